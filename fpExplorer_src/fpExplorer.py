@@ -32,14 +32,16 @@ https://www.tdt.com/support/python-sdk/offline-analysis-examples/fiber-photometr
 
 from tkinter import E
 import fpExplorer_functions
+import fpExplorer_cache
 import fpExplorer_csv
 import os
 import shutil
 import math
+import multiprocessing
 from PyQt5 import QtGui 
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
-from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, QTimer,QLocale
+from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, QTimer,QLocale,QThread,QEventLoop
 import pyqtgraph as pg
 from pyqtgraph.dockarea import *
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT as NavigationToolbar
@@ -49,6 +51,7 @@ import pandas as pd
 import numpy as np
 import sys
 import warnings
+import logging
 warnings.filterwarnings("ignore")
 
 #icon https://logomakr.com/9OpQfD
@@ -121,6 +124,7 @@ class MyMainWidget(QMainWindow):
         # list with general settings dictionary as first element 
         self.settings_dict = [{"downsample":None,
                               "entered_downsample":None,
+                              "downsample_method":fpExplorer_functions.DOWNSAMPLE_METHODS[0],
                               "normalization": "Standard Polynomial Fitting",
                               "show_norm_as":"Z-Score",
                               "filter":False,
@@ -413,6 +417,7 @@ class MyMainWidget(QMainWindow):
     # receives a single element list with settings from settings window
     def get_settings(self,settings):
         self.settings_dict[0]["downsample"] = settings[0]["downsample"] 
+        self.settings_dict[0]["downsample_method"] = settings[0]["downsample_method"]
         self.settings_dict[0]["normalization"] = settings[0]["normalization"]
         self.settings_dict[0]["show_norm_as"] = settings[0]["show_norm_as"]
         self.settings_dict[0]["filter"] = settings[0]["filter"]
@@ -461,9 +466,10 @@ class MyMainWidget(QMainWindow):
             
        
         # ask user for signal and control channels
-        data = fpExplorer_functions.get_raw_data(self.batch_paths_dict[self.select_data_window_content[0]["subject_names"][0]])
-        if data != None:
-            self.signal_control_window = SignalControlWindow(self,fpExplorer_functions.get_channel_names(data))
+        # (only headers are read to find channel names)
+        tank_info = fpExplorer_functions.get_tank_info(self.batch_paths_dict[self.select_data_window_content[0]["subject_names"][0]])
+        if tank_info != None:
+            self.signal_control_window = SignalControlWindow(self,tank_info["channel_names"])
             self.signal_control_window.got_signal_name_sig.connect(self.got_signal_name_sig)
             self.signal_control_window.show()   
         else:
@@ -1330,8 +1336,13 @@ class PreviewContinuousWidget(QWidget):
         # remember subject(key):group name(value) for later in a form dictionary
         self.group_names_dict = {self.options["subject"]:self.options["subject_group_name"]}
         
-        # a dictionary with subject:extracted raw data
-        self.raw_data_dict = {}
+        # downsampled and normalized data for all settings used so far
+        # key is (subject,stage,parameters), so changing plots does not repeat calculations
+        self.stage_cache = fpExplorer_cache.StageCache()
+        # a dictionary-like cache with subject:extracted raw data (only signal, control and events)
+        # least recently used subjects are released from memory and read again when needed
+        self.raw_data_dict = fpExplorer_cache.RawDataCache(self.preview_init_params[0][0]["signal_name"],
+                                                           self.preview_init_params[0][0]["control_name"])
         # start a widget by reading the first subject data on the list and adding that to dict
         self.get_raw_data(self.preview_init_params[0][0]["subject_names"][0],
                           self.preview_init_params[1][self.preview_init_params[0][0]["subject_names"][0]])
@@ -1725,50 +1736,34 @@ class PreviewContinuousWidget(QWidget):
             # if downsample was selected
             if self.downsample_cb.isChecked() or self.downsampled_export == True or self.save_plots == True or self.options["custom_baseline"] == True:
                 # add to downsampled dict
-                self.downsampled_dict[self.options["subject"]] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[self.options["subject"]][1],
-                                            self.settings_dict[0]["downsample"])
+                # (results are reused if subject was downsampled with the same settings before)
+                self.downsampled_dict[self.options["subject"]] = self.stage_cache.downsample(self.options["subject"],
+                                            self.trimmed_raw_data_dict[self.options["subject"]],
+                                            self.settings_dict)
             ##################################################
                 if self.options["custom_baseline"] == True:
-                    self.downsampled_baseline_dict[self.options["subject"]] = fpExplorer_functions.downsample(self.trimmed_baseline_data_dict[self.options["subject"]][1],
-                                            self.settings_dict[0]["downsample"])
+                    self.downsampled_baseline_dict[self.options["subject"]] = self.stage_cache.downsample(self.options["subject"],
+                                            self.trimmed_baseline_data_dict[self.options["subject"]],
+                                            self.settings_dict,"downsample_baseline")
             ##################################################
             # if normalize was selected
             if self.normalize_cb.isChecked() or self.normalized_export == True:
                 # always downsample first before normalizing
                 # downsample
-                self.downsampled_dict[self.options["subject"]] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[self.options["subject"]][1],
-                                                                                        self.settings_dict[0]["downsample"])
-                # check settings for method to normalize
-                if self.settings_dict[0]["normalization"] == "Modified Polynomial Fitting":                  
-                    if self.options["custom_baseline"] == True:
-                        self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_dff_baseline(
-                                                                                            self.downsampled_dict[self.options["subject"]],
-                                                                                            self.downsampled_baseline_dict[self.options["subject"]],
-                                                                                            self.settings_dict[0]["show_norm_as"],
-                                                                                            self.settings_dict[0]["filter"],
-                                                                                            self.settings_dict[0]["filter_window"])
-                    else: # whole trace used as baseline
-                        # normalize from downsampled
-                        self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_dff(
-                                                                                            self.downsampled_dict[self.options["subject"]],
-                                                                                            self.settings_dict[0]["show_norm_as"],
-                                                                                            self.settings_dict[0]["filter"],
-                                                                                            self.settings_dict[0]["filter_window"])
-                if self.settings_dict[0]["normalization"] == "Standard Polynomial Fitting":   
-                    if self.options["custom_baseline"] == True:
-                        self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_pMat_custom_baseline(
-                                                                                            self.downsampled_dict[self.options["subject"]],
-                                                                                            self.downsampled_baseline_dict[self.options["subject"]],
-                                                                                            self.settings_dict[0]["show_norm_as"],
-                                                                                            self.settings_dict[0]["filter"],
-                                                                                            self.settings_dict[0]["filter_window"])  
-                    else:   # whole trace used as baseline     
-                        # normalize from downsampled
-                        self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_pMat(
-                                                                                            self.downsampled_dict[self.options["subject"]],
-                                                                                            self.settings_dict[0]["show_norm_as"],
-                                                                                            self.settings_dict[0]["filter"],
-                                                                                            self.settings_dict[0]["filter_window"])
+                self.downsampled_dict[self.options["subject"]] = self.stage_cache.downsample(self.options["subject"],
+                                                                                        self.trimmed_raw_data_dict[self.options["subject"]],
+                                                                                        self.settings_dict)
+                # normalize with the method from settings
+                # (the fit is not repeated if subject was normalized with the same settings before)
+                if self.options["custom_baseline"] == True:
+                    self.normalized_dict[self.options["subject"]] = self.stage_cache.normalize(self.options["subject"],
+                                                                                        self.trimmed_raw_data_dict[self.options["subject"]],
+                                                                                        self.settings_dict,
+                                                                                        self.trimmed_baseline_data_dict[self.options["subject"]])
+                else: # whole trace used as baseline
+                    self.normalized_dict[self.options["subject"]] = self.stage_cache.normalize(self.options["subject"],
+                                                                                        self.trimmed_raw_data_dict[self.options["subject"]],
+                                                                                        self.settings_dict)
             # check what to show on the plot
             self.options["plot_separate"] = True if self.separate_signal_contol_cb.isChecked() else False 
             self.options["plot_downsampled"] = True if self.downsampled_plot_cb.isChecked() else False
@@ -1929,7 +1924,11 @@ class PreviewContinuousWidget(QWidget):
                                                     self.preview_init_params[0][0]["control_name"],
                                                     self.options["subject"],
                                                     False,
-                                                    "")
+                                                    "",
+                                                    self.stage_cache.get_cached_normalized(self.options["subject"],
+                                                                                           self.trimmed_raw_data_dict[self.options["subject"]],
+                                                                                           self.settings_dict,
+                                                                                           self.trimmed_baseline_data_dict[self.options["subject"]]))
                 else: # whole/trimmed trace as a baseline
                     slope_intercept_dict = fpExplorer_functions.show_polynomial_fitting(self.canvas,
                                                     self.settings_dict[0], 
@@ -1938,7 +1937,8 @@ class PreviewContinuousWidget(QWidget):
                                                     self.preview_init_params[0][0]["control_name"],
                                                     self.options["subject"],
                                                     False,
-                                                    "")
+                                                    "",
+                                                    self.stage_cache.get_cached_normalized(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict))
                 # show the equation of fitted lines
                 signal_slope_intercept = slope_intercept_dict["signal_slope_intercept"]
                 control_slope_intercept = slope_intercept_dict["control_slope_intercept"]
@@ -2089,23 +2089,10 @@ class PreviewContinuousWidget(QWidget):
                                                                                                                           )]
             # always downsample first before normalizing
             # downsample
-            self.downsampled_dict[self.options["subject"]] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[self.options["subject"]][1],
-                                                                                         self.settings_dict[0]["downsample"])
-            # check settings for method to normalize
-            if self.settings_dict[0]["normalization"] == "Modified Polynomial Fitting":                   
-                # normalize from downsampled
-                self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_dff(
-                                                                                        self.downsampled_dict[self.options["subject"]],
-                                                                                        self.settings_dict[0]["show_norm_as"],
-                                                                                        self.settings_dict[0]["filter"],
-                                                                                        self.settings_dict[0]["filter_window"])
-            if self.settings_dict[0]["normalization"] == "Standard Polynomial Fitting":                
-                # normalize from downsampled
-                self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_pMat(
-                                                                                        self.downsampled_dict[self.options["subject"]],
-                                                                                        self.settings_dict[0]["show_norm_as"],
-                                                                                        self.settings_dict[0]["filter"],
-                                                                                        self.settings_dict[0]["filter_window"])
+            self.downsampled_dict[self.options["subject"]] = self.stage_cache.downsample(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
+            # normalize from downsampled with the method from settings
+            # (reused if it was already normalized with the same settings)
+            self.normalized_dict[self.options["subject"]] = self.stage_cache.normalize(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
             # verify if spikes windows are within trimmed data
             # unpack window values
             [(block1_from,block1_till),(block2_from,block2_till),(block3_from,block3_till)] = self.blocks_windows_values
@@ -2201,7 +2188,8 @@ class PreviewContinuousWidget(QWidget):
                                                 self.preview_init_params[0][0]["control_name"],
                                                 self.options["subject"],
                                                 self.save_plots,
-                                                self.export_path)
+                                                self.export_path,
+                                                self.stage_cache.get_cached_normalized(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict))
             # raw was checked
             if self.raw_export == True:
                 self.plot_bare_raw_data(self.options["subject"],self.raw_data_dict[self.options["subject"]])
@@ -2234,8 +2222,11 @@ class PreviewContinuousWidget(QWidget):
         
     # add raw data structure and subject to self.raw_data dictionary   
     def get_raw_data(self,subject,my_path):
-        self.raw_data_dict[subject] = fpExplorer_functions.get_raw_data(my_path)
-        if self.raw_data_dict[subject] == None:
+        # results calculated from previously read data are no longer valid
+        # (results of subjects not read yet were calculated from the same path by normalize_subjects)
+        if subject in self.raw_data_dict:
+            self.stage_cache.clear_subject(subject)
+        if self.raw_data_dict.load(subject,my_path) == None:
             # remove from combo box
             index = self.subject_comboBox.findText(subject)  # find the index of text
             self.subject_comboBox.removeItem(index)  # remove item from index
@@ -2415,6 +2406,15 @@ class PreviewContinuousWidget(QWidget):
                             (subject_subfolder,subject)
                             )
         if self.parent_window.batch_export_settings_dict["normalized"] == True or self.parent_window.batch_export_settings_dict["spikes"] == True:
+            # read and normalize all subjects in parallel processes first
+            # (subjects are independent), the loop below reuses the results
+            normalize_batch_subjects(self,self.stage_cache,
+                                     {subject:self.parent_window.preview_params[1][subject]
+                                      for subject in self.parent_window.batch_export_settings_dict["batch_subjects"]},
+                                     self.preview_init_params[0][0]["signal_name"],
+                                     self.preview_init_params[0][0]["control_name"],
+                                     (new_trim_start,new_trim_end),
+                                     self.settings_dict)
             # create normalized data for most recent settings
             for subject in self.parent_window.batch_export_settings_dict["batch_subjects"]:
                 # create separate options dictionary for batch analysis
@@ -2438,23 +2438,10 @@ class PreviewContinuousWidget(QWidget):
                     
                     # always downsample first before normalizing
                     # downsample
-                    self.downsampled_dict[subject] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[subject][1],
-                                                                                self.settings_dict[0]["downsample"])
-                    # check settings for method to normalize
-                    if self.settings_dict[0]["normalization"] == "Modified Polynomial Fitting":                   
-                        # normalize from downsampled
-                        self.normalized_dict[subject] = fpExplorer_functions.normalize_dff(
-                                                                                                self.downsampled_dict[subject],
-                                                                                                self.settings_dict[0]["show_norm_as"],
-                                                                                                self.settings_dict[0]["filter"],
-                                                                                                self.settings_dict[0]["filter_window"])
-                    if self.settings_dict[0]["normalization"] == "Standard Polynomial Fitting":                
-                        # normalize from downsampled
-                        self.normalized_dict[subject] = fpExplorer_functions.normalize_pMat(
-                                                                                                self.downsampled_dict[subject],
-                                                                                                self.settings_dict[0]["show_norm_as"],
-                                                                                                self.settings_dict[0]["filter"],
-                                                                                                self.settings_dict[0]["filter_window"])
+                    self.downsampled_dict[subject] = self.stage_cache.downsample(subject,self.trimmed_raw_data_dict[subject],self.settings_dict)
+                    # normalize from downsampled with the method from settings
+                    # (reused if it was already normalized with the same settings)
+                    self.normalized_dict[subject] = self.stage_cache.normalize(subject,self.trimmed_raw_data_dict[subject],self.settings_dict)
                     if self.parent_window.batch_export_settings_dict["export_for_single_subjects"] == True:
                         # create subfolder with subject name
                         subject_subfolder = os.path.join(self.parent_window.batch_export_settings_dict["dump_path"],subject)
@@ -2469,7 +2456,8 @@ class PreviewContinuousWidget(QWidget):
                                                         self.preview_init_params[0][0]["control_name"],
                                                         subject,
                                                         True,
-                                                        subject_subfolder)
+                                                        subject_subfolder,
+                                                        self.stage_cache.get_cached_normalized(subject,self.trimmed_raw_data_dict[subject],self.settings_dict))
                                 
                                 if self.parent_window.batch_export_settings_dict["normalized"] == True:
                                     fpExplorer_functions.plot_normalized_alone(self.canvas,
@@ -2489,7 +2477,8 @@ class PreviewContinuousWidget(QWidget):
                                                         self.preview_init_params[0][0]["control_name"],
                                                         subject,
                                                         True,
-                                                        subject_subfolder)
+                                                        subject_subfolder,
+                                                        self.stage_cache.get_cached_normalized(subject,self.trimmed_raw_data_dict[subject],self.settings_dict))
                                 
                             if self.parent_window.batch_export_settings_dict["normalized"] == True:
                                 fpExplorer_functions.plot_normalized_alone(self.canvas,
@@ -2566,8 +2555,13 @@ class PreviewEventBasedWidget(QWidget):
         # remember subject(key):group name(value) for later in a form dictionary
         self.group_names_dict = {self.options["subject"]:self.options["subject_group_name"]}
         
-        # a dictionary with subject:extracted raw data
-        self.raw_data_dict = {}
+        # downsampled and normalized data for all settings used so far
+        # key is (subject,stage,parameters), so changing plots does not repeat calculations
+        self.stage_cache = fpExplorer_cache.StageCache()
+        # a dictionary-like cache with subject:extracted raw data (only signal, control and events)
+        # least recently used subjects are released from memory and read again when needed
+        self.raw_data_dict = fpExplorer_cache.RawDataCache(self.preview_init_params[0][0]["signal_name"],
+                                                           self.preview_init_params[0][0]["control_name"])
         # start a widget by reading the first subject data on the list and adding that to dict
         self.get_raw_data(self.preview_init_params[0][0]["subject_names"][0],
                           self.preview_init_params[1][self.preview_init_params[0][0]["subject_names"][0]])
@@ -3017,29 +3011,15 @@ class PreviewEventBasedWidget(QWidget):
             # if downsample was selected
             if self.downsample_cb.isChecked() or self.downsampled_export == True or self.save_plots == True or self.separate_signal_contol_cb.isChecked():
                 # add to downdampled dict
-                self.downsampled_dict[self.options["subject"]] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[self.options["subject"]][1],
-                                            self.settings_dict[0]["downsample"])
+                self.downsampled_dict[self.options["subject"]] = self.stage_cache.downsample(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
             # if normalize was selected
             if self.normalize_cb.isChecked() or self.normalized_export == True:
                 # always downsample first before normalizing
                 # downsample
-                self.downsampled_dict[self.options["subject"]] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[self.options["subject"]][1],
-                                                                                        self.settings_dict[0]["downsample"])
-                # check settings for method to normalize
-                if self.settings_dict[0]["normalization"] == "Modified Polynomial Fitting":                   
-                    # normalize from downsampled
-                    self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_dff(
-                                                                                        self.downsampled_dict[self.options["subject"]],
-                                                                                        self.settings_dict[0]["show_norm_as"],
-                                                                                        self.settings_dict[0]["filter"],
-                                                                                        self.settings_dict[0]["filter_window"])
-                if self.settings_dict[0]["normalization"] == "Standard Polynomial Fitting":                
-                    # normalize from downsampled
-                    self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_pMat(
-                                                                                        self.downsampled_dict[self.options["subject"]],
-                                                                                        self.settings_dict[0]["show_norm_as"],
-                                                                                        self.settings_dict[0]["filter"],
-                                                                                        self.settings_dict[0]["filter_window"])
+                self.downsampled_dict[self.options["subject"]] = self.stage_cache.downsample(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
+                # normalize from downsampled with the method from settings
+                # (reused if it was already normalized with the same settings)
+                self.normalized_dict[self.options["subject"]] = self.stage_cache.normalize(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
             # check what to show on the plot
             self.options["plot_separate"] = True if self.separate_signal_contol_cb.isChecked() else False 
             self.options["plot_downsampled"] = True if self.downsampled_plot_cb.isChecked() else False
@@ -3521,7 +3501,8 @@ class PreviewEventBasedWidget(QWidget):
                                                 self.preview_init_params[0][0]["control_name"],
                                                 self.options["subject"],
                                                 False,
-                                                "")
+                                                "",
+                                                self.stage_cache.get_cached_normalized(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict))
                 # show the equation of fitted lines
                 signal_slope_intercept = slope_intercept_dict["signal_slope_intercept"]
                 control_slope_intercept = slope_intercept_dict["control_slope_intercept"]
@@ -3560,11 +3541,10 @@ class PreviewEventBasedWidget(QWidget):
         subjects_event_sets = []
         if self.batch_perievent == True:
             for subject in self.parent_window.batch_export_settings_dict["batch_subjects"]:
-                if subject not in self.raw_data_dict:
-                    self.get_raw_data(subject,self.parent_window.preview_params[1][subject])
-                if self.raw_data_dict[subject] != None:
-                    evt_list = fpExplorer_functions.get_events(self.raw_data_dict[subject])
-                    subjects_event_sets.append(set(evt_list))
+                # check events without reading subject's streams
+                tank_info = fpExplorer_functions.get_tank_info(self.parent_window.preview_params[1][subject])
+                if tank_info != None:
+                    subjects_event_sets.append(set(tank_info["events"]))
             # find intersection of all subjects events (common events)  
             common_events = list(set.intersection(*subjects_event_sets))  
         if self.batch_perievent == True and len(common_events) == 0:
@@ -3589,9 +3569,17 @@ class PreviewEventBasedWidget(QWidget):
             self.perievent_window.show()
             
     # add raw data structure and subject to self.raw_data dictionary   
+    def add_normalized_around_event(self,subject,data):
+        # normalize the whole trace (or reuse the one normalized with the same settings)
+        normalized = self.stage_cache.normalize(subject,self.trimmed_raw_data_dict[subject],self.settings_dict)
+        fpExplorer_functions.add_normalized_around_event(data,normalized,self.settings_dict,self.preview_init_params[0][0]["signal_name"])
+
     def get_raw_data(self,subject,my_path):
-        self.raw_data_dict[subject] = fpExplorer_functions.get_raw_data(my_path)
-        if self.raw_data_dict[subject] == None:
+        # results calculated from previously read data are no longer valid
+        # (results of subjects not read yet were calculated from the same path by normalize_subjects)
+        if subject in self.raw_data_dict:
+            self.stage_cache.clear_subject(subject)
+        if self.raw_data_dict.load(subject,my_path) == None:
             # remove from combo box
             index = self.subject_comboBox.findText(subject)  # find the index of text
             self.subject_comboBox.removeItem(index)  # remove item from index
@@ -3744,6 +3732,9 @@ class PreviewEventBasedWidget(QWidget):
                                                         self.settings_dict,
                                                         self.preview_init_params[0][0]["signal_name"],
                                                         self.preview_init_params[0][0]["control_name"])
+                                # use windows of the whole trace normalized data instead of normalizing each trial
+                                if self.perievent_options_dict["use_normalized_trace"] == True:
+                                    self.add_normalized_around_event(subject,data)
                                 # # if run on batch was selected, select all trials by default
                                 # self.current_trials = [i+1 for i in range(len(data.streams[self.preview_init_params[0][0]["signal_name"]].filtered))]
                                 # if run on batch was selected, get selected trials
@@ -3939,6 +3930,9 @@ class PreviewEventBasedWidget(QWidget):
                                                                     self.settings_dict,
                                                                     self.preview_init_params[0][0]["signal_name"],
                                                                     self.preview_init_params[0][0]["control_name"])
+                                        # use windows of the whole trace normalized data instead of normalizing each trial
+                                        if self.perievent_options_dict["use_normalized_trace"] == True:
+                                            self.add_normalized_around_event(subject,data)
                                         # if run on batch was selected, select all trials by default
                                         # self.current_trials = [i+1 for i in range(len(data.streams[self.preview_init_params[0][0]["signal_name"]].filtered))]
                                         # if run on batch was selected, get selected trials
@@ -4137,6 +4131,9 @@ class PreviewEventBasedWidget(QWidget):
                                                     self.settings_dict,
                                                     self.preview_init_params[0][0]["signal_name"],
                                                     self.preview_init_params[0][0]["control_name"])
+            # use windows of the whole trace normalized data instead of normalizing each trial
+            if self.perievent_options_dict["use_normalized_trace"] == True:
+                self.add_normalized_around_event(self.options["subject"],data)
 
             # update export path settings
             if len(self.perievent_options_dict["export_path"]) > 0 and os.path.split(self.perievent_options_dict["export_path"])[1]==DEFAULT_EXPORT_FOLDER:
@@ -4654,7 +4651,8 @@ class PreviewEventBasedWidget(QWidget):
                                                 self.preview_init_params[0][0]["control_name"],
                                                 self.options["subject"],
                                                 self.save_plots,
-                                                self.export_path)
+                                                self.export_path,
+                                                self.stage_cache.get_cached_normalized(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict))
             # raw was checked
             if self.raw_export == True:
                 if self.options["event"] == "---":
@@ -4916,23 +4914,10 @@ class PreviewEventBasedWidget(QWidget):
                                                                                                                           )]
             # always downsample first before normalizing
             # downsample
-            self.downsampled_dict[self.options["subject"]] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[self.options["subject"]][1],
-                                                                                         self.settings_dict[0]["downsample"])
-            # check settings for method to normalize
-            if self.settings_dict[0]["normalization"] == "Modified Polynomial Fitting":                   
-                # normalize from downsampled
-                self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_dff(
-                                                                                        self.downsampled_dict[self.options["subject"]],
-                                                                                        self.settings_dict[0]["show_norm_as"],
-                                                                                        self.settings_dict[0]["filter"],
-                                                                                        self.settings_dict[0]["filter_window"])
-            if self.settings_dict[0]["normalization"] == "Standard Polynomial Fitting":                
-                # normalize from downsampled
-                self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_pMat(
-                                                                                        self.downsampled_dict[self.options["subject"]],
-                                                                                        self.settings_dict[0]["show_norm_as"],
-                                                                                        self.settings_dict[0]["filter"],
-                                                                                        self.settings_dict[0]["filter_window"])
+            self.downsampled_dict[self.options["subject"]] = self.stage_cache.downsample(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
+            # normalize from downsampled with the method from settings
+            # (reused if it was already normalized with the same settings)
+            self.normalized_dict[self.options["subject"]] = self.stage_cache.normalize(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
             # set event
             self.options["event"] = self.event_from_data_comboBox.currentText()
             self.options["event_name"] = self.event_name_text.text()
@@ -5116,6 +5101,15 @@ class PreviewEventBasedWidget(QWidget):
                             (subject_subfolder,subject)
                             )
         if self.parent_window.batch_export_settings_dict["normalized"] == True or self.parent_window.batch_export_settings_dict["spikes"] == True:
+            # read and normalize all subjects in parallel processes first
+            # (subjects are independent), the loop below reuses the results
+            normalize_batch_subjects(self,self.stage_cache,
+                                     {subject:self.parent_window.preview_params[1][subject]
+                                      for subject in self.parent_window.batch_export_settings_dict["batch_subjects"]},
+                                     self.preview_init_params[0][0]["signal_name"],
+                                     self.preview_init_params[0][0]["control_name"],
+                                     (new_trim_start,new_trim_end),
+                                     self.settings_dict)
             # create normalized data for most recent settings
             for i in range(len(self.parent_window.batch_export_settings_dict["batch_subjects"])):
                 subject = self.parent_window.batch_export_settings_dict["batch_subjects"][i]
@@ -5156,23 +5150,10 @@ class PreviewEventBasedWidget(QWidget):
                     
                     # always downsample first before normalizing
                     # downsample
-                    self.downsampled_dict[subject] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[subject][1],
-                                                                                self.settings_dict[0]["downsample"])
-                    # check settings for method to normalize
-                    if self.settings_dict[0]["normalization"] == "Modified Polynomial Fitting":                   
-                        # normalize from downsampled
-                        self.normalized_dict[subject] = fpExplorer_functions.normalize_dff(
-                                                                                                self.downsampled_dict[subject],
-                                                                                                self.settings_dict[0]["show_norm_as"],
-                                                                                                self.settings_dict[0]["filter"],
-                                                                                                self.settings_dict[0]["filter_window"])
-                    if self.settings_dict[0]["normalization"] == "Standard Polynomial Fitting":                
-                        # normalize from downsampled
-                        self.normalized_dict[subject] = fpExplorer_functions.normalize_pMat(
-                                                                                                self.downsampled_dict[subject],
-                                                                                                self.settings_dict[0]["show_norm_as"],
-                                                                                                self.settings_dict[0]["filter"],
-                                                                                                self.settings_dict[0]["filter_window"])
+                    self.downsampled_dict[subject] = self.stage_cache.downsample(subject,self.trimmed_raw_data_dict[subject],self.settings_dict)
+                    # normalize from downsampled with the method from settings
+                    # (reused if it was already normalized with the same settings)
+                    self.normalized_dict[subject] = self.stage_cache.normalize(subject,self.trimmed_raw_data_dict[subject],self.settings_dict)
                     if self.parent_window.batch_export_settings_dict["export_for_single_subjects"] == True:
                         # create subfolder with subject name
                         subject_subfolder = os.path.join(self.parent_window.batch_export_settings_dict["dump_path"],subject)
@@ -5191,7 +5172,8 @@ class PreviewEventBasedWidget(QWidget):
                                                 self.preview_init_params[0][0]["control_name"],
                                                 subject,
                                                 True,
-                                                subject_subfolder)
+                                                subject_subfolder,
+                                                self.stage_cache.get_cached_normalized(subject,self.trimmed_raw_data_dict[subject],self.settings_dict))
                         if self.parent_window.batch_export_settings_dict["normalized"] == True:
                             if self.options["event"] == "---":
                                 fpExplorer_functions.plot_normalized_alone(self.canvas,
@@ -5888,11 +5870,15 @@ class SettingsWindow(QMainWindow):
         self.downsample_text.setToolTip("Integers from "+str(self.min_downsampe_rate)+" to "+str(round(self.max_downsample_rate)))
         self.downsample_label = QLabel("Downsample to (in Hz)\nOriginal rate: "+str(round(self.current_fs))+" Hz")
         self.settings_layout.addRow(self.downsample_label,self.downsample_text)
+        self.downsample_method_comboBox = QComboBox()
+        self.downsample_method_comboBox.addItems(fpExplorer_functions.DOWNSAMPLE_METHODS)
+        self.downsample_method_comboBox.setCurrentText(self.settings[0]["downsample_method"])
+        self.settings_layout.addRow("Method of downsampling",self.downsample_method_comboBox)
         # self.update_rate_btn = QPushButton("Preview new rate")
         # self.after_rate_label = QLabel("After downsampling: "+str(round(self.current_fs/int(self.downsample_text.text()))) +" Hz")
         # self.settings_layout.addRow(self.after_rate_label,self.update_rate_btn)
         self.normalization_method_comboBox = QComboBox()
-        self.normalization_method_comboBox.addItems(["Standard Polynomial Fitting","Modified Polynomial Fitting"])
+        self.normalization_method_comboBox.addItems(fpExplorer_functions.NORMALIZATION_METHODS)
         self.normalization_method_comboBox.setCurrentText(self.settings[0]["normalization"])
         self.settings_layout.addRow("Method of normalization",self.normalization_method_comboBox)
         self.normalization_show_comboBox = QComboBox()
@@ -5911,6 +5897,9 @@ class SettingsWindow(QMainWindow):
         self.save_settings_layout.setAlignment(Qt.AlignRight)
         self.save_settings_btn = QPushButton("Save settings")
         self.save_settings_layout.addWidget(self.save_settings_btn)
+        self.clear_cache_btn = QPushButton("Clear cache")
+        self.clear_cache_btn.setToolTip("Delete copies of recordings saved to read them faster next time\n("+fpExplorer_cache.CONVERSION_CACHE_FOLDER+")")
+        self.save_settings_layout.addWidget(self.clear_cache_btn)
         self.settings_main_layout.addLayout(self.save_settings_layout)
         
         # set the window's main layout
@@ -5922,6 +5911,7 @@ class SettingsWindow(QMainWindow):
         self.setStyleSheet(STYLESHEET)
         
         self.save_settings_btn.clicked.connect(self.save_settings_btn_clicked)
+        self.clear_cache_btn.clicked.connect(self.clear_cache_btn_clicked)
         # self.update_rate_btn.clicked.connect(self.update_rate)
 
     # def update_rate(self):
@@ -5930,6 +5920,15 @@ class SettingsWindow(QMainWindow):
     #     # self.downsample_label.setText("Downsample X times (Suggested: 10-20 times)\nOriginal rate: "+str(round(self.current_fs))+" Hz; After downsampling: "+str(round(self.current_fs/int(self.downsample_text.text()))) +" Hz")
     #     self.after_rate_label.setText("After downsampling: "+str(round(self.current_fs/int(self.downsample_text.text()))) +" Hz")
 
+    def clear_cache_btn_clicked(self):
+        deleted = fpExplorer_cache.clear_conversion_cache()
+        message = "Deleted "+str(round(deleted/1024**2))+" MB of saved recordings."
+        # data in memory is kept, show how it is used
+        if self.parent_window.preview_widget != None:
+            message += "\n\nRaw data in memory: "+fpExplorer_cache.get_stats_text(self.parent_window.preview_widget.raw_data_dict.get_stats())
+            message += "\nAnalysis results in memory: "+fpExplorer_cache.get_stats_text(self.parent_window.preview_widget.stage_cache.get_stats())
+        self.show_info_dialog(message)
+
     def save_settings_btn_clicked(self):
         # read user settings
         self.read_user_settings()
@@ -5960,6 +5959,7 @@ class SettingsWindow(QMainWindow):
                     self.show_info_dialog("Fraction of the data has to be between 0 and "+str(MAX_SMOOTH_WINDOW))
             except:
                 self.show_info_dialog("Fraction of the data has to be between 0 and "+str(MAX_SMOOTH_WINDOW))
+        self.settings[0]["downsample_method"] = self.downsample_method_comboBox.currentText()
         # read normalization method
         self.settings[0]["normalization"] = self.normalization_method_comboBox.currentText()
         self.settings[0]["show_norm_as"] = self.normalization_show_comboBox.currentText()
@@ -6196,6 +6196,11 @@ class PeriEventOptionsWindow(QMainWindow):
         self.baseline_layout.addWidget(self.plot_zscore_cb,3,2) 
         self.baseline_layout.addWidget(self.plot_auc_cb,3,3)
         self.baseline_layout.addWidget(self.plot_zscore_with_trials_cb,4,2)
+        self.use_normalized_trace_cb = QCheckBox("Use whole trace normalization")
+        self.use_normalized_trace_cb.setToolTip("Cut trials out of the normalized whole recording\n(instead of normalizing each trial separately)")
+        if "use_normalized_trace" in self.options_dict:
+            self.use_normalized_trace_cb.setChecked(self.options_dict["use_normalized_trace"])
+        self.baseline_layout.addWidget(self.use_normalized_trace_cb,4,1)
         self.bottom_layout.addLayout(self.baseline_layout)
         
         self.analyze_btn = QPushButton("Analyze")
@@ -6573,6 +6578,7 @@ class PeriEventOptionsWindow(QMainWindow):
         self.options_dict["plot_zscore"] = self.plot_zscore_cb.isChecked()
         self.options_dict["plot_zscore_trials"] = self.plot_zscore_with_trials_cb.isChecked()
         self.options_dict["plot_auc"] = self.plot_auc_cb.isChecked()
+        self.options_dict["use_normalized_trace"] = self.use_normalized_trace_cb.isChecked()
         self.current_trials = []
         if self.batch == True:
             if self.how_many_batch_trials < 10 and self.how_many_batch_trials > 0:
@@ -6830,12 +6836,69 @@ class MplCanvas(FigureCanvasQTAgg):
         except:
             pass
         
+#################################################
+# CLASSES FOR NORMALIZING BATCH SUBJECTS        #
+################################################
+
+class NormalizeSubjectsThread(QThread):
+    '''Reads and normalizes batch subjects (jobs from StageCache.get_normalize_jobs)
+    in worker processes without blocking the GUI.
+    Emits progress_sig with subject, number of subjects done and all subjects after each subject.
+    '''
+    progress_sig = pyqtSignal(str,int,int)
+    def __init__(self, jobs, workers=fpExplorer_cache.BATCH_WORKERS):
+        super(NormalizeSubjectsThread, self).__init__()
+        self.jobs = jobs
+        self.workers = workers
+        self.results = []
+        
+    def run(self):
+        self.results = fpExplorer_cache.normalize_jobs(self.jobs,self.workers,self.progress_sig.emit)
+        
+class BatchProgressDialog(QProgressDialog):
+    def __init__(self, parent, n_subjects):
+        super(BatchProgressDialog, self).__init__("Normalizing subjects...",None,0,n_subjects,parent)
+        self.setWindowTitle("Run On Batch")
+        self.setWindowIcon(QtGui.QIcon(ICO))
+        self.setMinimumDuration(0)
+        self.setValue(0)
+        
+    @pyqtSlot(str,int,int)
+    def show_progress(self, subject, done, total):
+        self.setLabelText("Normalized "+subject+" ("+str(done)+" of "+str(total)+")")
+        self.setValue(done)
+        
+# read and normalize batch subjects in parallel processes and keep results in stage cache
+# the GUI keeps responding while waiting and shows each subject that is done
+def normalize_batch_subjects(parent, stage_cache, subject_paths, signal_name, control_name, trimming, settings_dict):
+    jobs = stage_cache.get_normalize_jobs(subject_paths,signal_name,control_name,trimming,settings_dict)
+    if fpExplorer_cache.get_workers(fpExplorer_cache.BATCH_WORKERS,len(jobs)) < 2:
+        # nothing to run in parallel (only logs that subjects are normalized one by one)
+        fpExplorer_cache.normalize_jobs(jobs)
+        return
+    progress_dialog = BatchProgressDialog(parent,len(jobs))
+    thread = NormalizeSubjectsThread(jobs)
+    thread.progress_sig.connect(progress_dialog.show_progress)
+    loop = QEventLoop()
+    thread.finished.connect(loop.quit)
+    thread.start()
+    loop.exec_()
+    progress_dialog.close()
+    stage_cache.add_normalized_results(jobs,thread.results,trimming,settings_dict)
+    errors = fpExplorer_cache.get_errors(jobs,thread.results)
+    if len(errors) > 0:
+        parent.show_info_dialog("Problem analyzing subjects:\n"+"\n".join([subject+": "+str(e) for subject,e in errors.items()]))
+        
 ################################################################
 #                                                              #
 # EXECUTE GUI FROM MAIN                                        #
 #                                                              #
 ################################################################
 if __name__ == "__main__":
+    # needed by batch worker processes in frozen (executable) version
+    multiprocessing.freeze_support()
+    # show info messages (i.e. from caches) in the console
+    logging.basicConfig(level=logging.INFO,format="%(message)s")
     # Always start by initializing Qt (only once per application)
     app = QApplication([])
     main_widget = MyMainWidget()
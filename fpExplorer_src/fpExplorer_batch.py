@@ -0,0 +1,590 @@
+# -*- coding: utf-8 -*-
+"""
+ Copyright (c) 2021 CSAN_LiU
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ """
+
+"""
+Headless batch analysis of TDT data tanks.
+
+Runs the same pipeline as the Run on Batch window of fpExplorer
+(read -> trim -> downsample -> normalize -> peri-event/spikes -> export)
+without any Qt widgets, so it can be used unattended on analysis servers.
+
+Example (from fpExplorer_src folder):
+    python fpExplorer_batch.py ../example_data/Peri-event --experiment FearConditioning
+        --signal _465A --control _405A --event "PrtA 254" --perievent
+"""
+
+import matplotlib
+# never try to open a window
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import fpExplorer_functions
+import fpExplorer_cache
+import fpExplorer_chunked
+import argparse
+import logging
+import math
+import os
+import sys
+
+# sampling rate (Hz) after downsampling, the same default as in the app
+DEFAULT_HZ = 100
+DEFAULT_SMOOTH_WINDOW = 10
+DEFAULT_EXPORT_FOLDER = "_fpExplorerAnalysis"
+SHOW_NORM_AS = ["Z-Score","dF/F"]
+# number of subjects processed at the same time (0 uses all available cores)
+DEFAULT_WORKERS = fpExplorer_cache.BATCH_WORKERS
+
+
+class HeadlessCanvas():
+    '''Replaces MplCanvas when there is no GUI.
+    Plotting functions only use canvas.fig and canvas.draw()
+    '''
+    def __init__(self, width=12, height=8, dpi=100):
+        self.fig = Figure(figsize=(width, height), dpi=dpi)
+        FigureCanvasAgg(self.fig)
+
+    def draw(self):
+        self.fig.canvas.draw()
+
+
+# dictionary with all settings used by the headless batch analysis
+# keys follow batch_export_settings_dict and perievent_options_dict from the GUI
+def get_default_batch_settings():
+    batch_settings = {"main_path":"",
+                      "selected_experiment":"",
+                      "subject_experiment":True,  # folder structure main_path/subject/experiment
+                      "batch_subjects":[],
+                      "batch_subjects_group_names":[],
+                      "signal_name":"",
+                      "control_name":"",
+                      "trim_begin":0,
+                      "trim_end":0,
+                      "trim_begin_event":"",
+                      "trim_end_event":"",
+                      "downsample":DEFAULT_HZ,
+                      "downsample_method":fpExplorer_functions.DOWNSAMPLE_METHODS[0],
+                      "normalization":"Standard Polynomial Fitting",
+                      "show_norm_as":"Z-Score",
+                      "filter":False,
+                      "filter_window":DEFAULT_SMOOTH_WINDOW,
+                      "raw":False,
+                      "normalized":True,
+                      "spikes":False,
+                      "perievent":False,
+                      "export_for_single_subjects":True,
+                      "export_group_data":False,
+                      "dump_path":"",
+                      "file_begin":"",
+                      # spikes options: list of parameters for scipy.find_peaks and time windows
+                      "peak_options":["None","None","None","None","None","None","None","None",True],
+                      "spikes_blocks":[("None","None"),("None","None"),("None","None")],
+                      # peri-event options
+                      "event":"",
+                      "event_name":"",
+                      "event2":"",
+                      "event2_name":"",
+                      "sec_before":5,
+                      "sec_after":10,
+                      "baseline_from":-5,
+                      "baseline_to":0,
+                      "auc_pre_from":-5,
+                      "auc_pre_to":0,
+                      "auc_post_from":0,
+                      "auc_post_to":5,
+                      "trials":[],
+                      "plot_avg":True,
+                      "plot_zscore":True,
+                      "plot_zscore_trials":True,
+                      "plot_auc":True,
+                      "use_normalized_trace":False,
+                      # read and normalize long recordings in chunks (None to decide by recording duration)
+                      "chunked":None,
+                      "chunk_sec":fpExplorer_chunked.CHUNK_SEC,
+                      # in chunks estimate Z-Score median and MAD from histograms
+                      "approximate_zscore":False}
+    return batch_settings
+
+# create a list with general settings dictionary as first element
+# the same way the main app window does
+def create_settings_dict(batch_settings):
+    settings_dict = [{"downsample":batch_settings["downsample"],
+                      "entered_downsample":None,
+                      "downsample_method":batch_settings["downsample_method"],
+                      "normalization":batch_settings["normalization"],
+                      "show_norm_as":batch_settings["show_norm_as"],
+                      "filter":batch_settings["filter"],
+                      "filter_window":batch_settings["filter_window"],
+                      "subject":"",
+                      "subject_group_name":""}]
+    return settings_dict
+
+# create perievent options dictionary the same way PeriEventOptionsWindow does
+def create_perievent_options_dict(batch_settings):
+    keys = ["event","event_name","sec_before","sec_after","baseline_from","baseline_to",
+            "auc_pre_from","auc_pre_to","auc_post_from","auc_post_to","trials",
+            "plot_avg","plot_zscore","plot_zscore_trials","plot_auc","use_normalized_trace"]
+    perievent_options_dict = {key:batch_settings[key] for key in keys}
+    perievent_options_dict["export"] = True
+    perievent_options_dict["export_path"] = batch_settings["dump_path"]
+    perievent_options_dict["file_beginning"] = batch_settings["file_begin"]
+    return perievent_options_dict
+
+# return subject:path to the data tank dictionary
+def get_subject_paths(batch_settings):
+    main_path = batch_settings["main_path"]
+    experiment = batch_settings["selected_experiment"]
+    subjects = batch_settings["batch_subjects"]
+    if batch_settings["subject_experiment"] == True:
+        if len(subjects) == 0:
+            subjects = sorted([el for el in os.listdir(main_path) if os.path.isdir(os.path.join(main_path,el))])
+        paths_dict = fpExplorer_functions.create_list_of_paths(main_path,subjects,experiment)
+        # keep only existing paths
+        paths_dict = {subject:path for subject,path in paths_dict.items() if os.path.exists(path)}
+    else:
+        if len(subjects) == 0:
+            to_experiment = os.path.join(main_path,experiment)
+            subjects = sorted([el for el in os.listdir(to_experiment) if os.path.isdir(os.path.join(to_experiment,el))])
+        valid_subjects,paths_dict = fpExplorer_functions.create_list_of_paths_experiment_subjects(main_path,subjects,experiment)
+    return paths_dict
+
+# get trimming in seconds (beginning, end) from settings
+# if trimming by event was selected, use the first/last onset of that event
+# (last_raw_ts is needed if raw_data has only epocs)
+def get_trimming(raw_data,batch_settings,last_raw_ts=None):
+    trim_beginning = int(batch_settings["trim_begin"])
+    trim_end = int(batch_settings["trim_end"])
+    if len(batch_settings["trim_begin_event"]) > 0:
+        begin_evt_data_onsets = fpExplorer_functions.get_event_on_off(raw_data, batch_settings["trim_begin_event"])[0]
+        trim_beginning = 0 # assign zero in case there is no such event
+        if len(begin_evt_data_onsets) > 0:
+            # use the first onset as trim begin
+            trim_beginning = math.ceil(begin_evt_data_onsets[0])
+        else:
+            print("There was a problem reading event "+batch_settings["trim_begin_event"]+". This data was not trimmed.")
+    if len(batch_settings["trim_end_event"]) > 0:
+        end_evt_data_onsets = fpExplorer_functions.get_event_on_off(raw_data, batch_settings["trim_end_event"])[0]
+        trim_end = 0 # assign zero in case there is no such event
+        if len(end_evt_data_onsets) > 0:
+            if last_raw_ts == None:
+                last_raw_ts = fpExplorer_functions.get_last_timestamp(raw_data,batch_settings["signal_name"])
+            # use last onset as trim end
+            trim_end = math.ceil(last_raw_ts - end_evt_data_onsets[-1])
+        else:
+            print("There was a problem reading event "+batch_settings["trim_end_event"]+". This data was not trimmed.")
+    return trim_beginning,trim_end
+
+# normalize downsampled data with the method from settings
+def normalize(downsampled,settings_dict):
+    return fpExplorer_cache.get_normalized(downsampled,None,settings_dict)
+
+# create subfolder with subject name
+# if that is not possible, save under main folder
+def get_subject_subfolder(dump_path,subject):
+    subject_subfolder = os.path.join(dump_path,subject)
+    if not os.path.exists(subject_subfolder):
+        try:
+            os.mkdir(subject_subfolder)
+        except:
+            print("Problem creating subfolder",subject_subfolder)
+            subject_subfolder = dump_path
+    return subject_subfolder
+
+# check if spikes time windows are within the normalized data
+def spikes_blocks_in_range(normalized,blocks_windows_values):
+    ts = normalized["ts"]
+    total_seconds = ts[-1]-ts[0]
+    for block in blocks_windows_values:
+        for el in block:
+            if len(str(el)) > 0 and el != "None":
+                if el > total_seconds or el < 0:
+                    return False
+    return True
+
+# check if recording should be processed in chunks
+def use_chunked(path,batch_settings):
+    if batch_settings["chunked"] != None:
+        return batch_settings["chunked"]
+    tank_info = fpExplorer_functions.get_tank_info(path)
+    return tank_info != None and tank_info["duration"] > fpExplorer_chunked.CHUNKED_MIN_DURATION
+
+def process_subject(subject,path,group_name,batch_settings,canvas=None):
+    '''Runs the whole pipeline for a single subject and exports single subject data.
+    Returns a dictionary with only the data needed for the group analysis:
+        normalized: dict(ts,normalized_signal) of the whole (trimmed) trace
+        perievent_normalized_df: dataframe with all normalized trials
+        perievent_zscored_df: dataframe with z-scored trials
+    or None if subject's data could not be read.
+    '''
+    if canvas == None:
+        canvas = HeadlessCanvas()
+    settings_dict = create_settings_dict(batch_settings)
+    signal_name = batch_settings["signal_name"]
+    control_name = batch_settings["control_name"]
+    dump_path = batch_settings["dump_path"]
+    file_begin = batch_settings["file_begin"]
+    single_subjects = batch_settings["export_for_single_subjects"]
+    result = {"subject":subject,
+              "normalized":None,
+              "perievent_normalized_df":None,
+              "perievent_zscored_df":None}
+    print("Processing subject",subject)
+    chunked = use_chunked(path,batch_settings)
+    if chunked == True:
+        # streams are read later chunk by chunk, for now only events
+        print("Processing subject",subject,"in chunks")
+        raw_data = fpExplorer_chunked.get_epocs_data(path)
+        stream_info = fpExplorer_chunked.get_stream_info(path,signal_name,control_name)
+        if raw_data == None or stream_info == None:
+            print("Problem reading subject's "+subject+" file. Subject will not be available for the analysis.")
+            return None
+        fs = stream_info["fs"]
+    else:
+        # read only signal and control streams and events
+        # (from conversion cache if this tank was analyzed before)
+        raw_data = fpExplorer_cache.get_converted_raw_data(path,[signal_name,control_name])
+        if raw_data == None:
+            print("Problem reading subject's "+subject+" file. Subject will not be available for the analysis.")
+            return None
+        fs = fpExplorer_functions.get_frequency(raw_data,signal_name)
+    settings_dict[0]["entered_downsample"] = round(fs/settings_dict[0]["downsample"])
+    subject_subfolder = dump_path
+    if single_subjects == True:
+        subject_subfolder = get_subject_subfolder(dump_path,subject)
+    if batch_settings["raw"] == True and single_subjects == True:
+        if chunked == True:
+            print("Raw data of subject "+subject+" is too long to plot.")
+        else:
+            fpExplorer_functions.plot_raw(canvas,subject,raw_data,signal_name,control_name,
+                                          True,True,(subject_subfolder,subject))
+    options_dict = {"subject":subject,"subject_group_name":group_name}
+    # in chunked mode peri-event trials are cut from the whole trace normalized data
+    if (batch_settings["normalized"] == True or batch_settings["spikes"] == True
+        or (batch_settings["perievent"] == True and (chunked == True or batch_settings["use_normalized_trace"] == True))):
+        if chunked == True:
+            trim_beginning,trim_end = get_trimming(raw_data,batch_settings,fpExplorer_chunked.get_last_timestamp(stream_info))
+            downsampled,normalized = fpExplorer_chunked.process_tank_chunked(path,signal_name,control_name,trim_beginning,trim_end,
+                                                                              settings_dict,batch_settings["chunk_sec"],stream_info,
+                                                                              batch_settings["approximate_zscore"])
+            if downsampled == None:
+                print("Problem reading subject's "+subject+" file. Subject will not be available for the analysis.")
+                return None
+            if normalized == None:
+                print("No data left after trimming for subject",subject)
+                return result
+        else:
+            trim_beginning,trim_end = get_trimming(raw_data,batch_settings)
+            trimmed = fpExplorer_functions.trim_raw_data(raw_data,signal_name,control_name,trim_beginning,trim_end)
+            if len(trimmed["ts"]) == 0:
+                print("No data left after trimming for subject",subject)
+                return result
+            # always downsample first before normalizing
+            downsampled = fpExplorer_functions.downsample(trimmed,settings_dict[0]["downsample"],settings_dict[0]["downsample_method"])
+            normalized = normalize(downsampled,settings_dict)
+        result["normalized"] = normalized
+        # events to show on the plots
+        event_data = []
+        for event in [batch_settings["event"],batch_settings["event2"]]:
+            if len(event) > 0:
+                evt = fpExplorer_functions.get_event_on_off(raw_data,event)
+                if len(evt[0]) == 0:
+                    print("Some "+event+" event data is missing.")
+                event_data.append(evt)
+        if single_subjects == True and (batch_settings["normalized"] == True or batch_settings["spikes"] == True):
+            # save also polynomial fitting by default
+            fpExplorer_functions.show_polynomial_fitting(canvas,settings_dict[0],downsampled,signal_name,control_name,
+                                                         subject,True,subject_subfolder,normalized)
+            if batch_settings["normalized"] == True:
+                if len(event_data) == 0:
+                    fpExplorer_functions.plot_normalized_alone(canvas,options_dict,normalized,True,True,
+                                                               (subject_subfolder,file_begin),settings_dict)
+                else:
+                    custom_event_name = batch_settings["event"] if len(batch_settings["event_name"])==0 else batch_settings["event_name"]
+                    custom_event_name2 = batch_settings["event2"] if len(batch_settings["event2_name"])==0 else batch_settings["event2_name"]
+                    fpExplorer_functions.plot_normalized_alone_with_event(canvas,options_dict,normalized,
+                                                                          custom_event_name,custom_event_name2,event_data,
+                                                                          True,True,(subject_subfolder,file_begin),settings_dict)
+            if batch_settings["spikes"] == True:
+                if spikes_blocks_in_range(normalized,batch_settings["spikes_blocks"]):
+                    try:
+                        fpExplorer_functions.plot_peaks(canvas,subject,normalized,
+                                                        batch_settings["peak_options"],
+                                                        batch_settings["spikes_blocks"],
+                                                        True,True,group_name,settings_dict,
+                                                        (subject_subfolder,file_begin))
+                    except:
+                        print("Could not calculate spikes for subject "+subject+". Try with different parameters.")
+                else:
+                    print("One or more time windows for spikes might be out of data range for subject",subject)
+    if batch_settings["perievent"] == True:
+        perievent_options_dict = create_perievent_options_dict(batch_settings)
+        if chunked == True:
+            data = fpExplorer_chunked.filter_downsampled_around_event(raw_data,downsampled,normalized,perievent_options_dict,
+                                                                      settings_dict,signal_name,control_name,stream_info)
+            perievent_options_dict["use_normalized_trace"] = True
+        else:
+            data = fpExplorer_functions.filter_data_around_event(raw_data,perievent_options_dict,settings_dict,signal_name,control_name)
+            if perievent_options_dict["use_normalized_trace"] == True and result["normalized"] != None:
+                fpExplorer_functions.add_normalized_around_event(data,result["normalized"],settings_dict,signal_name)
+        if len(data.streams[signal_name].filtered) == 0 or len(data.streams[control_name].filtered) == 0:
+            print("Not enough data that satisfy your request for subject "+subject+". Try changing event or times around the event.")
+            return result
+        # trial numbers are the same in chunked mode, where some trials might not be available
+        available = fpExplorer_functions.get_available_trials(data,signal_name)
+        if len(available) == 0:
+            print("Not enough data that satisfy your request for subject "+subject+". Try changing event or times around the event.")
+            return result
+        # include all trials if none were selected
+        current_trials = perievent_options_dict["trials"] if len(perievent_options_dict["trials"]) > 0 else available
+        for el in current_trials:
+            if el not in available:
+                print("Some of the selected trials not present in subject "+subject+" data.")
+                return result
+        analyzed_perievent_dict = fpExplorer_functions.analyze_perievent_data(data,current_trials,perievent_options_dict,
+                                                                              settings_dict,signal_name,control_name)
+        result["perievent_normalized_df"] = fpExplorer_functions.plot_raw_perievents(canvas,subject,data,current_trials,
+                                                                                     perievent_options_dict,settings_dict,
+                                                                                     signal_name,control_name,single_subjects,
+                                                                                     True,group_name,(subject_subfolder,file_begin))
+        if perievent_options_dict["plot_avg"] == True:
+            fpExplorer_functions.plot_perievent_average_alone(canvas,subject,current_trials,perievent_options_dict,
+                                                              analyzed_perievent_dict,single_subjects,True,group_name,
+                                                              settings_dict,signal_name,control_name,(subject_subfolder,file_begin))
+        if (perievent_options_dict["plot_zscore"] == True or perievent_options_dict["plot_zscore_trials"] == True
+            or perievent_options_dict["plot_auc"] == True): # we need zcsore data for auc
+            if perievent_options_dict["plot_zscore"] == True:
+                result["perievent_zscored_df"] = fpExplorer_functions.plot_perievent_zscore_alone(canvas,subject,current_trials,
+                                                                                                  perievent_options_dict,analyzed_perievent_dict,
+                                                                                                  single_subjects,True,group_name,
+                                                                                                  settings_dict,(subject_subfolder,file_begin))
+            else:
+                result["perievent_zscored_df"] = fpExplorer_functions.plot_perievent_zscore_with_trials_alone(canvas,subject,current_trials,
+                                                                                                              perievent_options_dict,analyzed_perievent_dict,
+                                                                                                              single_subjects,True,group_name,
+                                                                                                              settings_dict,(subject_subfolder,file_begin))
+        if perievent_options_dict["plot_auc"] == True:
+            fpExplorer_functions.plot_perievent_auc_alone(canvas,subject,perievent_options_dict,analyzed_perievent_dict,
+                                                          single_subjects,True,group_name,settings_dict,(subject_subfolder,file_begin))
+    return result
+
+# export group data from single subject results
+def export_group_data(results,batch_settings,canvas=None):
+    if canvas == None:
+        canvas = HeadlessCanvas()
+    settings_dict = create_settings_dict(batch_settings)
+    export_loc_data = (batch_settings["dump_path"],batch_settings["file_begin"])
+    group_names = [result["group_name"] for result in results]
+    settings_dict[0]["subject"] = ",".join([result["subject"] for result in results])
+    settings_dict[0]["subject_group_name"] = ",".join(group_names)
+    all_normalized = [(result["subject"],result["normalized"]) for result in results if result["normalized"] != None]
+    if batch_settings["normalized"] == True and len(all_normalized) > 0:
+        fpExplorer_functions.get_batch_normalized(canvas,all_normalized,settings_dict,True,export_loc_data)
+    if batch_settings["perievent"] == True:
+        perievent_options_dict = create_perievent_options_dict(batch_settings)
+        all_subjects_peri_normalized_dfs = [(result["subject"],result["perievent_normalized_df"]) for result in results
+                                            if result["perievent_normalized_df"] is not None]
+        all_subjects_zscored_dfs = [(result["subject"],result["perievent_zscored_df"]) for result in results
+                                    if result["perievent_zscored_df"] is not None]
+        if perievent_options_dict["plot_avg"] == True and len(all_subjects_peri_normalized_dfs) > 0:
+            fpExplorer_functions.get_batch_perievent_normalized(canvas,all_subjects_peri_normalized_dfs,group_names,
+                                                                perievent_options_dict,settings_dict,export_loc_data)
+        if len(all_subjects_zscored_dfs) > 0:
+            if perievent_options_dict["plot_zscore"] == True:
+                fpExplorer_functions.get_batch_perievent_zscored(canvas,all_subjects_zscored_dfs,group_names,
+                                                                 perievent_options_dict,settings_dict,export_loc_data)
+            if perievent_options_dict["plot_zscore_trials"] == True:
+                fpExplorer_functions.get_batch_perievent_zscored_with_trials(canvas,all_subjects_zscored_dfs,group_names,
+                                                                             perievent_options_dict,settings_dict,export_loc_data)
+            if perievent_options_dict["plot_auc"] == True:
+                fpExplorer_functions.get_batch_perievent_auc(canvas,all_subjects_zscored_dfs,group_names,
+                                                             perievent_options_dict,settings_dict,export_loc_data)
+
+def run_batch(batch_settings,workers=DEFAULT_WORKERS):
+    '''Runs batch analysis on all subjects from batch settings.
+    Subjects are independent, so with more than one worker they are analyzed
+    in parallel processes (workers=0 uses all available cores).
+    Returns a list of results from process_subject for subjects that could be read
+    and a dictionary subject:reason for subjects that failed.
+    '''
+    paths_dict = get_subject_paths(batch_settings)
+    subjects = [subject for subject in paths_dict]
+    group_names = batch_settings["batch_subjects_group_names"]
+    if len(group_names) != len(subjects):
+        group_names = ["" for subject in subjects]
+    if len(batch_settings["dump_path"]) == 0:
+        batch_settings["dump_path"] = os.path.join(batch_settings["main_path"],DEFAULT_EXPORT_FOLDER)
+    if not os.path.exists(batch_settings["dump_path"]):
+        os.makedirs(batch_settings["dump_path"])
+    if len(batch_settings["file_begin"]) == 0:
+        batch_settings["file_begin"] = batch_settings["selected_experiment"]
+    workers = fpExplorer_cache.get_workers(workers,len(subjects))
+    print("Started batch processing with",workers,"worker(s)")
+    canvas = HeadlessCanvas()
+    # worker processes create their own canvas and send back only
+    # the data needed for the group analysis
+    jobs = [(subject,(subject,paths_dict[subject],group_name,batch_settings,canvas if workers == 1 else None))
+            for subject,group_name in zip(subjects,group_names)]
+    # keep the order of subjects for the group analysis
+    subject_results = fpExplorer_cache.run_for_subjects(process_subject,jobs,workers)
+    results = []
+    failed = {}
+    for (subject,args),result,group_name in zip(jobs,subject_results,group_names):
+        if isinstance(result,Exception):
+            failed[subject] = str(result)
+        elif result == None:
+            failed[subject] = "data could not be read"
+        else:
+            result["group_name"] = group_name
+            results.append(result)
+    if batch_settings["export_group_data"] == True and len(results) > 0:
+        export_group_data(results,batch_settings,canvas)
+    print("Done batch processing")
+    print("Analyzed",len(results),"of",len(subjects),"subject(s)")
+    for subject in failed:
+        print("Problem analyzing subject "+subject+": "+failed[subject])
+    return results,failed
+
+def get_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Run fpExplorer batch analysis without GUI.")
+    parser.add_argument("main_path", help="data folder")
+    parser.add_argument("--experiment", required=True, help="experiment name")
+    parser.add_argument("--signal", required=True, help="signal channel name, i.e. _465A")
+    parser.add_argument("--control", required=True, help="control channel name, i.e. _405A")
+    parser.add_argument("--subjects", nargs="*", default=[], help="subjects to include (all by default)")
+    parser.add_argument("--groups", nargs="*", default=[], help="group name for each subject")
+    parser.add_argument("--experiment-subject", action="store_true",
+                        help="folder structure is main_path/experiment/subject (default main_path/subject/experiment)")
+    parser.add_argument("--trim-begin", type=int, default=0, help="trim first seconds")
+    parser.add_argument("--trim-end", type=int, default=0, help="trim last seconds")
+    parser.add_argument("--trim-begin-event", default="", help="trim beginning at the first onset of this event")
+    parser.add_argument("--trim-end-event", default="", help="trim end at the last onset of this event")
+    parser.add_argument("--downsample", type=int, default=DEFAULT_HZ, help="rate after downsampling (Hz)")
+    parser.add_argument("--downsample-method", choices=fpExplorer_functions.DOWNSAMPLE_METHODS, default=fpExplorer_functions.DOWNSAMPLE_METHODS[0])
+    parser.add_argument("--normalization", choices=fpExplorer_functions.NORMALIZATION_METHODS, default=fpExplorer_functions.NORMALIZATION_METHODS[0])
+    parser.add_argument("--show-as", choices=SHOW_NORM_AS, default=SHOW_NORM_AS[0])
+    parser.add_argument("--smooth-window", type=int, default=0, help="smoothing window (0 for no smoothing)")
+    parser.add_argument("--raw", action="store_true", help="export raw data")
+    parser.add_argument("--no-normalized", action="store_true", help="do not export normalized data")
+    parser.add_argument("--spikes", action="store_true", help="export spikes")
+    parser.add_argument("--distance", default="None", help="spikes minimal distance (sec)")
+    parser.add_argument("--prominence", default="None", help="spikes prominence")
+    parser.add_argument("--spikes-window", nargs=2, type=float, action="append", default=[], metavar=("FROM","TILL"),
+                        help="time window to count spikes separately (up to three)")
+    parser.add_argument("--perievent", action="store_true", help="run peri-event analysis around --event")
+    parser.add_argument("--event", default="", help="event, i.e. 'PrtA 254'")
+    parser.add_argument("--event-name", default="", help="custom event name")
+    parser.add_argument("--event2", default="", help="second event to show on plots")
+    parser.add_argument("--event2-name", default="", help="custom second event name")
+    parser.add_argument("--sec-before", type=int, default=5)
+    parser.add_argument("--sec-after", type=int, default=10)
+    parser.add_argument("--baseline", nargs=2, type=int, default=[-5,0], metavar=("FROM","TO"))
+    parser.add_argument("--auc-pre", nargs=2, type=int, default=[-5,0], metavar=("FROM","TO"))
+    parser.add_argument("--auc-post", nargs=2, type=int, default=[0,5], metavar=("FROM","TO"))
+    parser.add_argument("--trials", nargs="*", type=int, default=[], help="trials to include (all by default)")
+    parser.add_argument("--use-normalized-trace", action="store_true",
+                        help="cut peri-event trials out of the whole trace normalized data")
+    chunked = parser.add_mutually_exclusive_group()
+    chunked.add_argument("--chunked", action="store_true",
+                         help="read and normalize recordings in chunks (default for recordings longer than "
+                         +str(fpExplorer_chunked.CHUNKED_MIN_DURATION)+" sec; not with Polyphase downsampling)")
+    chunked.add_argument("--no-chunked", action="store_true", help="never process recordings in chunks")
+    parser.add_argument("--chunk-sec", type=int, default=fpExplorer_chunked.CHUNK_SEC, help="length of chunks (sec)")
+    parser.add_argument("--approximate-zscore", action="store_true",
+                        help="in chunks estimate Z-Score median and MAD from histograms (faster, less memory)")
+    parser.add_argument("--group-data", action="store_true", help="export group data")
+    parser.add_argument("--no-single-subjects", action="store_true", help="do not export data for single subjects")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of subjects analyzed in parallel (0 for all cores)")
+    parser.add_argument("--cache-folder", default="", help="where converted recordings are kept (~/.fpExplorer/cache by default)")
+    parser.add_argument("--cache-max-gb", type=float, default=fpExplorer_cache.CONVERSION_CACHE_MAX_BYTES/1024**3,
+                        help="disk space for converted recordings, least recently used are deleted")
+    parser.add_argument("--clear-cache", action="store_true", help="delete all converted recordings before the analysis")
+    parser.add_argument("--export-path", default="", help="where to save (main_path/"+DEFAULT_EXPORT_FOLDER+" by default)")
+    parser.add_argument("--file-begin", default="", help="beginning of the file names (experiment name by default)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = get_arguments(argv)
+    batch_settings = get_default_batch_settings()
+    batch_settings["main_path"] = args.main_path
+    batch_settings["selected_experiment"] = args.experiment
+    batch_settings["subject_experiment"] = not args.experiment_subject
+    batch_settings["batch_subjects"] = args.subjects
+    batch_settings["batch_subjects_group_names"] = args.groups
+    batch_settings["signal_name"] = args.signal
+    batch_settings["control_name"] = args.control
+    batch_settings["trim_begin"] = args.trim_begin
+    batch_settings["trim_end"] = args.trim_end
+    batch_settings["trim_begin_event"] = args.trim_begin_event
+    batch_settings["trim_end_event"] = args.trim_end_event
+    batch_settings["downsample"] = args.downsample
+    batch_settings["downsample_method"] = args.downsample_method
+    batch_settings["normalization"] = args.normalization
+    batch_settings["show_norm_as"] = args.show_as
+    batch_settings["filter"] = args.smooth_window > 0
+    batch_settings["filter_window"] = args.smooth_window if args.smooth_window > 0 else DEFAULT_SMOOTH_WINDOW
+    batch_settings["raw"] = args.raw
+    batch_settings["normalized"] = not args.no_normalized
+    batch_settings["spikes"] = args.spikes
+    batch_settings["peak_options"] = ["None","None",args.distance,args.prominence,"None","None","None","None",True]
+    for i in range(min(len(args.spikes_window),len(batch_settings["spikes_blocks"]))):
+        batch_settings["spikes_blocks"][i] = (round(args.spikes_window[i][0],1),round(args.spikes_window[i][1],1))
+    batch_settings["perievent"] = args.perievent
+    batch_settings["event"] = args.event
+    batch_settings["event_name"] = args.event_name
+    batch_settings["event2"] = args.event2
+    batch_settings["event2_name"] = args.event2_name
+    batch_settings["sec_before"] = args.sec_before
+    batch_settings["sec_after"] = args.sec_after
+    batch_settings["baseline_from"],batch_settings["baseline_to"] = args.baseline
+    batch_settings["auc_pre_from"],batch_settings["auc_pre_to"] = args.auc_pre
+    batch_settings["auc_post_from"],batch_settings["auc_post_to"] = args.auc_post
+    batch_settings["trials"] = args.trials
+    batch_settings["use_normalized_trace"] = args.use_normalized_trace
+    if args.chunked == True:
+        batch_settings["chunked"] = True
+    elif args.no_chunked == True:
+        batch_settings["chunked"] = False
+    batch_settings["chunk_sec"] = args.chunk_sec
+    batch_settings["approximate_zscore"] = args.approximate_zscore
+    batch_settings["export_group_data"] = args.group_data
+    batch_settings["export_for_single_subjects"] = not args.no_single_subjects
+    batch_settings["dump_path"] = args.export_path
+    batch_settings["file_begin"] = args.file_begin
+    if batch_settings["perievent"] == True and len(batch_settings["event"]) == 0:
+        print("Select an event for the peri-event analysis (--event)")
+        return 1
+    if batch_settings["chunked"] == True and batch_settings["downsample_method"] not in fpExplorer_chunked.CHUNKED_DOWNSAMPLE_METHODS:
+        print(batch_settings["downsample_method"]+" downsampling is not available with --chunked, select another --downsample-method")
+        return 1
+    fpExplorer_cache.set_conversion_cache(args.cache_folder if len(args.cache_folder) > 0 else None,args.cache_max_gb*1024**3)
+    if args.clear_cache == True:
+        print("Deleted",fpExplorer_cache.clear_conversion_cache(),"bytes of converted recordings")
+    results,failed = run_batch(batch_settings,args.workers)
+    if len(results) == 0:
+        print("No subjects could be analyzed")
+        return 1
+    if len(failed) > 0:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # show info messages (i.e. from caches) in the console
+    logging.basicConfig(level=logging.INFO,format="%(message)s")
+    sys.exit(main())
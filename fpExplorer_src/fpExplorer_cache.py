@@ -0,0 +1,833 @@
+# -*- coding: utf-8 -*-
+"""
+ Copyright (c) 2021 CSAN_LiU
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ """
+
+"""
+Caches used by fpExplorer to avoid reading and analyzing the same data twice
+while keeping memory use bounded.
+"""
+
+import tdt
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import hashlib
+import logging
+import mmap
+import pickle
+import shutil
+import os
+import fpExplorer_functions
+
+logger = logging.getLogger(__name__)
+
+# csv parser used for recordings: multithreaded pyarrow parser if it is installed
+# and pandas can use it with selected columns and dtypes (from version 1.4), otherwise C parser
+def get_csv_engine():
+    try:
+        import pyarrow
+    except ImportError:
+        return "c"
+    try:
+        version = tuple([int(x) for x in pd.__version__.split(".")[:2]])
+    except:
+        return "c"
+    if version >= (1,4):
+        return "pyarrow"
+    return "c"
+
+CSV_ENGINE = get_csv_engine()
+
+# how much memory (in bytes) loaded recordings can use before the least recently used are released
+RAW_DATA_CACHE_MAX_BYTES = 2*1024**3
+# converted recordings are saved there and read (memory mapped) from there next time
+# (another location can be set with FPEXPLORER_CACHE_FOLDER environment variable)
+CONVERSION_CACHE_FOLDER = os.environ.get("FPEXPLORER_CACHE_FOLDER",os.path.join(os.path.expanduser("~"),".fpExplorer","cache"))
+USE_CONVERSION_CACHE = True
+# how much disk space (in bytes) converted recordings can use before the least recently used are deleted
+# (or FPEXPLORER_CACHE_MAX_BYTES environment variable)
+CONVERSION_CACHE_MAX_BYTES = int(os.environ.get("FPEXPLORER_CACHE_MAX_BYTES",20*1024**3))
+# file with everything but the arrays of a converted recording
+CONVERSION_INFO_FILE = "info.pkl"
+# version of converted data format, data converted by other versions is deleted
+CONVERSION_FORMAT = 2
+# how much memory (in bytes) results of analysis stages (downsampled, normalized data) can use
+# before the least recently used are released
+STAGE_CACHE_MAX_BYTES = 512*1024**2
+# recording csv files: only time, signal and control columns are read
+# (columns are kept in one array, so they all get the larger of the two dtypes)
+CSV_RECORDING_COLUMNS = 3
+CSV_TIME_DTYPE = np.float64
+CSV_SIGNAL_DTYPE = np.float64
+# how many next subjects are read from csv files in background
+CSV_PREFETCH_SUBJECTS = 1
+# number of subjects processed at the same time in batch analysis (0 uses all available cores)
+BATCH_WORKERS = 0
+
+
+# True if array (or the array it is a view of) is memory mapped from a file
+# (its pages are read from disk when needed and can be dropped by the system)
+def is_mapped(array):
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, "base", None)
+    return False
+
+def get_array_size(array, mapped=False):
+    if isinstance(array, np.ndarray) and is_mapped(array) == mapped:
+        return array.nbytes
+    return 0
+
+# return approximate size in bytes of all arrays in tdt structure
+# that are in memory (or memory mapped from files if mapped is True)
+def get_block_size(raw_data, mapped=False):
+    total = 0
+    if not isinstance(raw_data, dict):
+        return total
+    for key in raw_data.keys():
+        el = raw_data[key]
+        if isinstance(el, np.ndarray):
+            total += get_array_size(el,mapped)
+        elif isinstance(el, dict):
+            total += get_block_size(el,mapped)
+        elif isinstance(el, (list, tuple)):
+            total += sum([get_array_size(x,mapped) for x in el])
+    return total
+
+# return size in bytes of dataframe columns that are in memory
+# (or memory mapped from files if mapped is True)
+def get_frame_size(df, mapped=False):
+    mapped_bytes = sum([get_array_size(df[name].to_numpy(),True) for name in df.columns])
+    if mapped == True:
+        return mapped_bytes
+    return int(df.memory_usage(index=True).sum())-mapped_bytes
+
+# keep only streams needed for the analysis (signal and control), all epocs and info
+def get_slim_block(raw_data,stream_names):
+    if raw_data is None:
+        return raw_data
+    slim_data = tdt.StructType()
+    for key in raw_data.keys():
+        if key == "streams":
+            slim_data.streams = tdt.StructType()
+            for name in raw_data.streams.keys():
+                if name in stream_names:
+                    slim_data.streams[name] = raw_data.streams[name]
+        elif key in ["snips","scalars"]:
+            slim_data[key] = tdt.StructType()
+        else:
+            slim_data[key] = raw_data[key]
+    return slim_data
+
+################################
+# conversion cache
+################################
+# size and modification time of the source file or of all files in the tank folder
+# converted data is valid as long as this does not change
+def get_source_stamp(path):
+    if os.path.isfile(path):
+        return [(os.path.basename(path),os.path.getsize(path),os.path.getmtime(path))]
+    stamp = []
+    for entry in sorted(os.scandir(path), key=lambda x: x.name):
+        if entry.is_file():
+            stamp.append((entry.name,entry.stat().st_size,entry.stat().st_mtime))
+    return stamp
+
+# each source (and selection of streams) gets its own folder in cache
+def get_conversion_folder(path,stream_names=[]):
+    key = os.path.abspath(path)+"|"+",".join(stream_names)
+    return os.path.join(CONVERSION_CACHE_FOLDER,hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+# write to a temporary file first so that other processes never see half written files
+def save_array(array,file_path):
+    temp_path = file_path+"."+str(os.getpid())+".tmp"
+    with open(temp_path,"wb") as f:
+        np.save(f,np.ascontiguousarray(array))
+    os.replace(temp_path,file_path)
+
+def save_info(info,folder):
+    file_path = os.path.join(folder,CONVERSION_INFO_FILE)
+    temp_path = file_path+"."+str(os.getpid())+".tmp"
+    with open(temp_path,"wb") as f:
+        pickle.dump(info,f,protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path,file_path)
+
+# returns saved info if it was created from the same version of source
+# in the current format, converted data of older versions is deleted
+def read_info(folder,stamp):
+    file_path = os.path.join(folder,CONVERSION_INFO_FILE)
+    try:
+        with open(file_path,"rb") as f:
+            info = pickle.load(f)
+    except:
+        return None
+    if info["stamp"] == stamp and info.get("format") == CONVERSION_FORMAT:
+        # modification time of info file is the time of last use
+        try:
+            os.utime(file_path)
+        except:
+            pass
+        return info
+    shutil.rmtree(folder,ignore_errors=True)
+    return None
+
+# change location and size of conversion cache
+# (also in environment, so that batch worker processes use the same)
+def set_conversion_cache(folder=None,max_bytes=None):
+    global CONVERSION_CACHE_FOLDER, CONVERSION_CACHE_MAX_BYTES
+    if folder != None:
+        CONVERSION_CACHE_FOLDER = folder
+        os.environ["FPEXPLORER_CACHE_FOLDER"] = folder
+    if max_bytes != None:
+        CONVERSION_CACHE_MAX_BYTES = int(max_bytes)
+        os.environ["FPEXPLORER_CACHE_MAX_BYTES"] = str(int(max_bytes))
+
+def get_folder_size(folder):
+    total = 0
+    for entry in os.scandir(folder):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+# folders of converted recordings with (time of last use, size in bytes)
+# folders without info file (conversion in progress) are skipped
+def get_conversion_folders():
+    folders = {}
+    if not os.path.isdir(CONVERSION_CACHE_FOLDER):
+        return folders
+    for entry in os.scandir(CONVERSION_CACHE_FOLDER):
+        try:
+            if entry.is_dir():
+                folders[entry.path] = (os.path.getmtime(os.path.join(entry.path,CONVERSION_INFO_FILE)),get_folder_size(entry.path))
+        except:
+            pass
+    return folders
+
+def prune_conversion_cache(max_bytes=None,keep=None):
+    '''Deletes least recently used converted recordings until all of them
+    use at most max_bytes (CONVERSION_CACHE_MAX_BYTES by default) of disk space
+    (never the keep folder). Returns number of deleted bytes
+    '''
+    if max_bytes == None:
+        max_bytes = CONVERSION_CACHE_MAX_BYTES
+    folders = get_conversion_folders()
+    total = sum([size for last_use,size in folders.values()])
+    deleted = 0
+    for folder in sorted(folders.keys(),key=lambda x: folders[x][0]):
+        if total <= max_bytes:
+            break
+        if folder == keep:
+            continue
+        shutil.rmtree(folder,ignore_errors=True)
+        total -= folders[folder][1]
+        deleted += folders[folder][1]
+    return deleted
+
+# delete all converted recordings, returns number of deleted bytes
+def clear_conversion_cache():
+    return prune_conversion_cache(0)
+
+# info file is written last, it marks the conversion as complete
+def finish_conversion(info,folder):
+    info["format"] = CONVERSION_FORMAT
+    save_info(info,folder)
+    prune_conversion_cache(keep=folder)
+
+# arrays are memory mapped copy-on-write: pages are shared between processes
+# and changes stay private
+def load_array(folder,file_name):
+    return np.load(os.path.join(folder,file_name),mmap_mode="c")
+
+def get_array_frame(array,columns):
+    '''Returns dataframe with columns that are rows of 2-D array (one contiguous row per column).
+    Dataframe is a single block that is a view of the array, so memory mapped data
+    stays on disk until it is used (dataframe built from separate column arrays
+    is copied into one block by older pandas versions).
+    If pandas copies the data anyway, dataframe is in memory like a csv file that was read
+    (get_frame_size counts it so) and it is logged.
+    '''
+    df = pd.DataFrame(array.T,columns=columns,copy=False)
+    if is_mapped(array) and len(columns) > 0 and not np.shares_memory(df.iloc[:,0].to_numpy(),array):
+        logger.info("Memory mapped data was copied into memory by pandas %s",pd.__version__)
+    return df
+
+# rows of 2-D array saved by save_frame_array, memory mapped
+def load_frame_array(folder):
+    return load_array(folder,"data.npy")
+
+# save dataframe columns as rows of a 2-D array
+def save_frame_array(array,folder):
+    save_array(array,os.path.join(folder,"data.npy"))
+
+def save_converted_block(raw_data,folder,stamp):
+    os.makedirs(folder,exist_ok=True)
+    # streams data is saved in separate files, the rest of structure (epocs, info) is pickled
+    block = tdt.StructType()
+    for key in raw_data.keys():
+        if key == "streams":
+            block.streams = tdt.StructType()
+            for name in raw_data.streams.keys():
+                save_array(raw_data.streams[name].data,os.path.join(folder,name+".npy"))
+                block.streams[name] = tdt.StructType()
+                for k in raw_data.streams[name].keys():
+                    if k != "data":
+                        block.streams[name][k] = raw_data.streams[name][k]
+        else:
+            block[key] = raw_data[key]
+    finish_conversion({"stamp":stamp,"block":block},folder)
+
+def load_converted_block(folder,info):
+    raw_data = info["block"]
+    for name in raw_data.streams.keys():
+        raw_data.streams[name].data = load_array(folder,name+".npy")
+    return raw_data
+
+def get_converted_raw_data(path,stream_names):
+    '''Returns raw data with only selected streams and epocs.
+    Data converted before from the same tank files is memory mapped from cache,
+    otherwise tank is read and converted data is saved to cache.
+    '''
+    if USE_CONVERSION_CACHE == False or len(stream_names) == 0:
+        return get_slim_block(fpExplorer_functions.get_raw_data(path,stream_names),stream_names)
+    try:
+        stamp = get_source_stamp(path)
+        folder = get_conversion_folder(path,stream_names)
+        info = read_info(folder,stamp)
+        if info != None:
+            return load_converted_block(folder,info)
+    except:
+        stamp = None
+    raw_data = get_slim_block(fpExplorer_functions.get_raw_data(path,stream_names),stream_names)
+    if raw_data != None and stamp != None:
+        try:
+            save_converted_block(raw_data,folder,stamp)
+        except Exception as e:
+            logger.warning("Could not save converted data of %s to %s: %s",path,CONVERSION_CACHE_FOLDER,e)
+    return raw_data
+
+def read_converted_csv(path):
+    '''Returns a dataframe read from csv file.
+    Numeric data is memory mapped from cache if the file was read before,
+    other files are kept in cache as pickled dataframes.
+    '''
+    if USE_CONVERSION_CACHE == False:
+        return pd.read_csv(path)
+    try:
+        stamp = get_source_stamp(path)
+        folder = get_conversion_folder(path)
+        info = read_info(folder,stamp)
+        if info != None:
+            if info["df"] is None:
+                return get_array_frame(load_frame_array(folder),info["columns"])
+            return info["df"]
+    except:
+        stamp = None
+    df = pd.read_csv(path)
+    if stamp != None:
+        try:
+            os.makedirs(folder,exist_ok=True)
+            if len(df.columns) > 0 and all([pd.api.types.is_numeric_dtype(t) for t in df.dtypes]) and len(set(df.dtypes)) == 1:
+                save_frame_array(df.to_numpy().T,folder)
+                finish_conversion({"stamp":stamp,"columns":list(df.columns),"df":None},folder)
+            else:
+                finish_conversion({"stamp":stamp,"df":df},folder)
+        except Exception as e:
+            logger.warning("Could not save converted data of %s to %s: %s",path,CONVERSION_CACHE_FOLDER,e)
+    return df
+
+def read_csv_columns(path):
+    '''Reads time, signal and control columns from csv file with numeric dtypes
+    Returns list of column names and 2-D array with one contiguous row per column
+    '''
+    names = list(pd.read_csv(path,nrows=0).columns[:CSV_RECORDING_COLUMNS])
+    dtypes = {names[0]:CSV_TIME_DTYPE}
+    for name in names[1:]:
+        dtypes[name] = CSV_SIGNAL_DTYPE
+    try:
+        df = pd.read_csv(path,usecols=names,dtype=dtypes,engine=CSV_ENGINE)
+    except ValueError as e:
+        # values that are not numbers (i.e. text in the middle) cannot be parsed with numeric dtypes,
+        # file is read again and they become nan
+        logger.warning("%s has values that are not numbers (%s), they are replaced with nan",path,e)
+        df = pd.read_csv(path,usecols=names)
+        df = pd.DataFrame({name:pd.to_numeric(df[name],errors="coerce").to_numpy(dtype=dtypes[name]) for name in names})
+    array = np.empty((len(names),len(df)),dtype=np.result_type(*dtypes.values()))
+    for i,name in enumerate(names):
+        array[i] = df[name].to_numpy(dtype=dtypes[name])
+    return names,array
+
+# True if times (numpy array) never decrease
+def is_increasing(ts):
+    return len(ts) < 2 or not np.any(ts[1:] < ts[:-1])
+
+# keep samples in file order, but remember if time is increasing
+# (attrs["time_increasing"], checked once here)
+def set_time_order(df,path,time_increasing=None):
+    if time_increasing == None:
+        time_increasing = len(df.columns) == 0 or is_increasing(df.iloc[:,0].to_numpy())
+    if time_increasing == False:
+        logger.warning("Time in %s is not increasing, samples are used in the order they are in the file",path)
+    df.attrs["time_increasing"] = time_increasing
+    return df
+
+def read_recording_csv(path):
+    '''Returns a dataframe with time, signal and control columns of csv recording.
+    Columns are contiguous numeric arrays (memory mapped from cache if the file was read before).
+    attrs["time_increasing"] is False if samples are not in time order
+    '''
+    if USE_CONVERSION_CACHE == False:
+        names,array = read_csv_columns(path)
+        return set_time_order(get_array_frame(array,names),path)
+    try:
+        stamp = get_source_stamp(path)
+        folder = get_conversion_folder(path,["recording"])
+        info = read_info(folder,stamp)
+        if info != None:
+            df = get_array_frame(load_frame_array(folder),info["columns"])
+            return set_time_order(df,path,info.get("time_increasing"))
+    except:
+        stamp = None
+    names,array = read_csv_columns(path)
+    df = set_time_order(get_array_frame(array,names),path)
+    if stamp != None:
+        try:
+            os.makedirs(folder,exist_ok=True)
+            save_frame_array(array,folder)
+            finish_conversion({"stamp":stamp,"columns":names,"time_increasing":df.attrs["time_increasing"]},folder)
+        except Exception as e:
+            logger.warning("Could not save converted data of %s to %s: %s",path,CONVERSION_CACHE_FOLDER,e)
+    return df
+
+def get_event_index(df):
+    '''Returns dictionary event name:(onsets,offsets) of events dataframe
+    (first column event name, second onset, third offset) in order of first appearance.
+    Onsets and offsets are float64 arrays, values that are not numbers are skipped
+    (empty cells stay as nan like before).
+    '''
+    names = df.iloc[:,0].to_numpy().astype(str)
+    columns = []
+    for col in [df.iloc[:,1],df.iloc[:,2]]:
+        numeric = pd.to_numeric(col,errors="coerce")
+        columns.append((numeric.to_numpy(dtype=np.float64),(numeric.notna() | col.isna()).to_numpy()))
+    codes,unique_names = pd.factorize(names)
+    # rows of each event next to each other, in original order
+    order = np.argsort(codes,kind="stable")
+    bounds = np.searchsorted(codes[order],np.arange(len(unique_names)+1))
+    index = {}
+    for i,name in enumerate(unique_names):
+        rows = order[bounds[i]:bounds[i+1]]
+        index[str(name)] = tuple([values[rows][valid[rows]] for values,valid in columns])
+    return index
+
+def read_events_csv(path):
+    '''Returns event index (see get_event_index) of events csv file'''
+    return get_event_index(read_converted_csv(path))
+
+
+# short description of statistics from get_stats of a cache to show to the user
+def get_stats_text(stats):
+    return (str(round(stats["bytes"]/1024**2))+" of "+str(round(stats["max_bytes"]/1024**2))+" MB, "
+            +str(stats["hits"])+" hits, "+str(stats["misses"])+" misses, "+str(stats["evictions"])+" released")
+
+
+class RawDataCache():
+    '''Dictionary-like store of subject:raw data read by tdt.
+    Only signal and control streams and epocs are kept.
+    When the total size of stored data exceeds max_bytes,
+    least recently used subjects are released and read again from their path on next access.
+    Subjects that could not be read are remembered as None.
+    '''
+    def __init__(self, signal_name, control_name, max_bytes=RAW_DATA_CACHE_MAX_BYTES):
+        self.signal_name = signal_name
+        self.control_name = control_name
+        self.max_bytes = max_bytes
+        # subject:path for all subjects that were read, including released ones
+        self.paths = {}
+        # subject:(raw data,size in bytes) in order of use (most recent last)
+        self.data = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def read(self, path):
+        return get_converted_raw_data(path,[self.signal_name,self.control_name])
+
+    # memory mapped arrays are not counted, they are not kept in memory
+    def get_size(self, raw_data):
+        return get_block_size(raw_data)
+
+    def get_mapped_size(self, raw_data):
+        return get_block_size(raw_data,True)
+
+    # read subject's data from path and keep it in cache
+    def load(self, subject, path):
+        self.misses += 1
+        # subject is read again, so are its events
+        fpExplorer_functions.clear_event_index(path)
+        raw_data = self.read(path)
+        self.paths[subject] = path
+        self.add(subject, raw_data)
+        return raw_data
+
+    def add(self, subject, raw_data):
+        if subject in self.data:
+            self.total_bytes -= self.data[subject][1]
+            del self.data[subject]
+        size = self.get_size(raw_data)
+        self.data[subject] = (raw_data,size)
+        self.total_bytes += size
+        self.evict(keep=subject)
+
+    # release least recently used data until it fits into memory budget
+    # never release the most recent subject, data that cannot be read again
+    # or subjects that take no memory (could not be read or only memory mapped)
+    def evict(self, keep=None):
+        for subject in list(self.data.keys()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if subject == keep or subject not in self.paths or self.data[subject][1] == 0:
+                continue
+            raw_data,size = self.data.pop(subject)
+            self.total_bytes -= size
+            self.evictions += 1
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Released %s data from memory %s",subject,self.get_stats())
+
+    def get_stats(self):
+        return {"hits":self.hits,
+                "misses":self.misses,
+                "evictions":self.evictions,
+                "subjects":len(self.data),
+                "bytes":self.total_bytes,
+                "mapped_bytes":sum([self.get_mapped_size(data) for data,size in self.data.values()]),
+                "max_bytes":self.max_bytes}
+
+    def __contains__(self, subject):
+        return subject in self.data or subject in self.paths
+
+    def __getitem__(self, subject):
+        if subject in self.data:
+            self.hits += 1
+            self.data.move_to_end(subject)
+            return self.data[subject][0]
+        if subject in self.paths:
+            # it was released, read again
+            return self.load(subject, self.paths[subject])
+        raise KeyError(subject)
+
+    # data added directly cannot be read again, so it is never released
+    def __setitem__(self, subject, raw_data):
+        if subject in self.paths:
+            del self.paths[subject]
+        self.add(subject, raw_data)
+
+    def __delitem__(self, subject):
+        if subject in self.data:
+            self.total_bytes -= self.data[subject][1]
+            del self.data[subject]
+        if subject in self.paths:
+            del self.paths[subject]
+
+    def __len__(self):
+        return len(set(self.data.keys()) | set(self.paths.keys()))
+
+    def clear(self):
+        self.paths = {}
+        self.data = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class CsvDataCache(RawDataCache):
+    '''RawDataCache of data read from csv files (recording dataframes or event indexes).
+    Paths of all subjects are known from the start and each subject is read on first access.
+    Next subjects can be read ahead in a background thread (prefetch).
+    '''
+    def __init__(self, read_function, max_bytes=RAW_DATA_CACHE_MAX_BYTES):
+        RawDataCache.__init__(self, None, None, max_bytes)
+        # reads dataframe from path
+        self.read_function = read_function
+        # subject:(path,future) of data read in background
+        self.prefetched = {}
+        self.executor = None
+        self.prefetch_hits = 0
+
+    # remember subject:path for subjects that will be read when needed
+    def set_paths(self, subject_paths):
+        for subject,path in subject_paths.items():
+            if self.paths.get(subject) != path:
+                self.__delitem__(subject)
+                self.paths[subject] = path
+
+    def read(self, path):
+        return self.read_function(path)
+
+    def get_size(self, data):
+        if isinstance(data, pd.DataFrame):
+            return get_frame_size(data)
+        return get_block_size(data)
+
+    def get_mapped_size(self, data):
+        if isinstance(data, pd.DataFrame):
+            return get_frame_size(data,True)
+        return get_block_size(data,True)
+
+    def load(self, subject, path):
+        prefetched_path,future = self.prefetched.pop(subject,(None,None))
+        if future == None or prefetched_path != path:
+            return RawDataCache.load(self, subject, path)
+        # wait for background reading to finish
+        self.prefetch_hits += 1
+        df = future.result()
+        self.paths[subject] = path
+        self.add(subject, df)
+        return df
+
+    def prefetch(self, subjects):
+        '''Starts reading subjects that are not in memory in background
+        Only the last requested subjects are kept prefetched
+        '''
+        for subject in list(self.prefetched.keys()):
+            if subject not in subjects:
+                # if it is already read, the data is just dropped
+                self.prefetched.pop(subject)[1].cancel()
+        for subject in subjects:
+            if subject in self.data or subject in self.prefetched or subject not in self.paths:
+                continue
+            if self.executor == None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            self.prefetched[subject] = (self.paths[subject],self.executor.submit(self.read_function,self.paths[subject]))
+
+    def get_stats(self):
+        stats = RawDataCache.get_stats(self)
+        stats["prefetch_hits"] = self.prefetch_hits
+        return stats
+
+    def __delitem__(self, subject):
+        if subject in self.prefetched:
+            self.prefetched.pop(subject)[1].cancel()
+        RawDataCache.__delitem__(self, subject)
+
+    def __setitem__(self, subject, df):
+        if subject in self.prefetched:
+            self.prefetched.pop(subject)[1].cancel()
+        RawDataCache.__setitem__(self, subject, df)
+
+    def clear(self):
+        for path,future in self.prefetched.values():
+            future.cancel()
+        self.prefetched = {}
+        self.prefetch_hits = 0
+        RawDataCache.clear(self)
+
+
+class StageCache():
+    '''Results of analysis stages (downsampling, normalization) of each subject
+    keyed by (subject, stage, parameters of this and all previous stages).
+    Repeated requests with the same parameters return the same result without recalculating it.
+    When the total size of results exceeds max_bytes, least recently used are released.
+    '''
+    def __init__(self, max_bytes=STAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        # key:(result,size in bytes) in order of use (most recent last)
+        self.data = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # return result of function(*args) calculated before with the same key or calculate it now
+    def get(self, subject, stage, params, function, *args):
+        key = (subject,stage,params)
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key][0]
+        self.misses += 1
+        result = function(*args)
+        self.add(key, result)
+        return result
+
+    def add(self, key, result):
+        if key in self.data:
+            self.total_bytes -= self.data.pop(key)[1]
+        size = get_block_size(result)
+        self.data[key] = (result,size)
+        self.total_bytes += size
+        # release least recently used results, but never the newest
+        while self.total_bytes > self.max_bytes and len(self.data) > 1:
+            old_key,(old_result,old_size) = self.data.popitem(last=False)
+            self.total_bytes -= old_size
+            self.evictions += 1
+
+    # trimmed is a list with (trim begin, trim end) as first element and trimmed data as second
+    def downsample(self, subject, trimmed, settings_dict, stage="downsample"):
+        params = (trimmed[0],settings_dict[0]["downsample"],settings_dict[0]["downsample_method"])
+        return self.get(subject,stage,params,
+                        fpExplorer_functions.downsample,trimmed[1],settings_dict[0]["downsample"],settings_dict[0]["downsample_method"])
+
+    # normalize downsampled trimmed data with the method from settings
+    # if trimmed_baseline is given (the same format as trimmed), use it as baseline
+    def normalize(self, subject, trimmed, settings_dict, trimmed_baseline=None):
+        downsampled = self.downsample(subject,trimmed,settings_dict)
+        downsampled_baseline = None
+        if trimmed_baseline != None:
+            downsampled_baseline = self.downsample(subject,trimmed_baseline,settings_dict,"downsample_baseline")
+        return self.get(subject,"normalize",get_normalize_params(trimmed,settings_dict,trimmed_baseline),
+                        get_normalized,downsampled,downsampled_baseline,settings_dict)
+
+    # normalized data (with the fit) calculated before with the same settings or None if there is none
+    # (nothing is calculated, i.e. to show polynomial fitting without fitting again)
+    def get_cached_normalized(self, subject, trimmed, settings_dict, trimmed_baseline=None):
+        key = (subject,"normalize",get_normalize_params(trimmed,settings_dict,trimmed_baseline))
+        if key in self.data:
+            return self.data[key][0]
+        return None
+
+    # keep downsampled and normalized data calculated elsewhere (i.e. in a worker process)
+    # trimming is (trim begin, trim end) the same as the first element of trimmed
+    def add_normalized(self, subject, trimming, settings_dict, downsampled, normalized):
+        params = (trimming,settings_dict[0]["downsample"],settings_dict[0]["downsample_method"])
+        for key,result in [((subject,"downsample",params),downsampled),
+                           ((subject,"normalize",get_normalize_params([trimming],settings_dict)),normalized)]:
+            self.add(key, result)
+
+    # jobs for normalize_jobs: (subject,arguments of get_normalized_from_path)
+    # for subjects that were not normalized before with the same settings
+    def get_normalize_jobs(self, subject_paths, signal_name, control_name, trimming, settings_dict):
+        return [(subject,(path,signal_name,control_name,trimming,settings_dict)) for subject,path in subject_paths.items()
+                if self.get_cached_normalized(subject,[trimming],settings_dict) is None]
+
+    # keep results of normalize_jobs (in the same order as jobs), subjects that failed are skipped
+    def add_normalized_results(self, jobs, results, trimming, settings_dict):
+        for (subject,args),result in zip(jobs,results):
+            if result != None and not isinstance(result,Exception):
+                self.add_normalized(subject,trimming,settings_dict,result[0],result[1])
+
+    def normalize_subjects(self, subject_paths, signal_name, control_name, trimming, settings_dict, workers=BATCH_WORKERS, progress=None):
+        '''Reads, trims, downsamples and normalizes subjects (dictionary subject:path) in parallel processes
+        and keeps the results, so that next normalize calls with the same settings only return them.
+        Subjects normalized before with the same settings are skipped.
+        progress(subject,subjects done,all subjects) is called after each subject.
+        '''
+        jobs = self.get_normalize_jobs(subject_paths,signal_name,control_name,trimming,settings_dict)
+        self.add_normalized_results(jobs,normalize_jobs(jobs,workers,progress),trimming,settings_dict)
+
+    # forget all results of a subject (i.e. when its raw data changed)
+    def clear_subject(self, subject):
+        for key in [key for key in self.data.keys() if key[0] == subject]:
+            self.total_bytes -= self.data.pop(key)[1]
+
+    def get_stats(self):
+        return {"hits":self.hits,
+                "misses":self.misses,
+                "evictions":self.evictions,
+                "results":len(self.data),
+                "bytes":self.total_bytes,
+                "max_bytes":self.max_bytes}
+
+    def clear(self):
+        self.data = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+# downsampled and normalized data of a subject read from path
+# (runs in batch worker processes: raw data is read there and only the results are sent back)
+def get_normalized_from_path(path,signal_name,control_name,trimming,settings_dict):
+    raw_data = get_converted_raw_data(path,[signal_name,control_name])
+    if raw_data == None:
+        return None
+    trimmed = fpExplorer_functions.trim_raw_data(raw_data,signal_name,control_name,trimming[0],trimming[1])
+    if len(trimmed["ts"]) == 0:
+        return None
+    downsampled = fpExplorer_functions.downsample(trimmed,settings_dict[0]["downsample"],settings_dict[0]["downsample_method"])
+    return downsampled,get_normalized(downsampled,None,settings_dict)
+
+# how many subjects to process at the same time
+def get_workers(workers,n_subjects):
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return max(1,min(workers,n_subjects))
+
+def normalize_jobs(jobs,workers=BATCH_WORKERS,progress=None):
+    '''Returns results of get_normalized_from_path for jobs from StageCache.get_normalize_jobs.
+    If there are not enough workers to normalize subjects in parallel, returns an empty list
+    and subjects are normalized one by one when they are needed.
+    '''
+    n_workers = get_workers(workers,len(jobs))
+    if n_workers < 2:
+        if len(jobs) > 0:
+            logger.info("Normalizing %d subject(s) sequentially when they are needed (%d worker(s) available)",len(jobs),n_workers)
+        return []
+    return run_for_subjects(get_normalized_from_path,jobs,workers,progress)
+
+# errors of one subject never stop the whole batch, the error is returned instead of the result
+def run_for_subject(function,subject,args):
+    try:
+        return function(*args)
+    except Exception as e:
+        return e
+
+# subject:error for subjects that failed in run_for_subjects
+def get_errors(jobs,results):
+    return {subject:result for (subject,args),result in zip(jobs,results) if isinstance(result,Exception)}
+
+def run_for_subjects(function,jobs,workers=BATCH_WORKERS,progress=None):
+    '''Returns results of function(*args) for each (subject,args) in jobs in the same order
+    (the exception for subjects that failed, see get_errors). With more than one worker subjects are processed
+    in parallel processes, so function and args have to be picklable.
+    progress(subject,subjects done,all subjects) is called after each subject in the calling thread.
+    '''
+    workers = get_workers(workers,len(jobs))
+    results = [None]*len(jobs)
+    if workers == 1:
+        for i,(subject,args) in enumerate(jobs):
+            results[i] = run_for_subject(function,subject,args)
+            if progress != None:
+                progress(subject,i+1,len(jobs))
+        return results
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_for_subject,function,subject,args):i for i,(subject,args) in enumerate(jobs)}
+        for done,future in enumerate(as_completed(futures)):
+            results[futures[future]] = future.result()
+            if progress != None:
+                progress(jobs[futures[future]][0],done+1,len(jobs))
+    return results
+
+# parameters of all stages that lead to normalized data
+def get_normalize_params(trimmed,settings_dict,trimmed_baseline=None):
+    baseline_trim = None
+    if trimmed_baseline != None:
+        baseline_trim = trimmed_baseline[0]
+    return (trimmed[0],baseline_trim,settings_dict[0]["downsample"],settings_dict[0]["downsample_method"],
+            settings_dict[0]["normalization"],settings_dict[0]["show_norm_as"],
+            settings_dict[0]["filter"],settings_dict[0]["filter_window"])
+
+# normalize downsampled data with the method from settings
+# (result has also the fitted lines, see fpExplorer_functions.normalize_trace)
+def get_normalized(downsampled,downsampled_baseline,settings_dict):
+    return fpExplorer_functions.normalize_trace(downsampled,downsampled_baseline,settings_dict[0]["normalization"],
+                                                settings_dict[0]["show_norm_as"],settings_dict[0]["filter"],
+                                                settings_dict[0]["filter_window"])
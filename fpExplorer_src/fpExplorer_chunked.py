@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""
+ Copyright (c) 2021 CSAN_LiU
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ """
+
+"""
+Chunked (streaming) processing of very long recordings.
+
+Raw signal and control streams are never read as a whole. They are read from
+the data tank in time blocks of CHUNK_SEC seconds and each block is downsampled
+right away, so only the downsampled data is kept in memory.
+The memory bound covers only reading of raw data: the whole downsampled trace
+and the normalized result are kept in memory (about 17 MB per hour of recording at 100 Hz)
+and exported at the end, the same as without chunks.
+Polyphase downsampling filters the whole trace, so it cannot be used in chunks.
+Normalization then runs in passes over blocks of the downsampled data:
+the first pass collects mean and standard deviation of both channels
+(for the 2 standard deviations filter), the second one sums needed for the linear fit
+and the last one writes the normalized output.
+
+Results are the same (up to floating point rounding) as from
+trim_raw_data -> downsample -> normalize_dff/normalize_pMat in fpExplorer_functions.
+"""
+
+import fpExplorer_functions
+import tdt
+import numpy as np
+import math
+
+# how many seconds of raw data are read at once
+CHUNK_SEC = 600
+# recordings longer than that (sec) are processed in chunks by default
+CHUNKED_MIN_DURATION = 4*3600
+# downsampling methods that work chunk by chunk (all but Polyphase)
+CHUNKED_DOWNSAMPLE_METHODS = [method for method in fpExplorer_functions.DOWNSAMPLE_METHODS if method != "Polyphase"]
+# how many downsampled samples are normalized at once
+NORMALIZE_CHUNK_SAMPLES = 1000000
+# extra samples (in smoothing windows) on each side of a block when smoothing it,
+# so that the block is smoothed exactly the same way as the whole trace
+SMOOTH_MARGIN_WINDOWS = 6
+# normalization methods that are fitted from sums collected in blocks,
+# other methods normalize the whole downsampled trace at once
+CHUNKED_NORMALIZATION_METHODS = ["Standard Polynomial Fitting","Modified Polynomial Fitting"]
+# number of histogram bins for approximate median and MAD of Z-Score
+# (error is at most the range of normalized data divided by that)
+ZSCORE_HISTOGRAM_BINS = 100000
+
+
+def get_stream_info(path,signal_name,control_name):
+    '''Returns a dictionary with sampling rate of the signal, number of samples
+    in both streams (the shorter one) and start time of the streams
+    Reads only a short piece from the beginning and from the end of the recording.
+    Returns None if streams could not be read
+    '''
+    tank_info = fpExplorer_functions.get_tank_info(path)
+    if tank_info == None:
+        return None
+    first = fpExplorer_functions.get_selected_raw_data(path,[signal_name,control_name],0,1)
+    if first == None:
+        return None
+    stream = first.streams[signal_name]
+    info = {"fs":float(stream.fs),
+            "start_time":float(stream.start_time),
+            "duration":tank_info["duration"]}
+    # read the last chunk to find out how many samples there are
+    t1 = max(0,math.floor(tank_info["duration"])-CHUNK_SEC)
+    last = fpExplorer_functions.get_selected_raw_data(path,[signal_name,control_name],t1,0)
+    if last == None:
+        return None
+    info["n_samples"] = min([get_first_sample(last.streams[name],info)+len(last.streams[name].data)
+                             for name in [signal_name,control_name]])
+    return info
+
+# index of the first sample of stream (read from t1) in the whole recording
+def get_first_sample(stream,info):
+    return int(round((stream.start_time-info["start_time"])*info["fs"]))
+
+def read_chunks(path,signal_name,control_name,info,chunk_sec=CHUNK_SEC):
+    '''Generator of (first sample index, signal data, control data)
+    with consecutive chunk_sec long pieces of the recording
+    '''
+    t = 0
+    while t < info["duration"]:
+        raw_data = fpExplorer_functions.get_selected_raw_data(path,[signal_name,control_name],t,t+chunk_sec)
+        if raw_data == None:
+            raise IOError("Problem reading "+path+" from "+str(t)+" sec")
+        first = get_first_sample(raw_data.streams[signal_name],info)
+        n = min(len(raw_data.streams[signal_name].data),len(raw_data.streams[control_name].data))
+        yield first,raw_data.streams[signal_name].data[:n],raw_data.streams[control_name].data[:n]
+        t += chunk_sec
+
+def get_epocs_data(path):
+    '''Returns data structure with only epocs (no streams) that can be used
+    to get events (i.e. by get_event_on_off). None if it could not be read
+    '''
+    # events are indexed again from the new data
+    fpExplorer_functions.clear_event_index(path)
+    try:
+        return tdt.read_block(path,evtype=['epocs'])
+    except:
+        return None
+
+def get_whole_seconds_length(n_samples,fs):
+    '''Number of samples left by get_single_channel (recording cut at the last whole second)
+    Timestamps of samples are i/fs for i from 1 to n_samples
+    '''
+    full_total_sec = int(n_samples/fs)
+    n = int(full_total_sec*fs)
+    while n < n_samples and (n+1)/fs < full_total_sec:
+        n += 1
+    while n > 0 and n/fs >= full_total_sec:
+        n -= 1
+    return n
+
+# the same as get_last_timestamp from fpExplorer_functions, without reading streams
+def get_last_timestamp(info):
+    return get_whole_seconds_length(info["n_samples"],info["fs"])/info["fs"]
+
+def get_trimmed_range(info,beginning_sec,ending_sec):
+    '''Returns indexes of the first and after the last sample of the trimmed recording
+    (the same samples that trim_raw_data keeps)
+    '''
+    n = get_whole_seconds_length(info["n_samples"],info["fs"])
+    t0 = int(beginning_sec*info["fs"])
+    t1 = int(ending_sec*info["fs"])
+    return t0,n-t1
+
+def downsample_chunks(chunks,info,beginning_sec,ending_sec,target_Hz,method=fpExplorer_functions.DOWNSAMPLE_METHODS[0]):
+    '''Trims and downsamples chunks from read_chunks
+    Returns the same dictionary as downsample(trim_raw_data(...)): ts, signal, control
+    Only raw chunks are released, the whole downsampled trace is kept in memory.
+    Polyphase filtering needs the whole trace, so it raises ValueError.
+    '''
+    if method not in CHUNKED_DOWNSAMPLE_METHODS:
+        raise ValueError(method+" downsampling is not available for chunked processing. Use one of: "
+                         +", ".join(CHUNKED_DOWNSAMPLE_METHODS))
+    fs = info["fs"]
+    first,end = get_trimmed_range(info,beginning_sec,ending_sec)
+    if end-first < 2:
+        return {"ts":np.zeros(0),"signal":np.zeros(0),"control":np.zeros(0)}
+    # the same new times as in downsample
+    start = 0
+    if (first+1)/fs > 1: # if data was trimmed go back from zero
+        start = (first+1)/fs
+    last = math.floor(end/fs-start)
+    ts_adjusted = np.linspace(1/target_Hz,last,last*target_Hz)
+    if method in ["Block Mean","Block Median"]:
+        # blocks are small enough to be interpolated all at once
+        reduced = downsample_chunks_blocks(chunks,fs,first,end,target_Hz,method)
+        resampled = fpExplorer_functions.resample_linear(np.vstack((reduced["signal"],reduced["control"])),
+                                                         reduced["ts"]-start,ts_adjusted)
+        return {"ts":ts_adjusted+start,"signal":resampled[0],"control":resampled[1]}
+    resampled = np.zeros((2,len(ts_adjusted)))
+    # samples from previous chunk needed to interpolate between chunks
+    carry_ts = np.zeros(0)
+    carry = np.zeros((2,0))
+    done = 0
+    for chunk_first,signal,control in chunks:
+        n = len(signal)
+        # keep only samples within trimmed recording
+        lo = max(first-chunk_first,0)
+        hi = min(end-chunk_first,n)
+        if hi <= lo:
+            if chunk_first >= end:
+                break
+            continue
+        ts = np.arange(chunk_first+lo+1,chunk_first+hi+1)/fs-start
+        ts = np.concatenate((carry_ts,ts))
+        data = np.concatenate((carry,np.vstack((signal[lo:hi],control[lo:hi]))),axis=1)
+        # all new times up to the last sample of this chunk
+        # (or all remaining at the end of the recording)
+        if chunk_first+hi >= end:
+            stop = len(ts_adjusted)
+        else:
+            stop = np.searchsorted(ts_adjusted,ts[-1],side='right')
+        if stop > done:
+            resampled[:,done:stop] = fpExplorer_functions.resample_linear(data,ts,ts_adjusted[done:stop])
+            done = stop
+        # keep the sample before the next new time
+        keep = max(np.searchsorted(ts,ts_adjusted[min(done,len(ts_adjusted)-1)])-1,0)
+        carry_ts = ts[keep:]
+        carry = data[:,keep:]
+        if done == len(ts_adjusted):
+            break
+    return {"ts":ts_adjusted+start,"signal":resampled[0],"control":resampled[1]}
+
+def downsample_chunks_blocks(chunks,fs,first,end,target_Hz,method):
+    # the same as downsample_tdt, block by block
+    downsample_n = fpExplorer_functions.get_block_length(fs,target_Hz)
+    n_blocks = (end-first)//downsample_n
+    reduced = []
+    # samples left from previous chunk that did not make a full block
+    carry = np.zeros((2,0),dtype=np.float32)
+    for chunk_first,signal,control in chunks:
+        lo = max(first-chunk_first,0)
+        hi = min(end-chunk_first,len(signal))
+        if hi <= lo:
+            if chunk_first >= end:
+                break
+            continue
+        data = np.vstack((signal[lo:hi],control[lo:hi]))
+        if carry.shape[1] > 0:
+            data = np.concatenate((carry,data),axis=1)
+        n_full = data.shape[1]//downsample_n
+        blocks = data[:,:n_full*downsample_n].reshape(2,n_full,downsample_n)
+        if method == "Block Median":
+            reduced.append(np.median(blocks,axis=2))
+        else:
+            reduced.append(np.mean(blocks,axis=2,dtype=np.float64))
+        carry = data[:,n_full*downsample_n:]
+        if chunk_first+hi >= end:
+            break
+    reduced = np.concatenate(reduced,axis=1)[:,:n_blocks] if len(reduced) > 0 else np.zeros((2,0))
+    # timestamp of the middle of each block
+    ts = (first+1+np.arange(reduced.shape[1])*downsample_n+(downsample_n-1)/2)/fs
+    return {"ts":ts,"signal":reduced[0],"control":reduced[1]}
+
+def get_smoothed_block(data,lo,hi,smooth,smooth_window):
+    '''Returns data[lo:hi] as float64 (smoothed the same way as the whole trace if smooth is True)'''
+    if smooth == False:
+        return np.asarray(data[lo:hi],dtype=np.float64)
+    margin = SMOOTH_MARGIN_WINDOWS*smooth_window
+    smoothed = fpExplorer_functions.smooth_data(data[max(lo-margin,0):hi+margin],smooth_window)
+    return smoothed[lo-max(lo-margin,0):][:hi-lo]
+
+def get_blocks(n,block_samples=NORMALIZE_CHUNK_SAMPLES):
+    return [(lo,min(lo+block_samples,n)) for lo in range(0,n,block_samples)]
+
+def get_histogram_median(data,blocks,lower,upper,center=None,bins=ZSCORE_HISTOGRAM_BINS):
+    '''Approximate median of data (or of absolute deviations from center if it is not None)
+    from a histogram of values between lower and upper collected block by block
+    (linear interpolation inside the bin with the middle value)
+    '''
+    if upper <= lower:
+        return lower
+    counts = np.zeros(bins,dtype=np.int64)
+    for lo,hi in blocks:
+        values = data[lo:hi] if center is None else np.abs(data[lo:hi]-center)
+        counts += np.histogram(values,bins=bins,range=(lower,upper))[0]
+    half = np.sum(counts)/2
+    cumulative = np.cumsum(counts)
+    i = np.searchsorted(cumulative,half)
+    below = cumulative[i]-counts[i]
+    return lower+(upper-lower)/bins*(i+(half-below)/counts[i])
+
+def get_approximate_median_mad(data,blocks,bins=ZSCORE_HISTOGRAM_BINS):
+    '''Approximate median and median absolute deviation of data streamed block by block
+    without copying or partitioning the whole array
+    '''
+    lower = min(np.min(data[lo:hi]) for lo,hi in blocks)
+    upper = max(np.max(data[lo:hi]) for lo,hi in blocks)
+    median = get_histogram_median(data,blocks,lower,upper,bins=bins)
+    mad = get_histogram_median(data,blocks,0,max(upper-median,median-lower),median,bins)
+    return median,mad
+
+def normalize_chunked(downsampled,settings_dict,block_samples=NORMALIZE_CHUNK_SAMPLES,approximate_zscore=False):
+    '''Normalizes downsampled data block by block with the method from settings
+    Returns the same dictionary as normalize_dff (Modified Polynomial Fitting)
+    or normalize_pMat (Standard Polynomial Fitting): ts, normalized_signal, fit
+    With approximate_zscore Z-Score median and MAD are estimated from histograms
+    '''
+    normalization = settings_dict[0]["normalization"]
+    if normalization not in CHUNKED_NORMALIZATION_METHODS:
+        print(normalization+" normalizes the whole downsampled trace at once")
+        return fpExplorer_functions.normalize_trace(downsampled,None,normalization,settings_dict[0]["show_norm_as"],
+                                                    settings_dict[0]["filter"],settings_dict[0]["filter_window"])
+    ts = np.asarray(downsampled["ts"])
+    signal = downsampled["signal"]
+    control = downsampled["control"]
+    smooth = settings_dict[0]["filter"]
+    smooth_window = settings_dict[0]["filter_window"]
+    standard = normalization == "Standard Polynomial Fitting"
+    blocks = get_blocks(len(ts),block_samples)
+    if smooth == True:
+        print("Smoothing in blocks",smooth_window)
+    # first pass: mean and standard deviation of both channels
+    signal_moments = (0,0.0,0.0)
+    control_moments = (0,0.0,0.0)
+    for lo,hi in blocks:
+        signal_moments = fpExplorer_functions.add_moments(signal_moments,get_smoothed_block(signal,lo,hi,smooth,smooth_window))
+        control_moments = fpExplorer_functions.add_moments(control_moments,get_smoothed_block(control,lo,hi,smooth,smooth_window))
+    mean_signal = signal_moments[1]
+    stdev_signal = math.sqrt(signal_moments[2]/signal_moments[0])
+    mean_control = control_moments[1]
+    stdev_control = math.sqrt(control_moments[2]/control_moments[0])
+    mean_ts = np.mean(ts)
+    # second pass: sums for linear fits of values within 2 standard deviations from the mean
+    # (time axis is fitted to each channel also for Standard Polynomial Fitting to show it in the fitting plot)
+    signal_sums = np.zeros(5)
+    control_sums = np.zeros(5)
+    control_to_signal_sums = np.zeros(5)
+    for lo,hi in blocks:
+        signal_arr = get_smoothed_block(signal,lo,hi,smooth,smooth_window)
+        control_arr = get_smoothed_block(control,lo,hi,smooth,smooth_window)
+        signal_mask = (signal_arr<mean_signal+2*stdev_signal) & (signal_arr>mean_signal-2*stdev_signal)
+        control_mask = (control_arr<mean_control+2*stdev_control) & (control_arr>mean_control-2*stdev_control)
+        signal_sums = fpExplorer_functions.add_fit_sums(signal_sums,ts[lo:hi],signal_arr,signal_mask,mean_ts,mean_signal)
+        control_sums = fpExplorer_functions.add_fit_sums(control_sums,ts[lo:hi],control_arr,control_mask,mean_ts,mean_control)
+        if standard == True:
+            # fit control to signal
+            control_to_signal_sums = fpExplorer_functions.add_fit_sums(control_to_signal_sums,control_arr,signal_arr,signal_mask,
+                                                                       mean_control,mean_signal)
+    # the same lines as from fpExplorer_functions.get_normalization_fit
+    fit = {"signal":fpExplorer_functions.fit_line_from_sums(signal_sums,mean_ts,mean_signal),
+           "control":fpExplorer_functions.fit_line_from_sums(control_sums,mean_ts,mean_control),
+           "normalization":normalization}
+    if standard == True:
+        fit["control_to_signal"] = fpExplorer_functions.fit_line_from_sums(control_to_signal_sums,mean_control,mean_signal)
+    # last pass: normalized output and mean of its negative values
+    dff = np.zeros(len(ts))
+    negative_sum = 0.0
+    negative_count = 0
+    for lo,hi in blocks:
+        signal_arr = get_smoothed_block(signal,lo,hi,smooth,smooth_window)
+        control_arr = get_smoothed_block(control,lo,hi,smooth,smooth_window)
+        F0_signal,F0_control = fpExplorer_functions.get_F0(fit,ts[lo:hi],signal_arr,control_arr,normalization)
+        dff[lo:hi] = fpExplorer_functions.get_dff(signal_arr,control_arr,F0_signal,F0_control)
+        negative = dff[lo:hi][dff[lo:hi]<0]
+        negative_sum += np.sum(negative)
+        negative_count += len(negative)
+    # shift the curve up to make 0 the mean value for DF/F
+    dff -= negative_sum/negative_count
+    if settings_dict[0]["show_norm_as"] == "Z-Score":
+        if approximate_zscore == True:
+            median_all,mad = get_approximate_median_mad(dff,blocks)
+        else:
+            median_all,mad = fpExplorer_functions.get_median_mad(dff)
+        dff -= median_all
+        dff /= mad
+    return {"ts":ts,"normalized_signal":dff,"fit":fit}
+
+def process_tank_chunked(path,signal_name,control_name,beginning_sec,ending_sec,settings_dict,chunk_sec=CHUNK_SEC,info=None,
+                         approximate_zscore=False):
+    '''Reads, trims, downsamples and normalizes streams of a data tank chunk by chunk
+    Returns downsampled and normalized dictionaries or (None,None) if data could not be read
+    '''
+    if info == None:
+        info = get_stream_info(path,signal_name,control_name)
+    if info == None:
+        print("Problem reading streams from",path)
+        return None,None
+    try:
+        downsampled = downsample_chunks(read_chunks(path,signal_name,control_name,info,chunk_sec),info,
+                                        beginning_sec,ending_sec,settings_dict[0]["downsample"],settings_dict[0]["downsample_method"])
+    except IOError as e:
+        print(e)
+        return None,None
+    if len(downsampled["ts"]) == 0:
+        return downsampled,None
+    return downsampled,normalize_chunked(downsampled,settings_dict,approximate_zscore=approximate_zscore)
+
+def filter_downsampled_around_event(epocs_data,downsampled,normalized,perievent_options_dict,settings_dict,signal_name,control_name,info):
+    '''Returns data structure like filter_data_around_event from fpExplorer_functions
+    with trials cut out of the whole trace downsampled data instead of raw data
+    (filtered and filtered_downsampled are the same) and data["normalized"] with
+    the same trials cut out of the whole trace normalized data.
+    Windows start at the same raw samples as in filter_data_around_event,
+    so trials have the same numbers. Trials of events without the whole window
+    inside the (trimmed) trace are not available: all their values are nan.
+    '''
+    N = settings_dict[0]["downsample"]
+    n_samples = (perievent_options_dict["sec_before"]+perievent_options_dict["sec_after"])*N
+    data = fpExplorer_functions.filter_epocs_around_event(epocs_data,perievent_options_dict)
+    stream = tdt.StructType()
+    stream.fs = info["fs"]
+    stream.start_time = info["start_time"]
+    onsets,lengths = fpExplorer_functions.get_stream_windows(stream,data.time_ranges,info["n_samples"])
+    # windows that do not fit in the recording are the last ones (onsets are sorted)
+    data.time_ranges = data.time_ranges[:,:len(onsets)]
+    # first downsampled sample of each trial is 1/N after the first raw sample of the window
+    first_times = (onsets+1)/info["fs"]+1/N
+    ts = np.asarray(downsampled["ts"])
+    inside = (first_times >= ts[0]) & (first_times+(n_samples-1)/N <= ts[-1])
+    if np.count_nonzero(~inside) > 0:
+        print(f"{np.count_nonzero(~inside)} events too close to the trimmed part of the recording are not available")
+    data.streams = tdt.StructType()
+    for name,key in [(signal_name,"signal"),(control_name,"control")]:
+        data.streams[name] = tdt.StructType()
+        data.streams[name].fs = N
+        windows = get_windows_inside({"ts":ts,"normalized_signal":downsampled[key]},first_times,inside,n_samples,N)
+        data.streams[name].filtered = windows
+        data.streams[name].filtered_downsampled = windows
+    data["normalized"] = get_windows_inside(normalized,first_times,inside,n_samples,N)
+    return data
+
+# windows cut from the whole trace for all trials (nan for trials that are not inside)
+# or empty array if none is inside
+def get_windows_inside(normalized_dict,first_times,inside,n_samples,N):
+    windows = fpExplorer_functions.get_normalized_around_event(normalized_dict,first_times[inside],n_samples,N)
+    if len(windows) == 0:
+        return windows
+    all_windows = np.full((len(first_times),n_samples),np.nan)
+    all_windows[inside] = windows
+    return all_windows
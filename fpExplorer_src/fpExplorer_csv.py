@@ -36,7 +36,7 @@ from pyqtgraph.dockarea import *
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
 from matplotlib.ticker import MaxNLocator
-from scipy.signal import find_peaks, filtfilt
+from scipy.signal import find_peaks
 import pandas as pd
 import numpy as np
 from numpy.polynomial import Polynomial
@@ -47,6 +47,7 @@ import math
 import os
 import warnings
 import fpExplorer_functions
+import fpExplorer_cache
 import fpExplorer
 warnings.filterwarnings("ignore")
 
@@ -290,18 +291,22 @@ class PreviewEventBasedWidget(QWidget):
         # remember subject(key):group name(value) for later in a form dictionary
         self.group_names_dict = {self.options["subject"]:self.options["subject_group_name"]}
         
-        # a dictionary with subject:extracted raw data
-        self.raw_data_dict = {}
-        self.events_dict = {}
-        # start a widget by reading the subjects data on the list and adding that to dict
-        for key,val in self.preview_init_params[0]["subject_paths"].items():
-            self.raw_data_dict[key] = self.read_data_csv(val[0])
-            if len(val[1])>0:
-                self.events_dict[key] = self.read_data_csv(val[1])
+        # downsampled and normalized data for all settings used so far
+        # key is (subject,stage,parameters), so changing plots does not repeat calculations
+        self.stage_cache = fpExplorer_cache.StageCache()
+        # subjects whose samples are not in time order (user was already informed)
+        self.unordered_time_subjects = set()
+        # dictionary-like caches with subject:data read from csv files
+        # each subject is read when it is needed (the next one in background),
+        # least recently used subjects are released from memory and read again when needed
+        self.raw_data_dict = fpExplorer_cache.CsvDataCache(self.read_recording_csv)
+        self.events_dict = fpExplorer_cache.CsvDataCache(self.read_events_csv)
+        self.add_subject_paths(self.preview_init_params[0]["subject_paths"])
         # get last timestamp in seconds
         self.last_raw_ts = self.raw_data_dict[self.options["subject"]].iloc[:,0].iloc[-1]
         # read first subject's frequency and create suggested downsampled rate
         self.current_fs = self.get_frequency(self.options["subject"])
+        self.prefetch_next_subjects(self.options["subject"],self.get_subject_names())
         # # self.suggested_downsample_samples = int(int(self.current_fs)*DEFAULT_DOWNSAMPLE_PCT/100)
         self.suggested_downsample_samples = DEFAULT_HZ
         self.settings_dict[0]['downsample'] = self.suggested_downsample_samples
@@ -611,7 +616,6 @@ class PreviewEventBasedWidget(QWidget):
 
     @pyqtSlot(list) # when new subject is added
     def update_preview(self,new_init_params):
-        print("Time to update")
         self.preview_init_params = new_init_params
         subj = ""
         if "subject_names" in self.preview_init_params[0]:
@@ -630,15 +634,13 @@ class PreviewEventBasedWidget(QWidget):
                         "plot_normalized":False}
         # remember subject(key):group name(value) for later in a form dictionary
         self.group_names_dict[self.options["subject"]] = self.options["subject_group_name"]
-        # start a widget by reading the subjects data on the list and adding that to dict
-        for key,val in self.preview_init_params[0]["subject_paths"].items():
-            self.raw_data_dict[key] = self.read_data_csv(val[0])
-            if len(val[1])>0:
-                self.events_dict[key] = self.read_data_csv(val[1])
+        # subjects data is read when it is needed
+        self.add_subject_paths(self.preview_init_params[0]["subject_paths"])
         # get last timestamp in seconds
         self.last_raw_ts = self.raw_data_dict[self.options["subject"]].iloc[:,0].iloc[-1]
         # read first subject's frequency and create suggested downsampled rate
         self.current_fs = self.get_frequency(self.options["subject"])
+        self.prefetch_next_subjects(self.options["subject"],self.get_subject_names())
         # create a list of available events for current subject
         self.events_from_current_subject = []
         if self.options["subject"] in self.events_dict:
@@ -857,29 +859,15 @@ class PreviewEventBasedWidget(QWidget):
             # if downsample was selected
             if self.downsample_cb.isChecked() or self.downsampled_export == True or self.save_plots == True or self.separate_signal_contol_cb.isChecked():
                 # add to downdampled dict
-                self.downsampled_dict[self.options["subject"]] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[self.options["subject"]][1],
-                                            self.settings_dict[0]["downsample"])
+                self.downsampled_dict[self.options["subject"]] = self.stage_cache.downsample(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
             # if normalize was selected
             if self.normalize_cb.isChecked() or self.normalized_export == True:
                 # always downsample first before normalizing
                 # downsample
-                self.downsampled_dict[self.options["subject"]] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[self.options["subject"]][1],
-                                                                                        self.settings_dict[0]["downsample"])
-                # check settings for method to normalize
-                if self.settings_dict[0]["normalization"] == "Modified Polynomial Fitting":                   
-                    # normalize from downsampled
-                    self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_dff(
-                                                                                        self.downsampled_dict[self.options["subject"]],
-                                                                                        self.settings_dict[0]["show_norm_as"],
-                                                                                        self.settings_dict[0]["filter"],
-                                                                                        self.settings_dict[0]["filter_window"])
-                if self.settings_dict[0]["normalization"] == "Standard Polynomial Fitting":                
-                    # normalize from downsampled
-                    self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_pMat(
-                                                                                        self.downsampled_dict[self.options["subject"]],
-                                                                                        self.settings_dict[0]["show_norm_as"],
-                                                                                        self.settings_dict[0]["filter"],
-                                                                                        self.settings_dict[0]["filter_window"])
+                self.downsampled_dict[self.options["subject"]] = self.stage_cache.downsample(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
+                # normalize from downsampled with the method from settings
+                # (reused if it was already normalized with the same settings)
+                self.normalized_dict[self.options["subject"]] = self.stage_cache.normalize(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
             # check what to show on the plot
             self.options["plot_separate"] = True if self.separate_signal_contol_cb.isChecked() else False 
             self.options["plot_downsampled"] = True if self.downsampled_plot_cb.isChecked() else False
@@ -1168,12 +1156,9 @@ class PreviewEventBasedWidget(QWidget):
         previous_events = self.events_from_current_subject
         # check if there was an event csv file and read it
         if self.options["subject"] in self.preview_init_params[0]["subject_paths"]:
-            paths = self.preview_init_params[0]["subject_paths"][self.options["subject"]]
-            print(f"Paths: {paths}")
             path2event_csv = self.preview_init_params[0]["subject_paths"][self.options["subject"]][1]
-            print(f"Event csv: {path2event_csv}")
             if len(path2event_csv)>0:
-                self.events_dict[self.options["subject"]] = self.read_data_csv(path2event_csv)
+                self.events_dict[self.options["subject"]] = self.read_events_csv(path2event_csv)
         self.events_from_current_subject = []
         if self.options["subject"] in self.events_dict:
             self.events_from_current_subject = self.get_events(self.events_dict[self.options["subject"]])
@@ -1285,8 +1270,8 @@ class PreviewEventBasedWidget(QWidget):
             # update last timestamp
             # get last timestamp in seconds
             # get last timestamp in seconds
-            print("Subject",self.subject_comboBox.currentText())
             self.last_raw_ts = self.raw_data_dict[self.options["subject"]].iloc[:,0].iloc[-1]
+            self.prefetch_next_subjects(self.options["subject"],self.get_subject_names())
             # read new subject's frequency and update suggested downsampled rate (only if it is different)
             new_fs = self.get_frequency(self.subject_comboBox.currentText())
             if new_fs != self.current_fs:
@@ -1361,7 +1346,8 @@ class PreviewEventBasedWidget(QWidget):
                                                 self.downsampled_dict[self.options["subject"]],
                                                 self.options["subject"],
                                                 False,
-                                                "")
+                                                "",
+                                                self.stage_cache.get_cached_normalized(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict))
                 # show the equation of fitted lines
                 signal_slope_intercept = slope_intercept_dict["signal_slope_intercept"]
                 control_slope_intercept = slope_intercept_dict["control_slope_intercept"]
@@ -1528,6 +1514,7 @@ class PreviewEventBasedWidget(QWidget):
                     if self.parent_window.batch_export_settings_dict["export_for_single_subjects"] == True:
                         for i in range(len(self.parent_window.batch_export_settings_dict["batch_subjects"])):
                             subject = self.parent_window.batch_export_settings_dict["batch_subjects"][i]
+                            self.prefetch_next_subjects(subject,self.parent_window.batch_export_settings_dict["batch_subjects"])
                             # add the group name to group names dictionary if it was not there or update group names from batch options
                             self.group_names_dict[subject] = self.parent_window.batch_export_settings_dict["batch_subjects_group_names"][i]
                             # if subject not in self.raw_data_dict: # if data has not beed read yet
@@ -1550,10 +1537,14 @@ class PreviewEventBasedWidget(QWidget):
                                                                                                                       )]
                             
                             # filter around trimmed
+                            self.check_time_order(subject)
                             data_dict = self.filter_data_around_event(self.raw_data_dict[subject],
                                                     self.events_dict[subject],
                                                     self.perievent_options_dict,
                                                     self.settings_dict)
+                            # use windows of the whole trace normalized data instead of normalizing each trial
+                            if self.perievent_options_dict["use_normalized_trace"] == True:
+                                self.add_normalized_around_event(subject,data_dict)
                             # # if run on batch was selected, select all trials by default
                             # self.current_trials = [i+1 for i in range(len(data.streams[self.preview_init_params[0][0]["signal_name"]].filtered))]
                             # if run on batch was selected, get selected trials
@@ -1738,10 +1729,14 @@ class PreviewEventBasedWidget(QWidget):
                                                                                                                       0
                                                                                                                       )]
                                     # filter around trimmed
+                                    self.check_time_order(self.options["subject"])
                                     data_dict = self.filter_data_around_event(self.raw_data_dict[self.options["subject"]],
                                                     self.events_dict[self.options["subject"]],
                                                     self.perievent_options_dict,
                                                     self.settings_dict)
+                                    # use windows of the whole trace normalized data instead of normalizing each trial
+                                    if self.perievent_options_dict["use_normalized_trace"] == True:
+                                        self.add_normalized_around_event(self.options["subject"],data_dict)
                             
                                     # if run on batch was selected, get selected trials
                                     self.current_trials = self.perievent_options_dict["trials"]
@@ -1917,10 +1912,14 @@ class PreviewEventBasedWidget(QWidget):
                                                                                                                       0
                                                                                                                       )]
             # filter around event
+            self.check_time_order(self.options["subject"])
             data_dict = self.filter_data_around_event(self.raw_data_dict[self.options["subject"]],
                                                     self.events_dict[self.options["subject"]],
                                                     self.perievent_options_dict,
                                                     self.settings_dict)
+            # use windows of the whole trace normalized data instead of normalizing each trial
+            if self.perievent_options_dict["use_normalized_trace"] == True:
+                self.add_normalized_around_event(self.options["subject"],data_dict)
 
             # update export path settings
             if len(self.perievent_options_dict["export_path"]) > 0 and os.path.split(self.perievent_options_dict["export_path"])[1]==DEFAULT_EXPORT_FOLDER:
@@ -2434,7 +2433,8 @@ class PreviewEventBasedWidget(QWidget):
                                                 self.downsampled_dict[self.options["subject"]],
                                                 self.options["subject"],
                                                 self.save_plots,
-                                                self.export_path)
+                                                self.export_path,
+                                                self.stage_cache.get_cached_normalized(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict))
             # raw was checked
             if self.raw_export == True:
                 if self.options["event"] == "---":
@@ -2681,23 +2681,10 @@ class PreviewEventBasedWidget(QWidget):
                                                                                                                       )]
             # always downsample first before normalizing
             # downsample
-            self.downsampled_dict[self.options["subject"]] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[self.options["subject"]][1],
-                                                                                         self.settings_dict[0]["downsample"])
-            # check settings for method to normalize
-            if self.settings_dict[0]["normalization"] == "Modified Polynomial Fitting":                   
-                # normalize from downsampled
-                self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_dff(
-                                                                                        self.downsampled_dict[self.options["subject"]],
-                                                                                        self.settings_dict[0]["show_norm_as"],
-                                                                                        self.settings_dict[0]["filter"],
-                                                                                        self.settings_dict[0]["filter_window"])
-            if self.settings_dict[0]["normalization"] == "Standard Polynomial Fitting":                
-                # normalize from downsampled
-                self.normalized_dict[self.options["subject"]] = fpExplorer_functions.normalize_pMat(
-                                                                                        self.downsampled_dict[self.options["subject"]],
-                                                                                        self.settings_dict[0]["show_norm_as"],
-                                                                                        self.settings_dict[0]["filter"],
-                                                                                        self.settings_dict[0]["filter_window"])
+            self.downsampled_dict[self.options["subject"]] = self.stage_cache.downsample(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
+            # normalize from downsampled with the method from settings
+            # (reused if it was already normalized with the same settings)
+            self.normalized_dict[self.options["subject"]] = self.stage_cache.normalize(self.options["subject"],self.trimmed_raw_data_dict[self.options["subject"]],self.settings_dict)
             # set event
             self.options["event"] = self.event_from_data_comboBox.currentText()
             self.options["event_name"] = self.event_name_text.text()
@@ -2847,6 +2834,7 @@ class PreviewEventBasedWidget(QWidget):
             # create normalized data for most recent settings
             for i in range(len(self.parent_window.batch_export_settings_dict["batch_subjects"])):
                 subject = self.parent_window.batch_export_settings_dict["batch_subjects"][i]
+                self.prefetch_next_subjects(subject,self.parent_window.batch_export_settings_dict["batch_subjects"])
                 # create separate options dictionary for batch analysis
                 self.batch_options_dict = {"subject":subject,
                                             "subject_group_name":self.parent_window.batch_export_settings_dict["batch_subjects_group_names"][i]}
@@ -2877,23 +2865,10 @@ class PreviewEventBasedWidget(QWidget):
                     
                 # always downsample first before normalizing
                 # downsample
-                self.downsampled_dict[subject] = fpExplorer_functions.downsample(self.trimmed_raw_data_dict[subject][1],
-                                                                                self.settings_dict[0]["downsample"])
-                # check settings for method to normalize
-                if self.settings_dict[0]["normalization"] == "Modified Polynomial Fitting":                   
-                    # normalize from downsampled
-                    self.normalized_dict[subject] = fpExplorer_functions.normalize_dff(
-                                                                                                self.downsampled_dict[subject],
-                                                                                                self.settings_dict[0]["show_norm_as"],
-                                                                                                self.settings_dict[0]["filter"],
-                                                                                                self.settings_dict[0]["filter_window"])
-                if self.settings_dict[0]["normalization"] == "Standard Polynomial Fitting":                
-                    # normalize from downsampled
-                    self.normalized_dict[subject] = fpExplorer_functions.normalize_pMat(
-                                                                                                self.downsampled_dict[subject],
-                                                                                                self.settings_dict[0]["show_norm_as"],
-                                                                                                self.settings_dict[0]["filter"],
-                                                                                                self.settings_dict[0]["filter_window"])
+                self.downsampled_dict[subject] = self.stage_cache.downsample(subject,self.trimmed_raw_data_dict[subject],self.settings_dict)
+                # normalize from downsampled with the method from settings
+                # (reused if it was already normalized with the same settings)
+                self.normalized_dict[subject] = self.stage_cache.normalize(subject,self.trimmed_raw_data_dict[subject],self.settings_dict)
                 if self.parent_window.batch_export_settings_dict["export_for_single_subjects"] == True:
                     # create subfolder with subject name
                     subject_subfolder = os.path.join(self.parent_window.batch_export_settings_dict["dump_path"],subject)
@@ -2910,7 +2885,8 @@ class PreviewEventBasedWidget(QWidget):
                                                 self.downsampled_dict[subject],
                                                 subject,
                                                 True,
-                                                subject_subfolder)
+                                                subject_subfolder,
+                                                self.stage_cache.get_cached_normalized(subject,self.trimmed_raw_data_dict[subject],self.settings_dict))
                     if self.parent_window.batch_export_settings_dict["normalized"] == True:
                         if self.options["event"] == "---":
                             fpExplorer_functions.plot_normalized_alone(self.canvas,
@@ -2966,70 +2942,139 @@ class PreviewEventBasedWidget(QWidget):
         fs = 1/interval_float
         return fs
 
-    def read_data_csv(self,path_to_data):
-        df = pd.read_csv(path_to_data)
-        return df
+    # subject:(data path,event path) of subjects to read later
+    def add_subject_paths(self,subject_paths):
+        for subject,paths in subject_paths.items():
+            # results calculated from data of the previous file are no longer valid
+            if subject in self.raw_data_dict.paths and self.raw_data_dict.paths[subject] != paths[0]:
+                self.stage_cache.clear_subject(subject)
+                self.unordered_time_subjects.discard(subject)
+        self.raw_data_dict.set_paths({key:val[0] for key,val in subject_paths.items()})
+        self.events_dict.set_paths({key:val[1] for key,val in subject_paths.items() if len(val[1])>0})
 
-    def get_events(self,df):
-        all_events = df.iloc[:,0].unique()
-        events = []
-        for evt in all_events:
-            # # exclude cam or tickfrom events
-            # if evt.lower().startswith("cam") == False and evt.lower().startswith("tick") == False:
-            events.append(str(evt))
-        return events
+    def get_subject_names(self):
+        if "subject_names" in self.preview_init_params[0]:
+            return self.preview_init_params[0]["subject_names"]
+        return [self.preview_init_params[0]["subject_name"]]
+
+    # start reading subjects that come after subject (in order of subjects list) in background
+    def prefetch_next_subjects(self,subject,subjects):
+        if subject not in subjects:
+            return
+        i = subjects.index(subject)
+        next_subjects = [subjects[(i+k)%len(subjects)] for k in range(1,fpExplorer_cache.CSV_PREFETCH_SUBJECTS+1)]
+        next_subjects = [el for el in next_subjects if el != subject]
+        self.raw_data_dict.prefetch(next_subjects)
+        self.events_dict.prefetch(next_subjects)
+
+    def read_recording_csv(self,path_to_data):
+        # only time, signal and control columns as numbers
+        return fpExplorer_cache.read_recording_csv(path_to_data)
+
+    def read_events_csv(self,path_to_data):
+        # after the first time csv is read from faster binary copy
+        # and parsed to event name:(onsets,offsets)
+        return fpExplorer_cache.read_events_csv(path_to_data)
+
+    def get_events(self,event_index):
+        # # exclude cam or tickfrom events
+        # if evt.lower().startswith("cam") == False and evt.lower().startswith("tick") == False:
+        return list(event_index.keys())
 
-    def get_event_on_off(self,event_dataframe, event):
+    def get_event_on_off(self,event_index, event):
         ''' Returns onset and offset times of the tones
             First element of this array are onset times, 
             Second el are offset times
         '''
         on_off = [[],[]]
-        # first column should be Event name, second event onset, last event offset
-        column_names = list(event_dataframe.columns)
-        # select only rows with given event name
-        # first make sure the events from dataframe are all strings
-        event_dataframe.loc[:,column_names[0]] = event_dataframe.loc[:, column_names[0]].astype(str)
-        selected_event_df = event_dataframe.loc[event_dataframe[column_names[0]] == event]
-        onsets = selected_event_df[column_names[1]].tolist()
-        # validate (could be i.e inf)
-        valid_onsets = []
-        for el in onsets:
-            try:
-                val = float(el)
-                valid_onsets.append(val)
-            except:
-                pass
-        offsets = selected_event_df[column_names[2]].tolist()
-        # validate
-        valid_offsets = []
-        for el in offsets:
-            try:
-                val = float(el)
-                valid_offsets.append(val)
-            except:
-                pass
-        if len(valid_onsets) > 0:
-            on_off[0] = valid_onsets
+        # events file was parsed once when it was read (fpExplorer_cache.get_event_index)
+        onsets,offsets = event_index.get(event,([],[]))
+        if len(onsets) > 0:
+            on_off[0] = onsets.tolist()
         else:
             print("There are no onsets for the event",event)
-        if len(valid_offsets) > 0:
-            on_off[1] = valid_offsets
+        if len(offsets) > 0:
+            on_off[1] = offsets.tolist()
         else:
             print("There are no offsets for the event",event)
         return on_off
 
-    def filter_data_around_event(self,raw_data,events_df,perievent_options_dict,settings_dict):
+    def add_normalized_around_event(self,subject,data_dict):
+        if len(data_dict) == 0 or subject not in self.trimmed_raw_data_dict:
+            return
+        # normalize the whole trace (or reuse the one normalized with the same settings)
+        normalized = self.stage_cache.normalize(subject,self.trimmed_raw_data_dict[subject],self.settings_dict)
+        # first downsampled sample of each trial is 1/N after the sample before the window
+        first_times = np.asarray(data_dict["first_ts"])-1/data_dict["fs"]+1/self.settings_dict[0]["downsample"]
+        n_samples = min([len(trial) for trial in data_dict["signal"]])
+        data_dict["normalized"] = fpExplorer_functions.get_normalized_around_event(normalized,first_times,n_samples,self.settings_dict[0]["downsample"])
+        if len(data_dict["normalized"]) == 0:
+            print("Events too close to the trimmed part of the recording. Each trial will be normalized separately.")
+
+    # inform user (once per subject) that samples are not in time order
+    def check_time_order(self,subject):
+        if subject in self.unordered_time_subjects:
+            return
+        if self.raw_data_dict[subject].attrs.get("time_increasing",True) == False:
+            self.unordered_time_subjects.add(subject)
+            self.show_info_dialog("Time in "+subject+" data is not increasing.\nSamples will be used in the order they are in the file.")
+
+    def align_onsets(self,raw_ts,evt_onsets):
+        '''Returns event onsets found in sorted raw_ts: the same time or, if there is none,
+        the first time that rounded to 3 decimal places is equal to the rounded onset
+        Onsets that are not found are skipped
+        '''
+        if len(raw_ts) == 0 or len(evt_onsets) == 0:
+            return np.zeros(0)
+        idx = np.minimum(np.searchsorted(raw_ts,evt_onsets,side='left'),len(raw_ts)-1)
+        found = raw_ts[idx] == evt_onsets
+        for i in np.nonzero(~found)[0]:
+            # round raw to 3 decimal places just in case the original time is not found
+            # (only times close to the onset can round to the same value)
+            rounded_onset = round(evt_onsets[i],3)
+            lo = np.searchsorted(raw_ts,rounded_onset-0.001,side='left')
+            hi = np.searchsorted(raw_ts,rounded_onset+0.001,side='right')
+            matching = np.nonzero(np.around(raw_ts[lo:hi],decimals=3) == rounded_onset)[0]
+            if len(matching) > 0:
+                # pick only the first one
+                idx[i] = lo+matching[0]
+                found[i] = True
+        return raw_ts[idx[found]]
+
+    def filter_data_around_event(self,raw_data,event_index,perievent_options_dict,settings_dict):
         filtered = {}
         event_name = perievent_options_dict["event"]
         before = perievent_options_dict["sec_before"]
         till = perievent_options_dict["sec_after"]+0.1
-        evt_onsets = self.get_event_on_off(events_df, event_name)[0]
+        evt_onsets = self.get_event_on_off(event_index, event_name)[0]
         signal_data = raw_data.iloc[:,1].to_numpy()
         control_data = raw_data.iloc[:,2].to_numpy()
+        raw_ts = raw_data.iloc[:,0].to_numpy()
+        if raw_data.attrs.get("time_increasing",True) == False:
+            # time is not increasing (checked when data was read), samples are searched in file order
+            return self.filter_unsorted_data_around_event(raw_ts,signal_data,control_data,evt_onsets,before,till,settings_dict)
+        # timestamps in data do not match exactly timestamps in event file
+        # events are located with binary search in increasing time
+        evt_onsets_from_data = self.align_onsets(raw_ts,np.asarray(evt_onsets,dtype=np.float64))
+        if len(evt_onsets_from_data) == 0:
+            print("Could not find matching event onset times times")
+            return filtered
+        
+        # chop data into windows around the events
+        # (first sample at or after evt-before, last one before evt+till)
+        first_samples = np.searchsorted(raw_ts,evt_onsets_from_data-before,side='left')
+        end_samples = np.searchsorted(raw_ts,evt_onsets_from_data+till,side='left')
+        signals = [signal_data[lo:hi] for lo,hi in zip(first_samples,end_samples)]
+        controls = [control_data[lo:hi] for lo,hi in zip(first_samples,end_samples)]
+        # time of the first sample in each window (the first sample of data if window is empty)
+        first_ts = list(raw_ts[np.where(end_samples > first_samples,np.minimum(first_samples,len(raw_ts)-1),0)])
+        return self.downsample_around_event(raw_ts,signals,controls,first_ts,settings_dict)
+
+    # the same as filter_data_around_event for time that is not increasing
+    # (events and windows are found by checking every sample)
+    def filter_unsorted_data_around_event(self,raw_ts,signal_data,control_data,evt_onsets,before,till,settings_dict):
         # timestamps in data do not match exactly timestamps in event file
         evt_onsets_from_data = []
-        raw_ts = raw_data.iloc[:,0].to_numpy()
         # round raw to 3 decimal places just in case the original time is not found
         rounded_arr = np.around(raw_ts,decimals=3)
         for el in evt_onsets:
@@ -3043,17 +3088,23 @@ class PreviewEventBasedWidget(QWidget):
                     evt_onsets_from_data.append(raw_ts[result_idx])
         if len(evt_onsets_from_data) == 0:
             print("Could not find matching event onset times times")
-            return filtered
+            return {}
         
         # chop data into windows around the events
         signals = []
         controls = []
+        # time of the first sample in each window
+        first_ts = []
         for evt in evt_onsets_from_data:
             condition = np.greater_equal(raw_ts,evt-before)&np.less(raw_ts,evt+till)
-            signal_temp = np.extract(condition,signal_data)
-            control_temp = np.extract(condition,control_data)
-            signals.append(signal_temp)
-            controls.append(control_temp)
+            signals.append(np.extract(condition,signal_data))
+            controls.append(np.extract(condition,control_data))
+            first_ts.append(raw_ts[np.argmax(condition)])
+        return self.downsample_around_event(raw_ts,signals,controls,first_ts,settings_dict)
+
+    # downsample windows of data cut around the events
+    def downsample_around_event(self,raw_ts,signals,controls,first_ts,settings_dict):
+        filtered = {}
         
         # downsample data as well
         N = settings_dict[0]["downsample"] 
@@ -3083,6 +3134,8 @@ class PreviewEventBasedWidget(QWidget):
                 signal_downsampled.append(resampled_data)
             filtered["signal"] = signal_downsampled
             filtered["control"] = control_downsampled   
+            filtered["first_ts"] = first_ts
+            filtered["fs"] = fs
         except:
             print("Not enough data that satisfy your request. Try changing event or times around event.")
         
@@ -3126,6 +3179,7 @@ class PreviewEventBasedWidget(QWidget):
         group = settings_dict[0]["subject_group_name"]
         my_df = pd.DataFrame({"rate after downsampling (Hz)":[downsample_rate],
                             "number of averaged samples for downsampling":[downsample_no],
+                            "downsampling method":[settings_dict[0]["downsample_method"]],
                             "normalization":[normalization],
                             "normalization as": normalization_as,
                             "filter":[filter_on],
@@ -3620,86 +3674,25 @@ class PreviewEventBasedWidget(QWidget):
         else:
             canvas.draw()
 
-    def show_polynomial_fitting(self,canvas, settings_dict,downsampled,subject_name,save_plot,dump_path):
+    # normalized_dict is normalized data of the same subject with the same settings
+    # (fitting is not repeated if it has the fit)
+    def show_polynomial_fitting(self,canvas, settings_dict,downsampled,subject_name,save_plot,dump_path,normalized_dict=None):
         normalization = settings_dict["normalization"]
-        smooth = settings_dict["filter"]
-        smooth_window = settings_dict["filter_window"]
-        
-        # change lists to numpy array for calculations
-        ts_arr = np.asarray(downsampled["ts"])
-        signal_arr =np.asarray(downsampled["signal"])
-        control_arr = np.asarray(downsampled["control"])
+        ts_arr,signal_arr,control_arr,fit = fpExplorer_functions.get_polynomial_fitting(settings_dict,downsampled,None,normalized_dict)
         # reset time to start from zero
         total_seconds = ts_arr[-1]-ts_arr[0]
         # start time from zero
         ts_reset = [i*total_seconds/len(ts_arr) for i in range(len(ts_arr))]
-
-        if smooth == True:
-            print("Start smoothing",smooth_window)
-            a = 1
-            b = np.divide(np.ones((smooth_window,)), smooth_window)
-            control_arr = filtfilt(b, a, control_arr)
-            signal_arr = filtfilt(b, a, signal_arr)
-            print("Done smoothing")
-
-        # in order to suggest if user should normalize using modified method
-        # check if signals in both channels do not decrease equally
-        # filter out signal values that are below or above 2 standard deviations from the signal mean 
-        # fit time axis to the 465nm stream 
-        mean_signal = np.mean(signal_arr)
-        stdev_signal = np.std(signal_arr)
-        mean_control = np.mean(control_arr)
-        stdev_control = np.std(control_arr)
-        indexes_signal = np.where((signal_arr<mean_signal+2*stdev_signal) & (signal_arr>mean_signal-2*stdev_signal))
-        selected_signal = signal_arr[indexes_signal]
-        selected_ts_signal_arr = ts_arr[indexes_signal]
-        indexes_control = np.where((control_arr<mean_control+2*stdev_control) & (control_arr>mean_control-2*stdev_control))
-        selected_control = control_arr[indexes_control]
-        selected_ts_control_arr = ts_arr[indexes_control]
-        # fit time axis to the 465nm stream  
-        bls_Ca = np.polynomial.polynomial.Polynomial.fit(selected_ts_signal_arr,selected_signal,1)
-        # fit time axis the 405nm stream
-        bls_ref = np.polynomial.polynomial.Polynomial.fit(selected_ts_control_arr,selected_control,1)
-        #######################
-        # # in order to suggest if user should normalize using modified method
-        # # check if signals in both channels do not decrease equally
-        # # fit time axis to the 465nm stream 
-        # bls_Ca = np.polynomial.polynomial.Polynomial.fit(ts_reset,signal_arr,1)
-        # # fit time axis the 405nm stream
-        # bls_ref = np.polynomial.polynomial.Polynomial.fit(ts_reset,control_arr,1)
-        ####################################################################################
-        # the below returns first: slope, second: intercept
-        print("bls_Ca",bls_Ca.convert().coef[::-1])
-        # the below returns first: slope, second: intercept
-        print("bls_ref",bls_ref.convert().coef[::-1])
-        # put those values in a dictionary
-        slope_intercept_dict = {"signal_slope_intercept":bls_Ca.convert().coef[::-1],
-                                "control_slope_intercept":bls_ref.convert().coef[::-1]
+        # put fitted lines in a dictionary (first: slope, second: intercept)
+        slope_intercept_dict = {"signal_slope_intercept":np.array(fit["signal"][::-1]),
+                                "control_slope_intercept":np.array(fit["control"][::-1])
         }
+        print("bls_Ca",slope_intercept_dict["signal_slope_intercept"])
+        print("bls_ref",slope_intercept_dict["control_slope_intercept"])
 
-        if normalization == 'Standard Polynomial Fitting':                   
-            # # https://stackoverflow.com/questions/45338872/matlab-polyval-function-with-three-outputs-equivalent-in-python-numpy
-            # mu = np.mean(control_arr)
-            # std = np.std(control_arr, ddof=0)
-            # # Call np.polyfit(), using the shifted and scaled version of control_arr
-            # cscaled = np.polynomial.polynomial.Polynomial.fit((control_arr - mu)/std, signal_arr, 1)
-            # # Create a poly1d object that can be called
-            # # https://numpy.org/doc/stable/reference/routines.polynomials.html
-            # pscaled = Polynomial(cscaled.convert().coef)
-            # # Inputs to pscaled must be shifted and scaled using mu and std
-            # F0 = pscaled((control_arr - mu)/std)   
-            #############################################################################################
-            # filter out signal values that are below or above 2 standard deviations from the signal mean 
-            mean_signal = np.mean(signal_arr)
-            stdev_signal = np.std(signal_arr)
-            indexes = np.where((signal_arr<mean_signal+2*stdev_signal) & (signal_arr>mean_signal-2*stdev_signal))
-            selected_signal = signal_arr[indexes]
-            selected_control = control_arr[indexes]
-            mu = np.mean(selected_control)
-            std = np.std(selected_control)
-            cscaled = np.polynomial.polynomial.Polynomial.fit((selected_control - mu)/std, selected_signal, 1)
-            pscaled = Polynomial(cscaled.convert().coef)
-            F0 = pscaled((control_arr - mu)/std)
+        F0,F0Ref = fpExplorer_functions.get_F0(fit,ts_arr,signal_arr,control_arr,normalization)
+        # one plot if F0 was fitted from control, otherwise signal and control with their F0
+        if F0Ref is None:
             ################################################################################# 
             # plot
             # clear previous figure
@@ -3723,9 +3716,7 @@ class PreviewEventBasedWidget(QWidget):
         
             canvas.draw()
         
-        if normalization == 'Modified Polynomial Fitting':           
-            F0Ca = polyval(ts_reset,bls_Ca.convert().coef)
-            F0Ref = polyval(ts_reset,bls_ref.convert().coef)
+        else:
             # plot
             # clear previous figure
             canvas.fig.clf()
@@ -3733,7 +3724,7 @@ class PreviewEventBasedWidget(QWidget):
             ax2 = canvas.fig.add_subplot(212)
             
             ax.plot(ts_reset, signal_arr, linewidth=1, color=SIGNAL_COLOR_RGB, label='F signal')
-            ax.plot(ts_reset, F0Ca, linewidth=1, color='k', label='F0')
+            ax.plot(ts_reset, F0, linewidth=1, color='k', label='F0')
             
             ax2.plot(ts_reset, control_arr, linewidth=1, color=CONTROL_COLOR_RGB, label='F control')
             ax2.plot(ts_reset, F0Ref, linewidth=1, color='k', label='F0')
@@ -3810,123 +3801,38 @@ class PreviewEventBasedWidget(QWidget):
             total_plots = 9
 
         
-        if settings_dict[0]["filter"] == True:
+        # windows cut from the whole trace normalized signal are already smoothed and normalized
+        normalized_perievent_data = []
+        if perievent_options_dict.get("use_normalized_trace",False) == True:
+            normalized_perievent_data = fpExplorer_functions.get_normalized_perievent_data(modified_data)
+            if len(current_trials) > 0 and len(normalized_perievent_data) > 0:
+                normalized_perievent_data = [normalized_perievent_data[trial-1] for trial in current_trials]
+        if len(normalized_perievent_data) > 0:
+            print("Using whole trace normalized data")
+        elif settings_dict[0]["filter"] == True:
             print("Start smoothing",settings_dict[0]["filter_window"])
-            # smooth data using filter
-            temp_signal_smoothed = []
-            temp_control_smoothed = []
-            a = 1
-            b = np.divide(np.ones((settings_dict[0]["filter_window"],)), settings_dict[0]["filter_window"])
-            for i in range(len(GCaMP_perievent_data)):
-                single_evt = filtfilt(b, a, GCaMP_perievent_data[i])
-                # single_evt = gaussian_filter(GCaMP_perievent_data[i], sigma=settings_dict[0]["filter_fraction"])
-    #            single_evt = lowess.lowess(pd.Series(ts_signal4average), pd.Series(GCaMP_perievent_data[i]), 
-    #                                       bandwidth=settings_dict[0]["filter_fraction"], polynomialDegree=1)
-                temp_signal_smoothed.append(single_evt)
-            for i in range(len(control_perievent_data)):
-                single_evt = filtfilt(b, a, control_perievent_data[i])
-                # single_evt = gaussian_filter(control_perievent_data[i], sigma=settings_dict[0]["filter_fraction"])
-    #            single_evt = lowess.lowess(pd.Series(ts_control4average), pd.Series(control_perievent_data[i]), 
-    #                                       bandwidth=settings_dict[0]["filter_fraction"], polynomialDegree=1)
-                temp_control_smoothed.append(single_evt)
-            if len(temp_signal_smoothed) > 0 and len(temp_control_smoothed) > 0:
-                GCaMP_perievent_data = temp_signal_smoothed
-                control_perievent_data = temp_control_smoothed
+            # smooth each trial
+            if len(GCaMP_perievent_data) > 0 and len(control_perievent_data) > 0:
+                GCaMP_perievent_data = fpExplorer_functions.smooth_data(np.asarray(GCaMP_perievent_data,dtype=np.float64),
+                                                                        settings_dict[0]["filter_window"],axis=1)
+                control_perievent_data = fpExplorer_functions.smooth_data(np.asarray(control_perievent_data,dtype=np.float64),
+                                                                          settings_dict[0]["filter_window"],axis=1)
             print("Done smoothing")
             
         # normalize
         y_dff_all = []
-        # find out how to normalize
-        if settings_dict[0]["normalization"] == 'Standard Polynomial Fitting':
-            # https://github.com/djamesbarker/pMAT
-            for x, y in zip(control_perievent_data, GCaMP_perievent_data):
-                x = np.array(x)
-                y = np.array(y)
-                
-            #     # https://stackoverflow.com/questions/45338872/matlab-polyval-function-with-three-outputs-equivalent-in-python-numpy
-            #     mu = np.mean(x)
-            #     std = np.std(x, ddof=0)
-            #     # Call np.polyfit(), using the shifted and scaled version of control_arr
-            #     cscaled = np.polynomial.polynomial.Polynomial.fit((x - mu)/std, y, 1)
-            #     # Create a poly1d object that can be called
-            #     # https://numpy.org/doc/stable/reference/routines.polynomials.html
-            #     pscaled = Polynomial(cscaled.convert().coef)
-            #     # Inputs to pscaled must be shifted and scaled using mu and std
-            #     F0 = pscaled((x - mu)/std)
-            # #    print("F0?",F0[:20])
-            #     dffnorm = (y - F0)/F0 * 100
-                #############################################################################################
-                # filter out signal values that are below or above 2 standard deviations from the signal mean 
-                mean_signal = np.mean(y)
-                stdev_signal = np.std(y)
-                indexes = np.where((y<mean_signal+2*stdev_signal) & (y>mean_signal-2*stdev_signal))
-                selected_signal = y[indexes]
-                selected_control = x[indexes]
-                mu = np.mean(selected_control)
-                std = np.std(selected_control)
-                cscaled = np.polynomial.polynomial.Polynomial.fit((selected_control - mu)/std, selected_signal, 1)
-                pscaled = Polynomial(cscaled.convert().coef)
-                F0 = pscaled((x - mu)/std)
-                dffnorm = (y - F0)/F0 * 100
-                ##############################################################################################
-                # find all values of the normalized DF/F that are negative so you can next shift up the curve 
-                # to make 0 the mean value for DF/F
-                negative = dffnorm[dffnorm<0]
-                dff=dffnorm-np.mean(negative)
-
-                if show_norm_as == "Z-Score":
-                    median_all = np.median(dff)
-                    mad = stats.median_absolute_deviation(dff)
-                    dff = (dff - median_all)/mad
-
-                y_dff_all.append(dff)
-                
-        elif settings_dict[0]["normalization"] == 'Modified Polynomial Fitting':
-            for x, y in zip(control_perievent_data, GCaMP_perievent_data):
-                x = np.array(x)
-                y = np.array(y)
-                # bls_signal = np.polynomial.polynomial.Polynomial.fit(ts1, y, 1)
-                # F0_signal = polyval(ts1,bls_signal.convert().coef)
-                # dFF_signal = (y - F0_signal)/F0_signal *100
-                
-                # bls_control = np.polynomial.polynomial.Polynomial.fit(ts2,x,1)
-                # F0_control = polyval(ts2,bls_control.convert().coef)
-                # dFF_control = (x - F0_control)/F0_control *100
-                # dFFnorm = dFF_signal - dFF_control
-                ############################################################################################
-                # 23/01 filter out signal values that are below or above 2 standard deviations from the signal mean 
-                mean_signal = np.mean(y)
-                stdev_signal = np.std(y)
-                mean_control = np.mean(x)
-                stdev_control = np.std(x)
-                indexes_signal = np.where((y<mean_signal+2*stdev_signal) & (y>mean_signal-2*stdev_signal))
-                selected_signal = y[indexes_signal]
-                selected_ts_signal_arr = ts1[indexes_signal]
-                indexes_control = np.where((x<mean_control+2*stdev_control) & (x>mean_control-2*stdev_control))
-                selected_control = x[indexes_control]
-                selected_ts_control_arr = ts2[indexes_control]
-                # fit time axis to the 465nm stream  
-                bls_signal = np.polynomial.polynomial.Polynomial.fit(selected_ts_signal_arr,selected_signal,1)
-                bls_control = np.polynomial.polynomial.Polynomial.fit(selected_ts_control_arr,selected_control,1)
-                F0_signal = polyval(ts1,bls_signal.convert().coef)
-                F0_control = polyval(ts2,bls_control.convert().coef)
-                # dF/F for the 465 channel
-                dFF_signal = (y - F0_signal)/F0_signal *100
-                # dF/F for the 405 channel
-                dFF_control = (x - F0_control)/F0_control *100
-                dFFnorm = dFF_signal - dFF_control
-                ##########################################################################
-                # find all values of the normalized DF/F that are negative so you can next shift up the curve 
-                # to make 0 the mean value for DF/F
-                negative = dFFnorm[dFFnorm<0]
-                dff = dFFnorm-np.mean(negative)
-
-                if show_norm_as == "Z-Score":
-                    median_all = np.median(dff)
-                    mad = stats.median_absolute_deviation(dff)
-                    dff = (dff - median_all)/mad
-
-                y_dff_all.append(dff)
+        if len(normalized_perievent_data) > 0:
+            y_dff_all = [np.asarray(trial,dtype=np.float64) for trial in normalized_perievent_data]
+        elif len(GCaMP_perievent_data) > 0:
+            # all trials at once, the same way as in analyze_perievent_data
+            y_dff_all = fpExplorer_functions.normalize_trials(ts1,np.asarray(GCaMP_perievent_data,dtype=np.float64),
+                                                              np.asarray(control_perievent_data,dtype=np.float64),
+                                                              settings_dict[0]["normalization"])
+            if show_norm_as == "Z-Score":
+                # the same scale as scipy's median_absolute_deviation
+                median_all,mad = fpExplorer_functions.get_median_mad(y_dff_all,axis=1,scale='normal')
+                y_dff_all = (y_dff_all - median_all[:,np.newaxis])/mad[:,np.newaxis]
+            y_dff_all = list(y_dff_all)
         # print(f"How many trials in preview plot perievent: {len(y_dff_all)}")
         # plot
         # clear previous figure
@@ -47,17 +47,25 @@ import math
 import pandas as pd
 # from scipy.ndimage import gaussian_filter
 from scipy import stats
-from sklearn.metrics import auc
 #from loess.loess_1d import loess_1d
 #import statsmodels.api as sm
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-from scipy.signal import find_peaks, filtfilt
+from scipy.signal import find_peaks, resample_poly
+from scipy.ndimage import uniform_filter1d
 from scipy.interpolate import interp1d
+from scipy.optimize import minimize
+from scipy.linalg import solveh_banded
 import os
 import copy
 import warnings
+from fractions import Fraction
+from functools import lru_cache
+try:
+    from numpy import trapezoid as trapz
+except ImportError: # numpy < 2.0
+    from numpy import trapz
 
 
 ''' get all data from the recording (reads from multiple files)
@@ -101,17 +109,138 @@ SIGNAL_COLOR_RGB = '#1A36F2'
 CONTROL_COLOR_RGB = '#FC2908'
 
 DPI4SVG = 1200
+
+# methods of downsampling that can be selected in settings (first is default)
+DOWNSAMPLE_METHODS = ["Linear Interpolation","Polyphase","Block Mean","Block Median"]
+# max decimation factor of polyphase resampling (ratio of rates is approximated with fraction up/down)
+MAX_POLYPHASE_DOWN = 1000
+# how many time axes (for different sampling rates and lengths) are kept in memory
+TIME_AXIS_CACHE_SIZE = 8
+# relative difference of normalized trace sample interval from 1/N for which
+# peri-event windows can still be cut out of the whole trace
+TRACE_INTERVAL_TOLERANCE = 1e-6
+# samples processed at once when accumulating sums for linear fits (limits temporary arrays)
+FIT_BLOCK_SAMPLES = 1000000
+# how smoothing handles edges (first is default): "odd" extends data like scipy's filtfilt
+# (point reflection of 3 windows), others are modes of scipy.ndimage filters
+SMOOTH_EDGE_MODES = ["odd","reflect","nearest","mirror"]
+# methods of normalization that can be selected in settings (first is default)
+# functions of each method are registered in NORMALIZATION_BACKENDS
+NORMALIZATION_METHODS = ["Standard Polynomial Fitting","Modified Polynomial Fitting",
+                         "Robust Polynomial Fitting (Huber)","airPLS Baseline","Double Exponential Fitting"]
+# Huber loss tuning constant (in robust standard deviations of residuals) and max number of reweighting iterations
+HUBER_K = 1.345
+IRLS_MAX_ITER = 50
+# airPLS baseline follows changes slower than this period (in seconds)
+AIRPLS_PERIOD_SEC = 60
+AIRPLS_MAX_ITER = 15
+# trace is decimated for airPLS to have at most that many samples in AIRPLS_PERIOD_SEC
+# (larger smoothing parameter makes the banded solver inaccurate)
+AIRPLS_PERIOD_SAMPLES = 2000
+# max number of samples used to fit double exponential bleaching (trace is decimated for the fit)
+BLEACHING_FIT_SAMPLES = 100000
+# number of time constants (log spaced) tried for double exponential bleaching of each trial
+BLEACHING_TRIAL_TAUS = 24
+
+# tank path:(modification time,tank info) of already scanned tanks
+TANK_INFO_CACHE = {}
+# recording path:event index (see get_event_index) of recordings read so far
+EVENT_INDEX_CACHE = {}
 ################################
 # return raw data structure
-def get_raw_data(path):
+def get_raw_data(path,stream_names=[],t1=0,t2=0):
     '''Returns a raw data extracted by tdt from all recording files
+    If stream names (i.e. _465A, _405A) are known, reads only those streams and all epocs,
+    optionally only from t1 to t2 seconds (streams data will then start at t1)
+    '''
+    raw_data = None
+    if len(stream_names) > 0:
+        raw_data = get_selected_raw_data(path,stream_names,t1,t2)
+    if raw_data == None: # channel names not known yet or selective reading failed
+        try:
+            raw_data = tdt.read_block(path) 
+        except:
+            raw_data = None
+    # events are indexed again from the new data
+    clear_event_index(path)
+    return raw_data
+
+def get_selected_raw_data(path,stream_names,t1=0,t2=0):
+    '''Returns raw data with only selected streams and all epocs
+    Returns None if any of the streams is not in the data
     '''
     try:
-        raw_data = tdt.read_block(path) 
+        # read just the headers first (no stream data)
+        headers = tdt.read_block(path,headers=1)
+        for name in stream_names:
+            if name not in headers.stores.keys() or headers.stores[name].type_str != 'streams':
+                print("Stream",name,"not found in",path)
+                return None
+        # keep only stores that need to be read from disk
+        # tdt reads data of all stores in headers it gets
+        selected_stores = tdt.StructType()
+        for key in headers.stores.keys():
+            if key in stream_names or headers.stores[key].type_str == 'epocs':
+                selected_stores[key] = headers.stores[key]
+        headers.stores = selected_stores
+        raw_data = tdt.read_block(path,headers=headers,t1=t1,t2=t2)
     except:
         raw_data = None
     return raw_data
 
+# latest modification time of all files in tank folder
+def get_tank_mtime(path):
+    mtime = os.path.getmtime(path)
+    for entry in os.scandir(path):
+        if entry.is_file():
+            mtime = max(mtime,entry.stat().st_mtime)
+    return mtime
+
+def get_tank_info(path):
+    '''Returns a dictionary with tank metadata without reading streams data:
+    store names, stream names and their sampling rates, recording duration (sec) and events
+    Reads only headers and epocs. Results are cached until any of tank files changes.
+    Returns None if tank could not be read
+    '''
+    try:
+        mtime = get_tank_mtime(path)
+    except:
+        return None
+    if path in TANK_INFO_CACHE and TANK_INFO_CACHE[path][0] == mtime:
+        return TANK_INFO_CACHE[path][1]
+    try:
+        headers = tdt.read_block(path,headers=1)
+    except:
+        return None
+    # tdt returns None for folders without tank files
+    if headers == None:
+        return None
+    info = {"stores":[key for key in headers.stores.keys()],
+            "channel_names":[],
+            "fs":{},
+            "duration":float(headers.stop_time[0]-headers.start_time[0]),
+            "events":[]}
+    epoc_stores = tdt.StructType()
+    for key in headers.stores.keys():
+        if headers.stores[key].type_str == 'streams':
+            info["channel_names"].append(key)
+            info["fs"][key] = headers.stores[key].fs
+        elif headers.stores[key].type_str == 'epocs':
+            epoc_stores[key] = headers.stores[key]
+    # epocs (with Cam1 notes) are stored in the same file as headers, 
+    # so reading them alone is as fast as reading headers
+    headers.stores = epoc_stores
+    try:
+        epocs_data = tdt.read_block(path,headers=headers)
+    except:
+        # use epocs found in headers
+        epocs_data = tdt.StructType()
+        epocs_data.epocs = epoc_stores
+    # (not kept, epocs may come from headers only)
+    info["events"] = list(build_event_index(epocs_data).keys())
+    TANK_INFO_CACHE[path] = (mtime,info)
+    return info
+
 def get_channel_names(raw_data):
     '''
     Returns a list of unique channel names in streams from file
@@ -125,35 +254,74 @@ def get_events(raw_data):
     Returns a list of unique events from file that
     don't start with cam or tick
     '''
+    return list(get_event_index(raw_data).keys())
+
+# returns path of the recording that raw data was read from or None if it is not known
+def get_block_path(raw_data):
+    try:
+        return os.path.normpath(os.path.join(raw_data.info.tankpath,raw_data.info.blockname))
+    except:
+        return None
+
+# forget event index of recording (i.e. when it is read again)
+def clear_event_index(path):
+    EVENT_INDEX_CACHE.pop(os.path.normpath(path),None)
+
+def get_event_index(raw_data):
+    '''
+    Returns dictionary event name:(onsets,offsets) of all events from file
+    (see build_event_index).
+    Index is built once per recording and kept in EVENT_INDEX_CACHE
+    until the recording is read again.
+    '''
+    path = get_block_path(raw_data)
+    if path == None:
+        return build_event_index(raw_data)
+    if path not in EVENT_INDEX_CACHE:
+        EVENT_INDEX_CACHE[path] = build_event_index(raw_data)
+    return EVENT_INDEX_CACHE[path]
+
+def build_event_index(raw_data):
+    '''
+    Returns dictionary event name:(onsets,offsets) of all events from file
+    (store name and value, i.e. "PtC0 1", or Cam1 if it has notes).
+    Onsets and offsets are arrays sorted by onset, Cam1 has only onsets (notes timestamps).
+    '''
+    event_index = {}
     # tdt StructTypes are dictionaries
-    all_epocs_list = [key for key in raw_data.epocs.keys()]
-    my_event_list = []
-    # iterate over all events that start with Ptr
-    for evt in all_epocs_list:
+    for evt in raw_data.epocs.keys():
+        data = raw_data.epocs[evt]
         # exclude cam or tickfrom events
-        if (evt.lower().startswith("cam") == False and evt.lower().startswith("tick") == False) or evt.lower().startswith("cam1") == True:
-            if evt.lower().startswith("cam1") == False:
-                # create set of unique events
-                unique_events = set(raw_data.epocs[evt].data)
-                for el in unique_events:
-                    evt_name = evt + " " + str(int(el))
-                    my_event_list.append(evt_name)
-            else:
-                # check if include special case for cam1 (only if it has notes)
-                data = raw_data.epocs[evt]
-                match = False
-                for k in data.keys():
-                    if k == 'notes':
-                        match = True
-                if match == True:
-                    my_event_list.append(evt)
-    return my_event_list
+        if evt.lower().startswith("cam1") == True:
+            # special case for cam1 (only if it has notes)
+            if "notes" in data.keys():
+                try:
+                    onsets = np.sort(np.asarray(data.notes.ts,dtype=np.float64),kind="stable")
+                except:
+                    onsets = np.zeros(0)
+                event_index[evt] = (onsets,np.zeros(0))
+        elif evt.lower().startswith("cam") == False and evt.lower().startswith("tick") == False:
+            values = np.asarray(data.data)
+            all_onsets = np.asarray(data.onset,dtype=np.float64)
+            all_offsets = np.asarray(data.offset,dtype=np.float64) if "offset" in data.keys() else None
+            # create set of unique events
+            for el in set(data.data):
+                evt_name = evt + " " + str(int(el))
+                if evt_name in event_index:
+                    continue
+                # the same values as tdt.epoc_filter(raw_data,evt,values=[int(el)])
+                valid = np.isclose(values,int(el))
+                order = np.argsort(all_onsets[valid],kind="stable")
+                onsets = all_onsets[valid][order]
+                offsets = all_offsets[valid][order] if all_offsets is not None else np.zeros(0)
+                event_index[evt_name] = (onsets,offsets)
+    return event_index
 
 # returns true if there are any events in the data
 def check_events(path):
     events_present = False
-    data = get_raw_data(path)
-    if len(get_events(data)) > 0:
+    info = get_tank_info(path)
+    if info != None and len(info["events"]) > 0:
         events_present = True
     return events_present
 
@@ -162,32 +330,11 @@ def get_event_on_off(raw_data, event):
         First element of this array are onset times, 
         Second el are offset times
     '''
-    event_name_split = event.split(" ")
     on_off = [[],[]]
-    if event.lower().startswith("cam1") == False:
-        # find tone onsets and offsets
-        try:    # some data was not readable by tdt.epoc_filter
-            evt_on_off= tdt.epoc_filter(raw_data, event_name_split[0], values=[int(event_name_split[1])])
-            on_off = evt_on_off.time_ranges
-        except: 
-            try:
-                print("Problem getting on off event data by tdt.epoc_filter")
-                print(event_name_split[0]) # some names end with _ and that gets replaced in data tank
-                if event_name_split[0][-1] == "_":
-                    adjusted_name = event_name_split[0][:-1]+"/"
-                    print(adjusted_name)
-                    evt_on_off= tdt.epoc_filter(raw_data, adjusted_name, values=[int(event_name_split[1])])
-                    on_off = evt_on_off.time_ranges
-            except:
-                print("After readjusting event name still problem getting on off event data by tdt.epoc_filter")
-    else: # special case for Cam1
-        data = raw_data.epocs[event]
-        onsets = []
-        try:
-            onsets = data.notes.ts
-        except:
-            onsets = []
-        on_off[0] = onsets
+    # all events were filtered once (get_event_index)
+    event_index = get_event_index(raw_data)
+    if event in event_index:
+        on_off = list(event_index[event])
     if len(on_off[0]) == 0:
         print("Could not get onsets any of known ways")
     return on_off
@@ -201,13 +348,19 @@ def get_single_channel(raw_data,chnl_name):
     # round to whole seconds
     full_total_sec = int(times[-1])
     # get only recording up to that time value
-    full_times = [el for el in times if el < full_total_sec]
-    chnl_data = chnl_data[:len(full_times)]
+    # (times are sorted, so find the index of first time that is not less than full seconds)
+    chnl_data = chnl_data[:np.searchsorted(times,full_total_sec)]
     return chnl_data
 
 def create_timestamps(raw_data,chnl_name,channel_data):
-    num_samples = len(channel_data)
-    times = np.linspace(1, num_samples, num_samples) / raw_data.streams[chnl_name].fs
+    return get_time_axis(float(raw_data.streams[chnl_name].fs),len(channel_data))
+
+# the same time axis is needed many times for the same recording,
+# so keep a few most recent ones (they are read only and shared by all callers)
+@lru_cache(maxsize=TIME_AXIS_CACHE_SIZE)
+def get_time_axis(fs,num_samples):
+    times = np.linspace(1, num_samples, num_samples) / fs
+    times.setflags(write=False)
     return times
 
 def get_frequency(raw_data,chnl_name):
@@ -275,333 +428,554 @@ def create_list_of_paths_experiment_subjects(main_path,subject_list,experiment_n
             valid_subjects.append(el) 
     return valid_subjects, paths_dict
 
-# downsample by using median instead of mean
-def downsample_tdt(signal_dict,downsample_n):
-    GCaMP_data = signal_dict["signal"]
-    control_data = signal_dict["control"]
-    ts = signal_dict["ts"]
-    GCaMP_data_means = []
-    control_data_means = []
-    for i in range(0, len(GCaMP_data), downsample_n):
-        GCaMP_data_means.append(np.mean(GCaMP_data[i:i+downsample_n-1])) # This is the moving window median
-        control_data_means.append(np.mean(control_data[i:i+downsample_n-1]))
-    # adjust timestamps every nth
-    ts_adjusted = ts[:-1:downsample_n]
-    
-    # check for equal lengths
-    if len(GCaMP_data_means) < len(ts_adjusted):
-        ts_adjusted = ts_adjusted[:len(GCaMP_data_means)]
-    elif len(GCaMP_data_means) > len(ts_adjusted):
-        GCaMP_data_means = GCaMP_data_means[:len(ts_adjusted)]
-        control_data_means = control_data_means[:len(ts_adjusted)]
-    
-    return {"ts":ts_adjusted,"signal":GCaMP_data_means,"control":control_data_means}
-
-# use 1D linear interpolation to downsample precisely in Hz
-def downsample(signal_dict,target_Hz):
-    GCaMP_data = signal_dict["signal"]
-    control_data = signal_dict["control"]
-    ts_original = signal_dict["ts"]
-    ts = signal_dict["ts"]
+# downsample by averaging (or taking median of) every downsample_n samples
+# of both channels at once; the last incomplete block is dropped
+def downsample_tdt(signal_dict,downsample_n,method="mean"):
+    ts = np.asarray(signal_dict["ts"])
+    data = np.vstack((np.asarray(signal_dict["signal"]),np.asarray(signal_dict["control"])))
+    n_blocks = min(data.shape[1],len(ts))//downsample_n
+    # each row becomes n_blocks x downsample_n matrix
+    blocks = data[:,:n_blocks*downsample_n].reshape(2,n_blocks,downsample_n)
+    if method == "median":
+        reduced = np.median(blocks,axis=2)
+    else:
+        reduced = np.mean(blocks,axis=2,dtype=np.float64)
+    # timestamp of the middle of each block
+    ts_adjusted = np.mean(ts[:n_blocks*downsample_n].reshape(n_blocks,downsample_n),axis=1,dtype=np.float64)
+    return {"ts":ts_adjusted,"signal":reduced[0],"control":reduced[1]}
+
+# number of samples in each block to downsample from fs close to target_Hz
+def get_block_length(fs,target_Hz):
+    return max(1,int(round(fs/target_Hz)))
+
+# downsample both channels to precisely target_Hz with selected method:
+# linear interpolation, polyphase filtering (low-pass filter before decimation) followed by interpolation
+# or average (median) of blocks of samples followed by interpolation
+def downsample(signal_dict,target_Hz,method=DOWNSAMPLE_METHODS[0]):
+    ts = np.asarray(signal_dict["ts"],dtype=np.float64)
+    # 2xN array with signal in first and control in second row
+    data = np.vstack((np.asarray(signal_dict["signal"]),np.asarray(signal_dict["control"])))
+    start = 0
     if ts[0] > 1: # if data was trimmed go back from zero
-        ts = [el-ts[0] for el in ts]
+        start = ts[0]
+        ts = ts-start
     # round last time to full integer
     last = math.floor(ts[-1])
     ts_adjusted = np.linspace(1/target_Hz,last,last*target_Hz)
-    GCaMP_interpolated = interp1d(ts, GCaMP_data)
-    GCaMP_resampled_data = GCaMP_interpolated(ts_adjusted)
-    control_interpolated = interp1d(ts, control_data)
-    control_resampled_data = control_interpolated(ts_adjusted)
-    # reconstruct time
-    if ts_original[0] > 1: # if data was trimmed go back to start like the original
-        ts_adjusted = [el+ts_original[0] for el in ts_adjusted]
-    # print(ts_original[0],ts_adjusted[0])
-    return {"ts":ts_adjusted,"signal":GCaMP_resampled_data,"control":control_resampled_data}
+    if method == "Polyphase":
+        data,ts = resample_polyphase(data,ts,target_Hz)
+    elif method in ["Block Mean","Block Median"]:
+        # blocks give rate fs/downsample_n that is only close to target_Hz
+        fs = (len(ts)-1)/(ts[-1]-ts[0])
+        reduced = downsample_tdt({"ts":ts,"signal":data[0],"control":data[1]},get_block_length(fs,target_Hz),
+                                 "median" if method == "Block Median" else "mean")
+        data = np.vstack((reduced["signal"],reduced["control"]))
+        ts = reduced["ts"]
+    resampled = resample_linear(data,ts,ts_adjusted)
+    # reconstruct time (if data was trimmed go back to start like the original)
+    ts_adjusted = ts_adjusted+start
+    return {"ts":ts_adjusted,"signal":resampled[0],"control":resampled[1]}
+
+# interpolate each row of data at new timestamps
+def resample_linear(data,ts,new_ts):
+    return np.vstack([np.interp(new_ts,ts,row) for row in data])
+
+# resample each row of data (with anti-aliasing filter) to a rate close to target_Hz
+# returns resampled data and its timestamps
+def resample_polyphase(data,ts,target_Hz):
+    fs = (len(ts)-1)/(ts[-1]-ts[0])
+    ratio = Fraction(target_Hz/fs).limit_denominator(MAX_POLYPHASE_DOWN)
+    resampled = resample_poly(data,ratio.numerator,ratio.denominator,axis=1,padtype="line")
+    new_ts = ts[0]+np.arange(resampled.shape[1])*ratio.denominator/(ratio.numerator*fs)
+    return resampled,new_ts
+
+def add_moments(moments,data):
+    '''Updates (count, mean, sum of squared differences from the mean) with new data
+    (parallel algorithm by Chan et al., stable for long recordings)
+    '''
+    count,mean,m2 = moments
+    n = len(data)
+    if n == 0:
+        return moments
+    block_mean = np.mean(data)
+    block_m2 = np.sum((data-block_mean)**2)
+    total = count+n
+    delta = block_mean-mean
+    return (total,mean+delta*n/total,m2+block_m2+delta**2*count*n/total)
+
+def get_2std_bounds(data,block_samples=FIT_BLOCK_SAMPLES):
+    '''Returns lower and upper bound of values within 2 standard deviations from the mean
+    (moments are accumulated block by block)
+    '''
+    moments = (0,0.0,0.0)
+    for lo in range(0,len(data),block_samples):
+        moments = add_moments(moments,data[lo:lo+block_samples])
+    stdev = math.sqrt(moments[2]/moments[0])
+    return moments[1]-2*stdev,moments[1]+2*stdev
+
+def add_fit_sums(sums,x,y,mask,x_shift,y_shift):
+    '''Adds sums needed to fit a line y = intercept + slope*x to values where mask is True
+    sums: count, sum of x, sum of y, sum of x*x, sum of x*y (of x-x_shift and y-y_shift)
+    Selected values are not copied out of x and y
+    '''
+    dx = np.subtract(x,x_shift,dtype=np.float64)
+    dy = np.subtract(y,y_shift,dtype=np.float64)
+    new_sums = [np.count_nonzero(mask),np.sum(dx,where=mask),np.sum(dy,where=mask)]
+    dy *= dx
+    dx *= dx
+    new_sums += [np.sum(dx,where=mask),np.sum(dy,where=mask)]
+    return sums+np.array(new_sums)
+
+def fit_line_from_sums(sums,x_shift,y_shift):
+    '''Returns intercept and slope of least squares line from add_fit_sums'''
+    n,sx,sy,sxx,sxy = sums
+    slope = (sxy-sx*sy/n)/(sxx-sx*sx/n)
+    intercept = (sy-slope*sx)/n
+    # go back from shifted values
+    return intercept+y_shift-slope*x_shift,slope
+
+def fit_line_2std(x,y,block_samples=FIT_BLOCK_SAMPLES):
+    '''Least squares fit of a line y = intercept + slope*x using only values
+    where y is within 2 standard deviations from its mean
+    Returns intercept and slope
+    '''
+    lower,upper = get_2std_bounds(y,block_samples)
+    x_shift = np.mean(x)
+    y_shift = (lower+upper)/2
+    sums = np.zeros(5)
+    for lo in range(0,len(y),block_samples):
+        x_block = x[lo:lo+block_samples]
+        y_block = y[lo:lo+block_samples]
+        sums = add_fit_sums(sums,x_block,y_block,(y_block<upper) & (y_block>lower),x_shift,y_shift)
+    return fit_line_from_sums(sums,x_shift,y_shift)
+
+def smooth_data(data,smooth_window,axis=-1,mode=SMOOTH_EDGE_MODES[0]):
+    '''Moving average filter applied forward and backward along axis
+    Running sums (uniform_filter1d) take the same time for any window length
+    With "odd" mode the result is the same as from filtfilt with boxcar filter:
+    data is extended by point reflection and each pass starts from its first value repeated
+    '''
+    data = np.moveaxis(np.asarray(data,dtype=np.float64),axis,-1)
+    padlen = 0
+    edge_mode = mode
+    if mode == "odd":
+        padlen = 3*smooth_window
+        if data.shape[-1] <= padlen:
+            raise ValueError("The length of the input vector x must be greater than padlen, which is %d." % padlen)
+        left = 2*data[...,:1]-data[...,padlen:0:-1]
+        right = 2*data[...,-1:]-data[...,-2:-padlen-2:-1]
+        data = np.concatenate((left,data,right),axis=-1)
+        edge_mode = "nearest"
+    # causal moving average forward, then backward
+    smoothed = uniform_filter1d(data,smooth_window,mode=edge_mode,origin=(smooth_window-1)//2)
+    smoothed = uniform_filter1d(smoothed,smooth_window,mode=edge_mode,origin=-(smooth_window//2))
+    return np.moveaxis(smoothed[...,padlen:smoothed.shape[-1]-padlen],-1,axis)
+
+#################################################################################
+# normalization methods
+# each method in NORMALIZATION_BACKENDS is a dictionary with:
+#   "fit": function(ts,signal,control) fitting whole trace (or baseline) arrays,
+#          returns dictionary with fitted parameters
+#   "F0": function(fit,ts,signal,control) returns (F0 of signal, F0 of control);
+#         F0 of control is None when F0 of signal is fitted from control
+#   "trials_F0": function(ts,signal,control) returning the same for all trials (rows) at once
+#                (optional, without it each trial is fitted separately)
+#   "extrapolate": False if fit of a custom baseline can't be applied to the whole trace
+#################################################################################
+
+def fit_standard(ts_arr,signal_arr,control_arr):
+    # https://github.com/djamesbarker/pMAT
+    return {"control_to_signal":fit_line_2std(control_arr,signal_arr)}
+
+def get_control_fit_F0(fit,ts_arr,signal_arr,control_arr):
+    return fit["control_to_signal"][0]+fit["control_to_signal"][1]*control_arr,None
+
+def get_standard_trials_F0(ts,signal,control):
+    # filter out signal values that are below or above 2 standard deviations from the signal mean 
+    # and fit control to signal in each trial
+    intercept,slope = fit_lines_masked(control,signal,get_2std_mask(signal))
+    return intercept[:,np.newaxis]+slope[:,np.newaxis]*control,None
 
-# modified polynomial
-def normalize_dff(signal_dict,show_as,smooth,smooth_window):
-    #####################
-    # change lists to numpy array for calculations
-    # create new timestamps for the data (from zero)
-    ts_arr = np.asarray(signal_dict["ts"])
-    signal_arr =np.asarray(signal_dict["signal"])
-    control_arr = np.asarray(signal_dict["control"])
-    if smooth == True:
-        print("Start smoothing",smooth_window)
-        a = 1
-        b = np.divide(np.ones((smooth_window,)), smooth_window)
-        control_arr = filtfilt(b, a, control_arr)
-        signal_arr = filtfilt(b, a, signal_arr)
-        print("Done smoothing")
-        
-    # Before filtering out +/- 2xstdev
-#     # fit time axis to the 465nm stream  
-# #    bls_Ca = np.polyfit(ts_arr,signal_arr,1) # deprecieted
-#     bls_Ca = np.polynomial.polynomial.Polynomial.fit(ts_arr,signal_arr,1)
-# #    print("bls_Ca",bls_Ca.convert().coef[::-1])
-# #    F0Ca = np.polyval(bls_Ca,ts_arr) # deprecieted
-#     F0Ca = polyval(ts_arr,bls_Ca.convert().coef)
-#     # dF/F for the 465 channel
-#     dFFCa = (signal_arr - F0Ca)/F0Ca *100
-#     # fit time axis the 405nm stream
-# #    bls_ref = np.polyfit(ts_arr,control_arr,1) # depreciated
-#     bls_ref = np.polynomial.polynomial.Polynomial.fit(ts_arr,control_arr,1)
-# #    F0Ref = np.polyval(bls_ref,ts_arr) # deprecieted
-#     F0Ref = polyval(ts_arr,bls_ref.convert().coef)
-#     # dF/F for the 405 channel
-#     dFFRef = (control_arr - F0Ref)/F0Ref *100
-# #    print(dFFRef)
-#     dFFnorm = dFFCa - dFFRef
-
-    ############################################################################################
-    # 23/01 filter out signal values that are below or above 2 standard deviations from the signal mean 
-    mean_signal = np.mean(signal_arr)
-    stdev_signal = np.std(signal_arr)
-    mean_control = np.mean(control_arr)
-    stdev_control = np.std(control_arr)
-    indexes_signal = np.where((signal_arr<mean_signal+2*stdev_signal) & (signal_arr>mean_signal-2*stdev_signal))
-    selected_signal = signal_arr[indexes_signal]
-    selected_ts_signal_arr = ts_arr[indexes_signal]
-    indexes_control = np.where((control_arr<mean_control+2*stdev_control) & (control_arr>mean_control-2*stdev_control))
-    selected_control = control_arr[indexes_control]
-    selected_ts_control_arr = ts_arr[indexes_control]
-    # fit time axis to the 465nm stream  
-    bls_Ca = np.polynomial.polynomial.Polynomial.fit(selected_ts_signal_arr,selected_signal,1)
-    bls_ref = np.polynomial.polynomial.Polynomial.fit(selected_ts_control_arr,selected_control,1)
-    F0Ca = polyval(ts_arr,bls_Ca.convert().coef)
-    # dF/F for the 465 channel
-    dFFCa = (signal_arr - F0Ca)/F0Ca *100
-    F0Ref = polyval(ts_arr,bls_ref.convert().coef)
-    # dF/F for the 405 channel
-    dFFRef = (control_arr - F0Ref)/F0Ref *100
-    #    print(dFFRef)
-    dFFnorm = dFFCa - dFFRef
-    ######################################################################################################
+def fit_modified(ts_arr,signal_arr,control_arr):
+    # fit time axis to the 465nm stream and to the 405nm stream
+    return {"signal":fit_line_2std(ts_arr,signal_arr),"control":fit_line_2std(ts_arr,control_arr)}
 
-    # find all values of the normalized DF/F that are negative so you can next shift up the curve 
-    # to make 0 the mean value for DF/F
-    negative = dFFnorm[dFFnorm<0]
-    dFF=dFFnorm-np.mean(negative)
+def get_modified_F0(fit,ts_arr,signal_arr,control_arr):
+    return fit["signal"][0]+fit["signal"][1]*ts_arr,fit["control"][0]+fit["control"][1]*ts_arr
 
-    if show_as == "Z-Score":
-        median_all = np.median(dFF)
-        mad = stats.median_abs_deviation(dFF)
-        dFF = (dFF - median_all)/mad
+def get_modified_trials_F0(ts,signal,control):
+    # 23/01 filter out signal values that are below or above 2 standard deviations from the signal mean 
+    # and fit time axis to each channel in each trial
+    intercept,slope = fit_lines_masked(ts,signal,get_2std_mask(signal))
+    F0_signal = intercept[:,np.newaxis]+slope[:,np.newaxis]*ts
+    intercept,slope = fit_lines_masked(ts,control,get_2std_mask(control))
+    F0_control = intercept[:,np.newaxis]+slope[:,np.newaxis]*ts
+    return F0_signal,F0_control
+
+def fit_huber(ts_arr,signal_arr,control_arr):
+    intercept,slope = fit_lines_huber(control_arr[np.newaxis,:],signal_arr[np.newaxis,:])
+    return {"control_to_signal":(intercept[0],slope[0])}
+
+def get_huber_trials_F0(ts,signal,control):
+    intercept,slope = fit_lines_huber(control,signal)
+    return intercept[:,np.newaxis]+slope[:,np.newaxis]*control,None
+
+def fit_airpls(ts_arr,signal_arr,control_arr):
+    # baselines are fitted to block means and interpolated back to all samples
+    fs = (len(ts_arr)-1)/(ts_arr[-1]-ts_arr[0])
+    step = max(1,int(math.ceil(AIRPLS_PERIOD_SEC*fs/AIRPLS_PERIOD_SAMPLES)))
+    decimated = downsample_tdt({"ts":ts_arr,"signal":signal_arr,"control":control_arr},step,"mean")
+    lam = get_airpls_lambda(AIRPLS_PERIOD_SEC*fs/step)
+    fit = {}
+    for channel in ["signal","control"]:
+        baseline = get_airpls_baseline(decimated[channel],lam)
+        fit[channel+"_baseline"] = np.interp(ts_arr,decimated["ts"],baseline)
+    return fit
+
+def get_airpls_F0(fit,ts_arr,signal_arr,control_arr):
+    return fit["signal_baseline"],fit["control_baseline"]
+
+def get_airpls_trials_F0(ts,signal,control):
+    # trials are shorter than the period used for the whole trace,
+    # baseline of each trial follows changes slower than the trial itself
+    fs = (len(ts)-1)/(ts[-1]-ts[0])
+    period_sec = min(AIRPLS_PERIOD_SEC,ts[-1]-ts[0])
+    step = max(1,int(math.ceil(period_sec*fs/AIRPLS_PERIOD_SAMPLES)))
+    # baselines of all signal and control trials are fitted at once to block means
+    data = np.vstack((signal,control))
+    n_blocks = len(ts)//step
+    decimated = np.mean(data[:,:n_blocks*step].reshape(len(data),n_blocks,step),axis=2)
+    decimated_ts = np.mean(ts[:n_blocks*step].reshape(n_blocks,step),axis=1)
+    # rows with values that are not finite get nan
+    finite = np.all(np.isfinite(decimated),axis=1)
+    fitted = get_airpls_baselines(decimated[finite],get_airpls_lambda(period_sec*fs/step))
+    if step > 1:
+        fitted = interp_rows(ts,decimated_ts,fitted)
+    baselines = np.full(data.shape,np.nan)
+    baselines[finite] = fitted
+    return baselines[:len(signal)],baselines[len(signal):]
+
+def fit_double_exponential(ts_arr,signal_arr,control_arr):
+    return {"signal_bleaching":fit_bleaching(ts_arr,signal_arr),
+            "control_bleaching":fit_bleaching(ts_arr,control_arr)}
+
+def get_double_exponential_F0(fit,ts_arr,signal_arr,control_arr):
+    return get_bleaching(fit["signal_bleaching"],ts_arr),get_bleaching(fit["control_bleaching"],ts_arr)
+
+def get_double_exponential_trials_F0(ts,signal,control):
+    F0 = get_bleaching_rows(ts,np.vstack((signal,control)))
+    return F0[:len(signal)],F0[len(signal):]
+
+NORMALIZATION_BACKENDS = {
+    "Standard Polynomial Fitting":{"fit":fit_standard,"F0":get_control_fit_F0,
+                                   "trials_F0":get_standard_trials_F0,"extrapolate":True},
+    "Modified Polynomial Fitting":{"fit":fit_modified,"F0":get_modified_F0,
+                                   "trials_F0":get_modified_trials_F0,"extrapolate":True},
+    "Robust Polynomial Fitting (Huber)":{"fit":fit_huber,"F0":get_control_fit_F0,
+                                         "trials_F0":get_huber_trials_F0,"extrapolate":True},
+    "airPLS Baseline":{"fit":fit_airpls,"F0":get_airpls_F0,
+                       "trials_F0":get_airpls_trials_F0,"extrapolate":False},
+    "Double Exponential Fitting":{"fit":fit_double_exponential,"F0":get_double_exponential_F0,
+                                  "trials_F0":get_double_exponential_trials_F0,"extrapolate":True}
+    }
 
-    return {"ts":ts_arr,"normalized_signal":dFF}
+def get_normalization_fit(ts_arr,signal_arr,control_arr,normalization):
+    '''Fits normalization method to the trace
+    Returns dictionary with parameters from the method's fit function,
+    (intercept,slope) of "signal" and "control" fitted to time axis
+    (lines are fitted to values within 2 standard deviations from the mean)
+    and the name of the method ("normalization")
+    '''
+    fit = NORMALIZATION_BACKENDS[normalization]["fit"](ts_arr,signal_arr,control_arr)
+    fit["normalization"] = normalization
+    # time axis lines are shown with polynomial fitting for every method
+    if "signal" not in fit:
+        fit["signal"] = fit_line_2std(ts_arr,signal_arr)
+    if "control" not in fit:
+        fit["control"] = fit_line_2std(ts_arr,control_arr)
+    return fit
+
+def get_F0(fit,ts_arr,signal_arr,control_arr,normalization):
+    '''Returns fitted signal (F0) and fitted control
+    (None if F0 of signal was fitted from control)
+    '''
+    return NORMALIZATION_BACKENDS[normalization]["F0"](fit,ts_arr,signal_arr,control_arr)
 
-# modified polynomial that uses custom baseline
-def normalize_dff_baseline(signal_dict,baseline_dict,show_as,smooth,smooth_window):
-    #####################
-    # change lists to numpy array for calculations
-    # create new timestamps for the data (from zero)
-    ts_arr = np.asarray(signal_dict["ts"])
-    signal_arr =np.asarray(signal_dict["signal"])
-    control_arr = np.asarray(signal_dict["control"])
-    print(f"All trace: first: {ts_arr[0]}, last: {ts_arr[-1]}")
-    # change baseline lists to numpy array for calculations
-    ts_baseline_arr = np.asarray(baseline_dict["ts"])
-    signal_baseline_arr =np.asarray(baseline_dict["signal"])
-    control_baseline_arr = np.asarray(baseline_dict["control"])
-    print(f"Baseline: first: {ts_baseline_arr[0]}, last: {ts_baseline_arr[-1]}")
-    if smooth == True:
-        print("Start smoothing",smooth_window)
-        a = 1
-        b = np.divide(np.ones((smooth_window,)), smooth_window)
-        control_arr = filtfilt(b, a, control_arr)
-        signal_arr = filtfilt(b, a, signal_arr)
-        control_baseline_arr = filtfilt(b, a, control_baseline_arr)
-        signal_baseline_arr = filtfilt(b, a, signal_baseline_arr)
-        print("Done smoothing")
-    ############################################################################################
-    # 23/01 filter out signal values that are below or above 2 standard deviations from the signal mean 
-    mean_baseline_signal = np.mean(signal_baseline_arr)
-    stdev_baseline_signal = np.std(signal_baseline_arr)
-    mean_baseline_control = np.mean(control_baseline_arr)
-    stdev_baseline_control = np.std(control_baseline_arr)
-    indexes_signal = np.where((signal_baseline_arr<mean_baseline_signal+2*stdev_baseline_signal) & (signal_baseline_arr>mean_baseline_signal-2*stdev_baseline_signal))
-    selected_signal = signal_baseline_arr[indexes_signal]
-    selected_ts_baseline_signal_arr = ts_baseline_arr[indexes_signal]
-    indexes_control = np.where((control_baseline_arr<mean_baseline_control+2*stdev_baseline_control) & (control_baseline_arr>mean_baseline_control-2*stdev_baseline_control))
-    selected_control = control_baseline_arr[indexes_control]
-    selected_ts_baseline_control_arr = ts_baseline_arr[indexes_control]
-    # fit time axis to the 465nm stream  
-    bls_Ca = np.polynomial.polynomial.Polynomial.fit(selected_ts_baseline_signal_arr,selected_signal,1)
-    bls_ref = np.polynomial.polynomial.Polynomial.fit(selected_ts_baseline_control_arr,selected_control,1)
-    F0Ca = polyval(ts_arr,bls_Ca.convert().coef)
+def get_trials_F0(ts,signal,control,normalization):
+    '''Returns F0 of signal and control for each trial (row) like get_F0
+    '''
+    backend = NORMALIZATION_BACKENDS[normalization]
+    if "trials_F0" in backend:
+        return backend["trials_F0"](ts,signal,control)
+    # backend without trials_F0: fit each trial separately
+    F0_signal = np.empty(signal.shape)
+    # the first trial decides if F0 of control is used for all of them
+    fit = backend["fit"](ts,signal[0],control[0])
+    F0_signal[0],first_F0_control = backend["F0"](fit,ts,signal[0],control[0])
+    F0_control = None if first_F0_control is None else np.empty(control.shape)
+    if F0_control is not None:
+        F0_control[0] = first_F0_control
+    for i in range(1,len(signal)):
+        fit = backend["fit"](ts,signal[i],control[i])
+        F0_signal[i],trial_F0_control = backend["F0"](fit,ts,signal[i],control[i])
+        if F0_control is not None:
+            if trial_F0_control is None:
+                raise ValueError(normalization+" returned no F0 of control for trial "+str(i+1))
+            F0_control[i] = trial_F0_control
+    return F0_signal,F0_control
+
+def get_dff(signal_arr,control_arr,F0_signal,F0_control):
+    '''Returns dF/F (in %) of signal or, if F0 of control is not None,
+    dF/F of signal minus dF/F of control
+    '''
+    if F0_control is None:
+        return (signal_arr - F0_signal)/F0_signal * 100
     # dF/F for the 465 channel
-    dFFCa = (signal_arr - F0Ca)/F0Ca *100
-    F0Ref = polyval(ts_arr,bls_ref.convert().coef)
+    dFF_signal = (signal_arr - F0_signal)/F0_signal *100
     # dF/F for the 405 channel
-    dFFRef = (control_arr - F0Ref)/F0Ref *100
-    #    print(dFFRef)
-    dFFnorm = dFFCa - dFFRef
-    ######################################################################################################
-#     # fit time axis to the 465nm stream  
-#     bls_Ca = np.polynomial.polynomial.Polynomial.fit(ts_baseline_arr,signal_baseline_arr,1)
-# #    print("bls_Ca",bls_Ca.convert().coef[::-1])
-#     F0Ca = polyval(ts_arr,bls_Ca.convert().coef)
-#     # dF/F for the 465 channel
-#     dFFCa = (signal_arr - F0Ca)/F0Ca *100
-#     # fit time axis the 405nm stream
-#     bls_ref = np.polynomial.polynomial.Polynomial.fit(ts_baseline_arr,control_baseline_arr,1)
-#     F0Ref = polyval(ts_arr,bls_ref.convert().coef)
-#     # dF/F for the 405 channel
-#     dFFRef = (control_arr - F0Ref)/F0Ref *100
-# #    print(dFFRef)
-#     dFFnorm = dFFCa - dFFRef
-#     # find all values of the normalized DF/F that are negative so you can next shift up the curve 
-#     # to make 0 the mean value for DF/F
-#     # negative = dFFnorm[dFFnorm<0]
-#     # dFF=dFFnorm-np.mean(negative)
-    ###########################################
-    # fix the shift towards zero
-    # get fragment of length baseline
-    # print(f"Baseline signal mean: {mean_baseline_signal}, Baseline control mean: {mean_baseline_control}")
-    # print(f"Median before shift: {np.median(dFFnorm)}, MAD before shit: {stats.median_abs_deviation(dFFnorm)}")
-    baseline_normalized = dFFnorm[:len(ts_baseline_arr)]
-    negative_baseline = baseline_normalized[baseline_normalized<0]
-    dFF = dFFnorm - np.mean(negative_baseline)
-    ###########################################
-
-    if show_as == "Z-Score":
-        median_all = np.median(dFF)
-        mad = stats.median_abs_deviation(dFF)
-        dFF = (dFF - median_all)/mad
-        # print(f"Median: {median_all}, MAD: {mad}")
-
-    return {"ts":ts_arr,"normalized_signal":dFF}
+    dFF_control = (control_arr - F0_control)/F0_control *100
+    return dFF_signal - dFF_control
 
+def fit_lines_weighted(x,y,weights):
+    '''Weighted least squares fit of a line y = intercept + slope*x to each row of y
+    x can be a single row shared by all rows of y
+    Returns arrays of intercepts and slopes (one per row)
+    '''
+    x = np.broadcast_to(x,y.shape)
+    sum_weights = np.sum(weights,axis=1)
+    mean_x = np.sum(weights*x,axis=1)/sum_weights
+    mean_y = np.sum(weights*y,axis=1)/sum_weights
+    dx = x-mean_x[:,np.newaxis]
+    slope = np.sum(weights*dx*(y-mean_y[:,np.newaxis]),axis=1)/np.sum(weights*dx*dx,axis=1)
+    intercept = mean_y-slope*mean_x
+    return intercept,slope
+
+def fit_lines_huber(x,y,max_iter=IRLS_MAX_ITER,tolerance=1e-8):
+    '''Robust fit of a line y = intercept + slope*x to each row of y (Huber loss)
+    with iteratively reweighted least squares starting from ordinary least squares
+    x can be a single row shared by all rows of y
+    Returns arrays of intercepts and slopes (one per row)
+    '''
+    x = np.broadcast_to(x,y.shape)
+    intercept,slope = fit_lines_weighted(x,y,np.ones(y.shape))
+    for i in range(max_iter):
+        residuals = np.abs(y-intercept[:,np.newaxis]-slope[:,np.newaxis]*x)
+        # robust standard deviation of residuals of each row
+        scale = get_median_mad(residuals,axis=1,scale='normal')[1][:,np.newaxis]
+        scale[scale == 0] = np.finfo(float).eps
+        # weight 1 for small residuals, k*scale/|residual| for outliers
+        weights = np.minimum(1,HUBER_K*scale/np.maximum(residuals,np.finfo(float).tiny))
+        new_intercept,new_slope = fit_lines_weighted(x,y,weights)
+        converged = (np.allclose(new_slope,slope,rtol=tolerance,atol=0) 
+                     and np.allclose(new_intercept,intercept,rtol=tolerance,atol=0))
+        intercept,slope = new_intercept,new_slope
+        if converged:
+            break
+    return intercept,slope
+
+# smoothing parameter of Whittaker smoother that follows changes slower than period (in samples)
+# (half power frequency response of second differences penalty is at 1/(2*pi*lambda**0.25) per sample)
+def get_airpls_lambda(period_samples):
+    return (period_samples/(2*np.pi))**4
+
+def whittaker_smooth(data,weights,lam):
+    '''Weighted Whittaker smoother with second differences penalty
+    solves (W + lam*D'D)z = Wy using banded Cholesky factorization
+    data and weights can be 2-D, then each row is smoothed separately
+    (rows are solved at once as one block diagonal system)
+    '''
+    rows = np.atleast_2d(data)
+    n = rows.shape[1]
+    # upper diagonals of lam*D'D for one row
+    banded = np.zeros((3,n))
+    banded[0,2:] = lam
+    banded[1,1:] = -4*lam
+    banded[1,1] = banded[1,-1] = -2*lam
+    banded[2,:] = 6*lam
+    banded[2,0] = banded[2,-1] = lam
+    banded[2,1] = banded[2,-2] = 5*lam
+    # the first two diagonals are 0 at the beginning of each row, so rows are not connected
+    banded = np.tile(banded,len(rows))
+    weights = np.ravel(weights)
+    banded[2,:] += weights
+    return solveh_banded(banded,weights*rows.ravel()).reshape(np.shape(data))
+
+def get_airpls_baseline(data,lam,max_iter=AIRPLS_MAX_ITER):
+    '''Adaptive iteratively reweighted penalized least squares baseline (airPLS)
+    Zhang, Chen and Liang (2010), Analyst 135(5):1138-1146
+    '''
+    return get_airpls_baselines(np.asarray(data,dtype=float)[np.newaxis,:],lam,max_iter)[0]
 
-# https://github.com/djamesbarker/pMAT
-def normalize_pMat(signal_dict,show_as,smooth,smooth_window):
+def get_airpls_baselines(data,lam,max_iter=AIRPLS_MAX_ITER):
+    '''airPLS baseline of each row of 2-D data (see get_airpls_baseline)
+    rows that did not converge yet are fitted together in each iteration
+    '''
+    data = np.asarray(data,dtype=float)
+    weights = np.ones(data.shape)
+    baselines = np.empty(data.shape)
+    # stop when negative residuals are small compared with deviations from the mean
+    # (not with the data itself like in the paper, fluorescence has large offset)
+    abs_sum = np.sum(np.abs(data-np.mean(data,axis=1)[:,np.newaxis]),axis=1)
+    active = np.arange(len(data))
+    for i in range(1,max_iter+1):
+        if len(active) == 0:
+            break
+        baselines[active] = whittaker_smooth(data[active],weights[active],lam)
+        difference = data[active]-baselines[active]
+        below = difference<0
+        negative_sum = np.sum(np.abs(difference),axis=1,where=below)
+        converged = (np.any(below,axis=1) == False) | (negative_sum < 0.001*abs_sum[active])
+        active = active[~converged]
+        if len(active) == 0:
+            break
+        difference = difference[~converged]
+        below = below[~converged]
+        negative_sum = negative_sum[~converged][:,np.newaxis]
+        # points above baseline are treated as peaks, points below get larger weights in each iteration
+        weights[active] = np.where(below,np.exp(i*np.abs(difference)/negative_sum),0)
+        max_negative = np.max(difference,axis=1,where=below,initial=-np.inf)[:,np.newaxis]
+        weights[active[:,np.newaxis],[0,-1]] = np.exp(i*max_negative/negative_sum)
+    return baselines
+
+# linear interpolation of each row of data (sampled at ts) at new_ts like np.interp
+def interp_rows(new_ts,ts,data):
+    idx = np.clip(np.searchsorted(ts,new_ts,side="right")-1,0,len(ts)-2)
+    weight = np.clip((new_ts-ts[idx])/(ts[idx+1]-ts[idx]),0,1)
+    return data[:,idx]*(1-weight)+data[:,idx+1]*weight
+
+def get_bleaching(params,ts_arr):
+    t0,tau_fast,tau_slow,offset,amplitude_fast,amplitude_slow = params
+    t = ts_arr-t0
+    return offset+amplitude_fast*np.exp(-t/tau_fast)+amplitude_slow*np.exp(-t/tau_slow)
+
+def get_bleaching_rows(ts_arr,data):
+    '''Returns double exponential decay offset + a1*exp(-t/tau1) + a2*exp(-t/tau2)
+    fitted to each row of 2-D data (i.e. trials) with time axis ts_arr shared by all rows
+    Time constants are chosen from BLEACHING_TRIAL_TAUS log spaced values (in the range used by fit_bleaching),
+    amplitudes are fitted with least squares to all rows at once for each pair of them
+    Rows with values that are not finite get nan
+    '''
+    step = max(1,len(ts_arr)//BLEACHING_FIT_SAMPLES)
+    t = ts_arr-ts_arr[0]
+    duration = t[-1]
+    taus = np.geomspace(max(t[step],duration/1000),duration*100,BLEACHING_TRIAL_TAUS)
+    finite = np.all(np.isfinite(data),axis=1)
+    y = np.asarray(data[finite,::step],dtype=float).T
+    best_cost = np.full(y.shape[1],np.inf)
+    best_taus = np.zeros((2,y.shape[1]))
+    best_coefficients = np.zeros((3,y.shape[1]))
+    for i in range(len(taus)):
+        for j in range(i,len(taus)):
+            design = np.column_stack((np.ones(len(t)),np.exp(-t/taus[i]),np.exp(-t/taus[j])))[::step]
+            coefficients = np.linalg.lstsq(design,y,rcond=None)[0]
+            cost = np.sum((design@coefficients-y)**2,axis=0)
+            better = cost < best_cost
+            best_cost[better] = cost[better]
+            best_taus[:,better] = [[taus[i]],[taus[j]]]
+            best_coefficients[:,better] = coefficients[:,better]
+    F0 = np.full(data.shape,np.nan)
+    F0[finite] = (best_coefficients[0][:,np.newaxis]
+                  +best_coefficients[1][:,np.newaxis]*np.exp(-t/best_taus[0][:,np.newaxis])
+                  +best_coefficients[2][:,np.newaxis]*np.exp(-t/best_taus[1][:,np.newaxis]))
+    return F0
+
+def fit_bleaching(ts_arr,data):
+    '''Fits double exponential decay offset + a1*exp(-t/tau1) + a2*exp(-t/tau2)
+    with t from the first sample
+    Time constants are optimized and amplitudes are fitted with least squares for each of them
+    Returns (t0,tau1,tau2,offset,a1,a2)
+    '''
+    # bleaching is slow, fit decimated trace
+    step = max(1,len(ts_arr)//BLEACHING_FIT_SAMPLES)
+    t = ts_arr[::step]-ts_arr[0]
+    y = np.asarray(data[::step],dtype=float)
+    duration = t[-1]
+    min_tau = max(t[1],duration/1000)
+    max_tau = duration*100
+    def get_coefficients(log_taus):
+        taus = np.clip(np.exp(log_taus),min_tau,max_tau)
+        design = np.column_stack((np.ones(len(t)),np.exp(-t/taus[0]),np.exp(-t/taus[1])))
+        coefficients = np.linalg.lstsq(design,y,rcond=None)[0]
+        return taus,coefficients,np.sum((design@coefficients-y)**2)
+    try:
+        result = minimize(lambda log_taus: get_coefficients(log_taus)[2],np.log([duration/10,duration]),method='Nelder-Mead')
+        taus,coefficients,cost = get_coefficients(result.x)
+        if not np.all(np.isfinite(coefficients)):
+            raise ValueError("Double exponential fit failed")
+    except:
+        print("Double exponential fit failed, fitting a line")
+        intercept,slope = fit_lines_weighted(t,y[np.newaxis,:],np.ones((1,len(y))))
+        # a line is a slow exponential with offset
+        tau = max_tau
+        return (ts_arr[0],tau,tau,intercept[0]+slope[0]*tau,-slope[0]*tau,0)
+    return (ts_arr[0],taus[0],taus[1],coefficients[0],coefficients[1],coefficients[2])
+
+def normalize_trace(signal_dict,baseline_dict,normalization,show_as,smooth,smooth_window):
+    '''Normalization of the whole trace used by normalize_dff, normalize_pMat and their baseline variants
+    Lines are fitted to baseline_dict data if it is not None, otherwise to the whole trace
+    Returns dictionary with ts, normalized_signal and fit (from get_normalization_fit)
+    '''
     # change lists to numpy array for calculations
     ts_arr = np.asarray(signal_dict["ts"])
     signal_arr =np.asarray(signal_dict["signal"])
     control_arr = np.asarray(signal_dict["control"])
+    if baseline_dict != None and NORMALIZATION_BACKENDS[normalization]["extrapolate"] == False:
+        print(normalization+" is fitted to the whole trace (custom baseline is not used)")
+        baseline_dict = None
+    if baseline_dict != None:
+        print(f"All trace: first: {ts_arr[0]}, last: {ts_arr[-1]}")
+        # change baseline lists to numpy array for calculations
+        ts_baseline_arr = np.asarray(baseline_dict["ts"])
+        signal_baseline_arr =np.asarray(baseline_dict["signal"])
+        control_baseline_arr = np.asarray(baseline_dict["control"])
+        print(f"Baseline: first: {ts_baseline_arr[0]}, last: {ts_baseline_arr[-1]}")
     if smooth == True:
         print("Start smoothing",smooth_window)
-        a = 1
-        b = np.divide(np.ones((smooth_window,)), smooth_window)
-        control_arr = filtfilt(b, a, control_arr)
-        signal_arr = filtfilt(b, a, signal_arr)
+        control_arr = smooth_data(control_arr,smooth_window)
+        signal_arr = smooth_data(signal_arr,smooth_window)
+        if baseline_dict != None:
+            control_baseline_arr = smooth_data(control_baseline_arr,smooth_window)
+            signal_baseline_arr = smooth_data(signal_baseline_arr,smooth_window)
         print("Done smoothing")
-        
-        
-    # Before
-#    bls = np.polyfit(control_arr, signal_arr, 1)
-#    fit_line = np.multiply(bls[0], control_arr) + bls[1]
-#    dff = (signal_arr - fit_line)/fit_line * 100
-        
-    # Before filtering out +/- 2xstdev
-#     # https://stackoverflow.com/questions/45338872/matlab-polyval-function-with-three-outputs-equivalent-in-python-numpy
-#     mu = np.mean(control_arr)
-#     std = np.std(control_arr, ddof=0)
-#     # Call np.polyfit(), using the shifted and scaled version of control_arr
-# #    cscaled = np.polyfit((control_arr - mu)/std, signal_arr, 1) # depreciated
-#     cscaled = np.polynomial.polynomial.Polynomial.fit((control_arr - mu)/std, signal_arr, 1)
-#     # Create a poly1d object that can be called
-# #    pscaled = np.poly1d(cscaled) # old obsolete function
-#     # https://numpy.org/doc/stable/reference/routines.polynomials.html
-#     pscaled = Polynomial(cscaled.convert().coef)
-#     # Inputs to pscaled must be shifted and scaled using mu and std
-#     F0 = pscaled((control_arr - mu)/std)
-# #    print("F0?",F0[:20])
-#     dffnorm = (signal_arr - F0)/F0 * 100
-
-    #############################################################################################
-    # filter out signal values that are below or above 2 standard deviations from the signal mean 
-    mean_signal = np.mean(signal_arr)
-    stdev_signal = np.std(signal_arr)
-    indexes = np.where((signal_arr<mean_signal+2*stdev_signal) & (signal_arr>mean_signal-2*stdev_signal))
-    selected_signal = signal_arr[indexes]
-    selected_control = control_arr[indexes]
-    mu = np.mean(selected_control)
-    std = np.std(selected_control)
-    cscaled = np.polynomial.polynomial.Polynomial.fit((selected_control - mu)/std, selected_signal, 1)
-    pscaled = Polynomial(cscaled.convert().coef)
-    F0 = pscaled((control_arr - mu)/std)
-    dffnorm = (signal_arr - F0)/F0 * 100
-    #################################################################################################
+    # 23/01 filter out signal values that are below or above 2 standard deviations from the signal mean
+    if baseline_dict != None:
+        fit = get_normalization_fit(ts_baseline_arr,signal_baseline_arr,control_baseline_arr,normalization)
+    else:
+        fit = get_normalization_fit(ts_arr,signal_arr,control_arr,normalization)
+    F0_signal,F0_control = get_F0(fit,ts_arr,signal_arr,control_arr,normalization)
+    dFFnorm = get_dff(signal_arr,control_arr,F0_signal,F0_control)
     # find all values of the normalized DF/F that are negative so you can next shift up the curve 
     # to make 0 the mean value for DF/F
-    negative = dffnorm[dffnorm<0]
-    dff=dffnorm-np.mean(negative)
+    # (with custom baseline only values in the fragment of length baseline are used)
+    if baseline_dict != None:
+        baseline_normalized = dFFnorm[:len(ts_baseline_arr)]
+        negative = baseline_normalized[baseline_normalized<0]
+    else:
+        negative = dFFnorm[dFFnorm<0]
+    dFF = dFFnorm-np.mean(negative)
 
     if show_as == "Z-Score":
-        median_all = np.median(dff)
-        mad = stats.median_abs_deviation(dff)
-        dff = (dff - median_all)/mad
+        median_all,mad = get_median_mad(dFF)
+        dFF -= median_all
+        dFF /= mad
 
-    return {"ts":ts_arr,"normalized_signal":dff}
+    return {"ts":ts_arr,"normalized_signal":dFF,"fit":fit}
 
-# function uses a custom baseline range to fit all of the data later
-def normalize_pMat_custom_baseline(signal_dict,baseline_dict,show_as,smooth,smooth_window):
-    # change lists to numpy array for calculations
-    ts_arr = np.asarray(signal_dict["ts"])
-    signal_arr =np.asarray(signal_dict["signal"])
-    control_arr = np.asarray(signal_dict["control"])
-    print(f"All trace: first: {ts_arr[0]}, last: {ts_arr[-1]}")
-    # change baseline lists to numpy array for calculations
-    ts_baseline_arr = np.asarray(baseline_dict["ts"])
-    signal_baseline_arr =np.asarray(baseline_dict["signal"])
-    control_baseline_arr = np.asarray(baseline_dict["control"])
-    print(f"Baseline: first: {ts_baseline_arr[0]}, last: {ts_baseline_arr[-1]}")
-    if smooth == True:
-        print("Start smoothing",smooth_window)
-        a = 1
-        b = np.divide(np.ones((smooth_window,)), smooth_window)
-        control_arr = filtfilt(b, a, control_arr)
-        signal_arr = filtfilt(b, a, signal_arr)
-        control_baseline_arr = filtfilt(b, a, control_baseline_arr)
-        signal_baseline_arr = filtfilt(b, a, signal_baseline_arr)
-        print("Done smoothing")
-        
-  
-    #############################################################################################
-    # filter out signal values that are below or above 2 standard deviations from the signal mean  
-    mean_baseline_signal = np.mean(signal_baseline_arr)
-    stdev_baseline_signal = np.std(signal_baseline_arr)
-    indexes = np.where((signal_baseline_arr<mean_baseline_signal+2*stdev_baseline_signal) & (signal_baseline_arr>mean_baseline_signal-2*stdev_baseline_signal))
-    selected_signal = signal_baseline_arr[indexes]
-    selected_control = control_baseline_arr[indexes]
-    mu = np.mean(selected_control)
-    std = np.std(selected_control)
-    cscaled = np.polynomial.polynomial.Polynomial.fit((selected_control - mu)/std, selected_signal, 1)
-    pscaled = Polynomial(cscaled.convert().coef)
-    F0 = pscaled((control_arr - mu)/std)
-    dffnorm = (signal_arr - F0)/F0 * 100
-    ######################################################################################################
-    # # https://stackoverflow.com/questions/45338872/matlab-polyval-function-with-three-outputs-equivalent-in-python-numpy
-    # mu = np.mean(control_baseline_arr)
-    # std = np.std(control_baseline_arr, ddof=0)
-    # # Call np.polyfit(), using the shifted and scaled version of control_arr
-    # cscaled = np.polynomial.polynomial.Polynomial.fit((control_baseline_arr - mu)/std, signal_baseline_arr, 1)
-    # # Create a poly1d object that can be called
-    # # https://numpy.org/doc/stable/reference/routines.polynomials.html
-    # pscaled = Polynomial(cscaled.convert().coef)
-    # # Inputs to pscaled must be shifted and scaled using mu and std
-    # F0 = pscaled((control_arr - mu)/std)
-    # dffnorm = (signal_arr - F0)/F0 * 100
-    # # find all values of the normalized DF/F that are negative so you can next shift up the curve 
-    # # to make 0 the mean value for DF/F
-    # # negative = dffnorm[dffnorm<0]
-    # # dff=dffnorm-np.mean(negative)
-
-    ###########################################
-    # fix the shift towards zero
-    # get fragment of length baseline
-    baseline_normalized = dffnorm[:len(ts_baseline_arr)]
-    negative_baseline = baseline_normalized[baseline_normalized<0]
-    dff = dffnorm - np.mean(negative_baseline)
-    ###########################################
+# modified polynomial
+def normalize_dff(signal_dict,show_as,smooth,smooth_window):
+    return normalize_trace(signal_dict,None,'Modified Polynomial Fitting',show_as,smooth,smooth_window)
 
-    if show_as == "Z-Score":
-        median_all = np.median(dff)
-        mad = stats.median_abs_deviation(dff)
-        dff = (dff - median_all)/mad
+# modified polynomial that uses custom baseline
+def normalize_dff_baseline(signal_dict,baseline_dict,show_as,smooth,smooth_window):
+    return normalize_trace(signal_dict,baseline_dict,'Modified Polynomial Fitting',show_as,smooth,smooth_window)
+
+# https://github.com/djamesbarker/pMAT
+def normalize_pMat(signal_dict,show_as,smooth,smooth_window):
+    return normalize_trace(signal_dict,None,'Standard Polynomial Fitting',show_as,smooth,smooth_window)
 
-    return {"ts":ts_arr,"normalized_signal":dff}
+# function uses a custom baseline range to fit all of the data later
+def normalize_pMat_custom_baseline(signal_dict,baseline_dict,show_as,smooth,smooth_window):
+    return normalize_trace(signal_dict,baseline_dict,'Standard Polynomial Fitting',show_as,smooth,smooth_window)
 
 # modified tdt function to handle special Cam1 case with notes
 def my_epoc_filter(data, epoc, *, values=None, t=None, tref=False, keepdata=True):
@@ -874,90 +1248,254 @@ def my_epoc_filter(data, epoc, *, values=None, t=None, tref=False, keepdata=True
 
 #https://www.tdt.com/support/python-sdk/offline-analysis-examples/fiber-photometry-epoch-averaging-example/
 def filter_data_around_event(raw_data,perievent_options_dict,settings_dict,signal_name,control_name):
-    event_name_split = perievent_options_dict["event"].split(" ")
-    before = -perievent_options_dict["sec_before"]
-    till = perievent_options_dict["sec_before"]+perievent_options_dict["sec_after"]+0.1
-    trange = [before,till]
-    if event_name_split[0] == 'Cam1': # special case
-        # find values = indexes of timestamps
-        my_values = []
-        data = raw_data.epocs[event_name_split[0]]
-        my_onsets = []
-        try:
-            my_onsets = data.notes.ts
-        except:
-            my_onsets = []
-        if len(my_onsets) > 0:
-            all_values = data.data
-            all_ts = data.onset
-            indexes = []
-            for el in my_onsets:
-                try:
-                    idx = np.where(all_ts == el)
-                    indexes.append(int(idx[0][0]))
-                except:
-                    print("Onset not found")
-            if len(indexes) > 0:
-                for el in indexes:
-                    my_values.append(all_values[el])
-                print(f"my_values {my_values}")
-                modified_data= my_epoc_filter(raw_data, event_name_split[0], values = my_values, t=trange, tref=True)
-    try:    # some data was not readable by tdt.epoc_filter
-        modified_data= tdt.epoc_filter(raw_data, event_name_split[0], t=trange, values=[int(event_name_split[1])], tref=True)
-    except: 
-        print("Problem getting on off event data by tdt.epoc_filter")
-        print(event_name_split[0]) # some names end with _ and that gets replaced in data tank
-        if event_name_split[0][-1] == "_":
-            adjusted_name = event_name_split[0][:-1]+"/"
-            print(adjusted_name)
-            modified_data= tdt.epoc_filter(raw_data, adjusted_name, t=trange, values=[int(event_name_split[1])], tref=True)
-    all_control_filtered = modified_data.streams[control_name].filtered
-    all_signal_filtered = modified_data.streams[signal_name].filtered
-    modified_data.streams[signal_name].filtered = all_signal_filtered
-    modified_data.streams[control_name].filtered = all_control_filtered
-    '''Applying a time filter to a uniformly sampled signal means that the length 
-        of each segment could vary by one sample. Let's find the minimum length 
-        so we can trim the excess off before calculating the median.
-        '''
-    if len(all_signal_filtered) > 0: # sometimes the first and only event gave empty list after filtering
-        min1 = np.min([np.size(x) for x in modified_data.streams[signal_name].filtered])
-        min2 = np.min([np.size(x) for x in modified_data.streams[control_name].filtered])
-        modified_data.streams[signal_name].filtered = [x[1:min1] for x in modified_data.streams[signal_name].filtered]
-        modified_data.streams[control_name].filtered = [x[1:min2] for x in modified_data.streams[control_name].filtered]
-    else:
+    '''Returns data structure like tdt.epoc_filter, where streams[signal_name] and streams[control_name] have:
+    filtered: (n_trials,n_samples) array with raw data around each event
+    filtered_downsampled: (n_trials,n_samples) array with the same data downsampled to settings rate
+    '''
+    # filter only epocs to get time ranges of all valid events,
+    # streams are cut out later from the original data by index
+    modified_data = filter_epocs_around_event(raw_data,perievent_options_dict)
+    modified_data.streams = tdt.StructType()
+    for name in [signal_name,control_name]:
+        modified_data.streams[name] = tdt.StructType()
+        for key in raw_data.streams[name].keys():
+            if key != "data":
+                modified_data.streams[name][key] = raw_data.streams[name][key]
+        onsets,lengths = get_stream_windows(raw_data.streams[name],modified_data.time_ranges)
+        modified_data.streams[name].onsets = onsets
+        modified_data.streams[name].filtered = np.zeros((0,0))
+        if len(onsets) > 0:
+            '''Applying a time filter to a uniformly sampled signal means that the length 
+            of each segment could vary by one sample. Let's find the minimum length 
+            so we can trim the excess off before calculating the median.
+            '''
+            # skip the first sample of each window like before
+            modified_data.streams[name].filtered = get_epochs(raw_data.streams[name].data,onsets+1,np.min(lengths)-1)
+    if len(modified_data.streams[signal_name].filtered) == 0: # sometimes the first and only event gave empty list after filtering
         print("Not enough data that satisfy your request. Try changing event or times around event.")
         return modified_data
     # downsample data as well
     N = settings_dict[0]["downsample"] 
-    
-    control = []
-    signal = []
     fs = get_frequency(raw_data,signal_name)
     try:
-        for lst in modified_data.streams[control_name].filtered:
-            ts = np.linspace(1, len(lst), len(lst))/fs
-            # round last time to full integer
-            last = math.floor(ts[-1])
-            # make new times till total expected
-            ts_adjusted = np.linspace(1/N,last,last*N)
-            control_interpolated = interp1d(ts, lst)
-            resampled_data = control_interpolated(ts_adjusted)
-            control.append(resampled_data)
-        for lst in modified_data.streams[signal_name].filtered:
-            ts = np.linspace(1, len(lst), len(lst))/fs
-            # round last time to full integer
-            last = math.floor(ts[-1])
-            ts_adjusted = np.linspace(1/N,last,last*N)
-            signal_interpolated = interp1d(ts, lst)
-            resampled_data = signal_interpolated(ts_adjusted)
-            signal.append(resampled_data)
-        modified_data.streams[signal_name].filtered_downsampled = signal
-        modified_data.streams[control_name].filtered_downsampled = control   
+        for name in [signal_name,control_name]:
+            modified_data.streams[name].filtered_downsampled = resample_epochs(modified_data.streams[name].filtered,fs,N)
     except:
         print("Not enough data that satisfy your request. Try changing event or times around event.")
     
     return modified_data
 
+# epocs of raw_data with time_ranges like tdt.epoc_filter around perievent_options_dict["event"]
+# (time_ranges are the windows around each event onset)
+def filter_epocs_around_event(raw_data,perievent_options_dict):
+    before = -perievent_options_dict["sec_before"]
+    till = perievent_options_dict["sec_before"]+perievent_options_dict["sec_after"]+0.1
+    onsets = np.asarray(get_event_on_off(raw_data,perievent_options_dict["event"])[0],dtype=np.float64)
+    time_ranges = np.vstack((onsets+before,onsets+before+till))
+    # throw away negative time ranges
+    if np.all(~np.isnan(time_ranges)):
+        time_ranges = time_ranges[:,time_ranges[0,:]>0]
+    modified_data = get_epocs_only(raw_data)
+    modified_data.time_ranges = time_ranges
+    modified_data.time_ref = [before,till]
+    return modified_data
+
+# copy of tdt data structure without any streams, snips or scalars
+# (filtering it by epocs is much faster than filtering all data)
+def get_epocs_only(raw_data):
+    epocs_data = tdt.StructType()
+    for key in raw_data.keys():
+        if key in ["streams","snips","scalars"]:
+            epocs_data[key] = tdt.StructType()
+        else:
+            epocs_data[key] = raw_data[key]
+    return epocs_data
+
+def get_stream_windows(stream,time_ranges,n_samples=None):
+    '''Returns first sample index and number of samples in stream data
+    of each time range (the same way tdt.epoc_filter cuts streams)
+    Time ranges that extend beyond recording are skipped.
+    If stream data is not read, n_samples has to be given
+    '''
+    if time_ranges.shape[1] == 0:
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+    sf = 1/(2.56e-6*stream.fs)
+    td_sample = int(np.uint64(stream.start_time/2.56e-6))
+    max_ind = n_samples if n_samples != None else max(stream.data.shape)
+    tlo_sample = (time_ranges[0,:]/2.56e-6).astype(np.uint64).astype(np.int64)
+    onsets = np.maximum(np.round((tlo_sample-td_sample)/sf),0).astype(np.int64)
+    # open ended time range goes till the end of recording
+    offsets = np.full(len(onsets),max_ind,dtype=np.int64)
+    finite = np.isfinite(time_ranges[1,:])
+    thi_sample = (time_ranges[1,finite]/2.56e-6).astype(np.uint64).astype(np.int64)
+    offsets[finite] = np.maximum(np.round((thi_sample-td_sample)/sf),0).astype(np.int64)
+    valid = (onsets <= max_ind) & (offsets <= max_ind)
+    return onsets[valid],offsets[valid]-onsets[valid]
+
+# (n_trials,n_samples) array with n_samples of data starting at each of first_samples
+def get_epochs(data,first_samples,n_samples):
+    indexes = first_samples[:,np.newaxis]+np.arange(max(n_samples,0))[np.newaxis,:]
+    return np.asarray(data)[indexes]
+
+def resample_epochs(epochs,fs,target_Hz):
+    '''Linear interpolation of all trials at once from fs to target_Hz
+    Times of each trial start at 1/fs and new times at 1/target_Hz till the last full second
+    '''
+    n_samples = epochs.shape[1]
+    ts = get_time_axis(float(fs),n_samples)
+    # round last time to full integer
+    last = math.floor(ts[-1])
+    # make new times till total expected
+    ts_adjusted = np.linspace(1/target_Hz,last,last*target_Hz)
+    # the same neighbours and weights for all trials (like scipy's interp1d)
+    hi = np.clip(np.searchsorted(ts,ts_adjusted),1,n_samples-1)
+    lo = hi-1
+    slope = (epochs[:,hi]-epochs[:,lo])/(ts[hi]-ts[lo])
+    return slope*(ts_adjusted-ts[lo])+epochs[:,lo]
+
+def get_normalized_around_event(normalized_dict,first_times,n_samples,target_Hz):
+    '''Cuts n_samples long windows out of the whole trace normalized signal by index
+    first_times are times (on normalized_dict["ts"] time axis) of the first sample of each window
+    Returns (n_trials,n_samples) array
+    or empty array if the trace is not sampled at target_Hz
+    or any of the windows does not fit in the normalized trace (i.e. trimmed)
+    '''
+    ts = np.asarray(normalized_dict["ts"])
+    first_times = np.asarray(first_times)
+    if len(first_times) == 0 or len(ts) < 2:
+        return np.zeros((0,0))
+    interval = (ts[-1]-ts[0])/(len(ts)-1)
+    if abs(interval*target_Hz-1) > TRACE_INTERVAL_TOLERANCE:
+        print("Normalized trace is not sampled at",target_Hz,"Hz")
+        return np.zeros((0,0))
+    # nearest sample of the normalized trace
+    first = np.searchsorted(ts,first_times-interval/2)
+    if (first[-1]+n_samples > len(ts)) or np.any(np.abs(ts[np.minimum(first,len(ts)-1)]-first_times) > interval):
+        return np.zeros((0,0))
+    return get_epochs(normalized_dict["normalized_signal"],first,n_samples)
+
+def add_normalized_around_event(data,normalized_dict,settings_dict,signal_name):
+    '''Adds windows cut from the whole trace normalized signal to data from filter_data_around_event
+    as data["normalized"] (the same trials and samples as filtered_downsampled)
+    Returns True if all windows were found in the normalized trace
+    '''
+    try:
+        stream = data.streams[signal_name]
+        n_samples = stream.filtered_downsampled.shape[1]
+    except:
+        return False
+    # first downsampled sample of each trial is 1/N after the first raw sample of the window
+    first_times = (stream.onsets+1)/stream.fs+1/settings_dict[0]["downsample"]
+    data["normalized"] = get_normalized_around_event(normalized_dict,first_times,n_samples,settings_dict[0]["downsample"])
+    if len(data["normalized"]) == 0:
+        print("Events too close to the trimmed part of the recording. Each trial will be normalized separately.")
+        return False
+    return True
+
+# numbers of trials (from 1) that have data
+# (in chunked mode trials too close to the trimmed part of the recording are all nan)
+def get_available_trials(data,signal_name):
+    filtered = data.streams[signal_name].filtered_downsampled
+    try:
+        filtered = np.asarray(filtered,dtype=np.float64).reshape(len(filtered),-1)
+    except:
+        return [i+1 for i in range(len(filtered))]
+    return [int(i)+1 for i in np.flatnonzero(~np.all(np.isnan(filtered),axis=1))]
+
+# normalized windows added by add_normalized_around_event (empty list if there are none)
+def get_normalized_perievent_data(data):
+    try:
+        return data["normalized"]
+    except:
+        return []
+
+# True for values within 2 standard deviations from the mean of each row
+def get_2std_mask(data):
+    mean = np.mean(data,axis=1)[:,np.newaxis]
+    stdev = np.std(data,axis=1)[:,np.newaxis]
+    return (data<mean+2*stdev) & (data>mean-2*stdev)
+
+def fit_lines_masked(x,y,mask):
+    '''Least squares fit of a line y = intercept + slope*x to each row of y
+    using only values where mask is True
+    x can be a single row shared by all rows of y
+    Returns arrays of intercepts and slopes (one per row)
+    '''
+    x = np.broadcast_to(x,y.shape)
+    n = np.sum(mask,axis=1)
+    mean_x = np.sum(x*mask,axis=1)/n
+    mean_y = np.sum(y*mask,axis=1)/n
+    dx = (x-mean_x[:,np.newaxis])*mask
+    slope = np.sum(dx*(y-mean_y[:,np.newaxis]),axis=1)/np.sum(dx*dx,axis=1)
+    intercept = mean_y-slope*mean_x
+    return intercept,slope
+
+# mean of negative values in each row (nan if there are none)
+def get_negative_mean(data):
+    negative = data<0
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return np.sum(data*negative,axis=1)/np.sum(negative,axis=1)
+
+def get_median_mad(data,axis=None,scale=1.0):
+    '''Median and median absolute deviation of data along axis (of all values if axis is None)
+    Both are found with selection (partition) instead of sorting, the median is computed once
+    and reused for the deviations which are then partitioned in place
+    scale='normal' gives the same scale as scipy's median_absolute_deviation
+    '''
+    data = np.asarray(data)
+    median = np.median(data,axis=axis,keepdims=True)
+    deviations = np.abs(data-median)
+    mad = np.median(deviations,axis=axis,overwrite_input=True)
+    if scale == 'normal':
+        scale = stats.norm.ppf(0.75)
+    return np.squeeze(median,axis=axis),mad/scale
+
+# robust z-score of each row: (data-median)/median absolute deviation of baseline samples
+def get_baseline_zscore(data,baseline_ind):
+    data = np.asarray(data)
+    baseline = data[:,baseline_ind]
+    zb,mad = get_median_mad(baseline,axis=1)
+    return (data-zb[:,np.newaxis])/mad[:,np.newaxis]
+
+# area under the curve (trapezoidal rule) of y (or each row of y)
+def get_auc(x,y):
+    return trapz(y,x,axis=-1)
+
+def get_auc_by_second(ts,data,perievent_options_dict):
+    '''Returns (n_trials,n_bins) array with area under the curve of each trial in one second bins
+    from sec_before till sec_after (samples at the bin edges are not included in any bin)
+    '''
+    data = np.asarray(data)
+    starts = []
+    start = -perievent_options_dict["sec_before"]
+    end = start + 1
+    while end < perievent_options_dict["sec_after"]:
+        starts.append(start)
+        start = end
+        end = start+1
+    starts = np.asarray(starts)
+    # area of each trapezoid and cumulative area from the first sample
+    areas = (data[:,1:]+data[:,:-1])/2*np.diff(ts)
+    cumulative = np.concatenate((np.zeros((len(data),1)),np.cumsum(areas,axis=1)),axis=1)
+    # first and last sample inside each bin (ts is sorted)
+    first = np.searchsorted(ts,starts,side='right')
+    last = np.maximum(np.searchsorted(ts,starts+1,side='left')-1,first)
+    first = np.minimum(first,len(ts)-1)
+    last = np.minimum(last,len(ts)-1)
+    return cumulative[:,last]-cumulative[:,first]
+
+def normalize_trials(ts,signal,control,normalization):
+    '''Normalizes each trial (row) of signal and control arrays with the method from settings
+    the same way as normalize_trace (without z-score)
+    ts is the time axis shared by all trials
+    Returns (n_trials,n_samples) array of dF/F
+    '''
+    F0_signal,F0_control = get_trials_F0(ts,signal,control,normalization)
+    dffnorm = get_dff(signal,control,F0_signal,F0_control)
+    # find all values of the normalized DF/F that are negative so you can next shift up the curve 
+    # to make 0 the mean value for DF/F
+    return dffnorm-get_negative_mean(dffnorm)[:,np.newaxis]
+
 def analyze_perievent_data(data,current_trials,perievent_options_dict,settings_dict,signal_name,control_name):
     # create a dictionary with analysed data for plotting
     analyzed_perievent_dict = {}
@@ -1004,127 +1542,37 @@ def analyze_perievent_data(data,current_trials,perievent_options_dict,settings_d
     # add that dict to all analysed data dict
     analyzed_perievent_dict["average"] = avg_data2plot_dict
     
-    if settings_dict[0]["filter"] == True:
+    # all trials as (n_trials,n_samples) arrays
+    GCaMP_perievent_data = np.asarray(GCaMP_perievent_data,dtype=np.float64)
+    control_perievent_data = np.asarray(control_perievent_data,dtype=np.float64)
+    # windows cut from the whole trace normalized signal are already smoothed and normalized
+    normalized_perievent_data = []
+    if perievent_options_dict.get("use_normalized_trace",False) == True:
+        normalized_perievent_data = get_normalized_perievent_data(data)
+        if len(current_trials) > 0 and len(normalized_perievent_data) > 0:
+            normalized_perievent_data = np.asarray([normalized_perievent_data[trial-1] for trial in current_trials])
+    if len(normalized_perievent_data) > 0:
+        print("Using whole trace normalized data")
+    elif settings_dict[0]["filter"] == True:
         print("Start smoothing",settings_dict[0]["filter_window"])
-        # smooth data using lowess filter
-        temp_signal_smoothed = []
-        temp_control_smoothed = []
-        a = 1
-        b = np.divide(np.ones((settings_dict[0]["filter_window"],)), settings_dict[0]["filter_window"])
-        for i in range(len(GCaMP_perievent_data)):
-            single_evt = filtfilt(b, a, GCaMP_perievent_data[i])
-            temp_signal_smoothed.append(single_evt)
-        for i in range(len(control_perievent_data)):
-            single_evt = filtfilt(b, a, control_perievent_data[i])
-            temp_control_smoothed.append(single_evt)
-        if len(temp_signal_smoothed) > 0 and len(temp_control_smoothed) > 0:
-            GCaMP_perievent_data = temp_signal_smoothed
-            control_perievent_data = temp_control_smoothed
+        # smooth each trial
+        if len(GCaMP_perievent_data) > 0 and len(control_perievent_data) > 0:
+            GCaMP_perievent_data = smooth_data(GCaMP_perievent_data,settings_dict[0]["filter_window"],axis=1)
+            control_perievent_data = smooth_data(control_perievent_data,settings_dict[0]["filter_window"],axis=1)
         print("Done smoothing")
         
-    # normalize
-    y_dff_all = []
-    # find out how to normalize
-    if settings_dict[0]["normalization"] == 'Standard Polynomial Fitting':
-        # https://github.com/djamesbarker/pMAT
-        for x, y in zip(control_perievent_data, GCaMP_perievent_data):
-            x = np.array(x)
-            y = np.array(y)           
-            ########################################################################################################################
-            # Before removing +/-2xstdev
-        #     # https://stackoverflow.com/questions/45338872/matlab-polyval-function-with-three-outputs-equivalent-in-python-numpy
-        #     mu = np.mean(x)
-        #     std = np.std(x, ddof=0)
-        #     # Call np.polyfit(), using the shifted and scaled version of control_arr
-        #     cscaled = np.polynomial.polynomial.Polynomial.fit((x - mu)/std, y, 1)
-        #     # Create a poly1d object that can be called
-        #     # https://numpy.org/doc/stable/reference/routines.polynomials.html
-        #     pscaled = Polynomial(cscaled.convert().coef)
-        #     # Inputs to pscaled must be shifted and scaled using mu and std
-        #     F0 = pscaled((x - mu)/std)
-        # #    print("F0?",F0[:20])
-        #     dffnorm = (y - F0)/F0 * 100
-            #############################################################################################
-            # filter out signal values that are below or above 2 standard deviations from the signal mean 
-            mean_signal = np.mean(y)
-            stdev_signal = np.std(y)
-            indexes = np.where((y<mean_signal+2*stdev_signal) & (y>mean_signal-2*stdev_signal))
-            selected_signal = y[indexes]
-            selected_control = x[indexes]
-            mu = np.mean(selected_control)
-            std = np.std(selected_control)
-            cscaled = np.polynomial.polynomial.Polynomial.fit((selected_control - mu)/std, selected_signal, 1)
-            pscaled = Polynomial(cscaled.convert().coef)
-            F0 = pscaled((x - mu)/std)
-            dffnorm = (y - F0)/F0 * 100
-            #############################################################################
-            # find all values of the normalized DF/F that are negative so you can next shift up the curve 
-            # to make 0 the mean value for DF/F
-            negative = dffnorm[dffnorm<0]
-            dff=dffnorm-np.mean(negative)
-            y_dff_all.append(dff)
-            
-    elif settings_dict[0]["normalization"] == 'Modified Polynomial Fitting':
-        for x, y in zip(control_perievent_data, GCaMP_perievent_data):
-            x = np.array(x)
-            y = np.array(y)
-            ##################################################################################
-            # Before removing +/-2xstdev
-            # bls_signal = np.polynomial.polynomial.Polynomial.fit(ts_signal4average, y, 1)
-            # F0_signal = polyval(ts_signal4average,bls_signal.convert().coef)
-            # dFF_signal = (y - F0_signal)/F0_signal *100
-            
-            # bls_control = np.polynomial.polynomial.Polynomial.fit(ts_control4average,x,1)
-            # F0_control = polyval(ts_control4average,bls_control.convert().coef)
-            # dFF_control = (x - F0_control)/F0_control *100
-            # dFFnorm = dFF_signal - dFF_control
-            ############################################################################################
-            # 23/01 filter out signal values that are below or above 2 standard deviations from the signal mean 
-            mean_signal = np.mean(y)
-            stdev_signal = np.std(y)
-            mean_control = np.mean(x)
-            stdev_control = np.std(x)
-            indexes_signal = np.where((y<mean_signal+2*stdev_signal) & (y>mean_signal-2*stdev_signal))
-            selected_signal = y[indexes_signal]
-            selected_ts_signal_arr = ts_signal4average[indexes_signal]
-            indexes_control = np.where((x<mean_control+2*stdev_control) & (x>mean_control-2*stdev_control))
-            selected_control = x[indexes_control]
-            selected_ts_control_arr = ts_control4average[indexes_control]
-            # fit time axis to the 465nm stream  
-            bls_signal = np.polynomial.polynomial.Polynomial.fit(selected_ts_signal_arr,selected_signal,1)
-            bls_control = np.polynomial.polynomial.Polynomial.fit(selected_ts_control_arr,selected_control,1)
-            F0_signal = polyval(ts_signal4average,bls_signal.convert().coef)
-            F0_control = polyval(ts_signal4average,bls_control.convert().coef)
-            # dF/F for the 465 channel
-            dFF_signal = (y - F0_signal)/F0_signal *100
-            # dF/F for the 405 channel
-            dFF_control = (x - F0_control)/F0_control *100
-            dFFnorm = dFF_signal - dFF_control
-            #############################################################################################
-            # find all values of the normalized DF/F that are negative so you can next shift up the curve 
-            # to make 0 the mean value for DF/F
-            negative = dFFnorm[dFFnorm<0]
-            dFF = dFFnorm-np.mean(negative)
-            y_dff_all.append(dFF)
-    
+    # normalize all trials at once
+    if len(normalized_perievent_data) > 0:
+        y_dff_all = np.asarray(normalized_perievent_data,dtype=np.float64)
+    else:
+        y_dff_all = normalize_trials(ts_signal4average,GCaMP_perievent_data,control_perievent_data,settings_dict[0]["normalization"])
                    
     # get the z-score and standard error(median absolute deviation in pMat)
-    zscore_all = []
-    for dF in y_dff_all:
-       ind = np.where((np.array(ts_control4average)<perievent_options_dict["baseline_to"]) & (np.array(ts_control4average)>perievent_options_dict["baseline_from"]))
-       zb = np.median(dF[ind])
-       mad = stats.median_abs_deviation(dF[ind])
-       zscore_all.append((dF - zb)/mad)
+    # of all trials at once, using the same baseline samples in each trial
+    baseline_ind = (ts_control4average<perievent_options_dict["baseline_to"]) & (ts_control4average>perievent_options_dict["baseline_from"])
+    zscore_all = get_baseline_zscore(y_dff_all,baseline_ind)
     zerror = np.std(zscore_all, axis=0)/np.sqrt(np.size(zscore_all, axis=0))
     
-#    for dF in y_dff_all:
-#        ind = np.where((np.array(ts_control4average)<perievent_options_dict["baseline_to"]) & (np.array(ts_control4average)>perievent_options_dict["baseline_from"]))
-#        zb = np.mean(dF[ind])
-#        zsd = np.std(dF[ind])
-#        zscore_all.append((dF - zb)/zsd)
-#
-#    zerror = np.std(zscore_all, axis=0)/np.sqrt(np.size(zscore_all, axis=0))
-    
     # create dictionary with data for z-score plot
     zscore_data2plot_dict = {}
     zscore_data2plot_dict["ts"] = ts_control4average
@@ -1134,43 +1582,25 @@ def analyze_perievent_data(data,current_trials,perievent_options_dict,settings_d
     analyzed_perievent_dict["zscore"] = zscore_data2plot_dict
     
     # Quantify changes as an area under the curve
-    pre_ind = np.where((np.array(ts_control4average)<perievent_options_dict["auc_pre_to"]) & (np.array(ts_control4average)>perievent_options_dict["auc_pre_from"]))
-    AUC_pre = auc(ts_control4average[pre_ind], np.mean(zscore_all, axis=0)[pre_ind])
-    post_ind = np.where((np.array(ts_control4average)>perievent_options_dict["auc_post_from"]) & (np.array(ts_control4average)<perievent_options_dict["auc_post_to"]))
-    AUC_post= auc(ts_control4average[post_ind], np.mean(zscore_all, axis=0)[post_ind])
+    mean_zscore = np.mean(zscore_all, axis=0)
+    pre_ind = (ts_control4average<perievent_options_dict["auc_pre_to"]) & (ts_control4average>perievent_options_dict["auc_pre_from"])
+    AUC_pre = get_auc(ts_control4average[pre_ind], mean_zscore[pre_ind])
+    post_ind = (ts_control4average>perievent_options_dict["auc_post_from"]) & (ts_control4average<perievent_options_dict["auc_post_to"])
+    AUC_post= get_auc(ts_control4average[post_ind], mean_zscore[post_ind])
     AUC = [AUC_pre, AUC_post]  
     # run a two-sample T-test
-    t_stat,p_val = stats.ttest_ind(np.mean(zscore_all, axis=0)[pre_ind],
-                               np.mean(zscore_all, axis=0)[post_ind], equal_var=False)
+    t_stat,p_val = stats.ttest_ind(mean_zscore[pre_ind],
+                               mean_zscore[post_ind], equal_var=False)
 
-    aucs_pre_by_trial =[]
-    aucs_post_by_trial = []
     # get single trial aucs
-    for i in range(len(zscore_all)):
-        pre = auc(ts_control4average[pre_ind], zscore_all[i][pre_ind])
-        aucs_pre_by_trial.append(pre)
-        post = auc(ts_control4average[post_ind], zscore_all[i][post_ind])
-        aucs_post_by_trial.append(post)
+    aucs_pre_by_trial = list(get_auc(ts_control4average[pre_ind], zscore_all[:,pre_ind]))
+    aucs_post_by_trial = list(get_auc(ts_control4average[post_ind], zscore_all[:,post_ind]))
 
-    # print("pre mean",np.mean(np.asarray(aucs_pre_by_trial)),AUC_pre)
-    # print("post mean",np.mean(np.asarray(aucs_post_by_trial)),AUC_post)
     AUC_pre_err = np.std(np.asarray(aucs_pre_by_trial)/np.sqrt(len(aucs_pre_by_trial)))
     AUC_post_err = np.std(np.asarray(aucs_post_by_trial)/np.sqrt(len(aucs_post_by_trial)))
-    # print("errors",AUC_pre_err,AUC_post_err)
 
-    
     # bin auc data in one second bins
-    # create indexes
-    aucs = [[] for i in range(len(zscore_all))]
-    start = -perievent_options_dict["sec_before"]
-    end = start + 1
-    while end < perievent_options_dict["sec_after"]:
-        ind = np.where((np.array(ts_control4average)<end) & (np.array(ts_control4average)>start))
-        for i in range(len(zscore_all)):
-            my_auc = auc(ts_control4average[ind], zscore_all[i][ind])
-            aucs[i].append(my_auc)
-        start = end
-        end = start+1
+    aucs = [list(trial_aucs) for trial_aucs in get_auc_by_second(ts_control4average,zscore_all,perievent_options_dict)]
         
     # create dictionary with data for AUC plot
     auc_data2plot_dict = {}
@@ -1199,6 +1629,7 @@ def get_settings_df(settings_dict):
     group = settings_dict[0]["subject_group_name"]
     my_df = pd.DataFrame({"rate after downsampling (Hz)":[downsample_rate],
                           "number of averaged samples for downsampling":[downsample_no],
+                          "downsampling method":[settings_dict[0]["downsample_method"]],
                           "normalization":[normalization],
                           "normalization as": normalization_as,
                           "filter":[filter_on],
@@ -2497,124 +2928,34 @@ def plot_raw_perievents(canvas,subject,modified_data,current_trials,perievent_op
     if total_plots > 9:
         total_plots = 9
     
-    if settings_dict[0]["filter"] == True:
+    # windows cut from the whole trace normalized signal are already smoothed and normalized
+    normalized_perievent_data = []
+    if perievent_options_dict.get("use_normalized_trace",False) == True:
+        normalized_perievent_data = get_normalized_perievent_data(modified_data)
+        if len(current_trials) > 0 and len(normalized_perievent_data) > 0:
+            normalized_perievent_data = [normalized_perievent_data[trial-1] for trial in current_trials]
+    if len(normalized_perievent_data) > 0:
+        print("Using whole trace normalized data")
+    elif settings_dict[0]["filter"] == True:
         print("Start smoothing",settings_dict[0]["filter_window"])
-        # smooth data using filter
-        temp_signal_smoothed = []
-        temp_control_smoothed = []
-        a = 1
-        b = np.divide(np.ones((settings_dict[0]["filter_window"],)), settings_dict[0]["filter_window"])
-        for i in range(len(GCaMP_perievent_data)):
-            single_evt = filtfilt(b, a, GCaMP_perievent_data[i])
-            # single_evt = gaussian_filter(GCaMP_perievent_data[i], sigma=settings_dict[0]["filter_fraction"])
-#            single_evt = lowess.lowess(pd.Series(ts_signal4average), pd.Series(GCaMP_perievent_data[i]), 
-#                                       bandwidth=settings_dict[0]["filter_fraction"], polynomialDegree=1)
-            temp_signal_smoothed.append(single_evt)
-        for i in range(len(control_perievent_data)):
-            single_evt = filtfilt(b, a, control_perievent_data[i])
-            # single_evt = gaussian_filter(control_perievent_data[i], sigma=settings_dict[0]["filter_fraction"])
-#            single_evt = lowess.lowess(pd.Series(ts_control4average), pd.Series(control_perievent_data[i]), 
-#                                       bandwidth=settings_dict[0]["filter_fraction"], polynomialDegree=1)
-            temp_control_smoothed.append(single_evt)
-        if len(temp_signal_smoothed) > 0 and len(temp_control_smoothed) > 0:
-            GCaMP_perievent_data = temp_signal_smoothed
-            control_perievent_data = temp_control_smoothed
+        # smooth each trial
+        if len(GCaMP_perievent_data) > 0 and len(control_perievent_data) > 0:
+            GCaMP_perievent_data = smooth_data(np.asarray(GCaMP_perievent_data,dtype=np.float64),settings_dict[0]["filter_window"],axis=1)
+            control_perievent_data = smooth_data(np.asarray(control_perievent_data,dtype=np.float64),settings_dict[0]["filter_window"],axis=1)
         print("Done smoothing")
         
     # normalize
     y_dff_all = []
-    # find out how to normalize
-    if settings_dict[0]["normalization"] == 'Standard Polynomial Fitting':
-        # https://github.com/djamesbarker/pMAT
-        for x, y in zip(control_perievent_data, GCaMP_perievent_data):
-            x = np.array(x)
-            y = np.array(y)
-            # Before removing +/- 2xstdev
-        #     # https://stackoverflow.com/questions/45338872/matlab-polyval-function-with-three-outputs-equivalent-in-python-numpy
-        #     mu = np.mean(x)
-        #     std = np.std(x, ddof=0)
-        #     # Call np.polyfit(), using the shifted and scaled version of control_arr
-        #     cscaled = np.polynomial.polynomial.Polynomial.fit((x - mu)/std, y, 1)
-        #     # Create a poly1d object that can be called
-        #     # https://numpy.org/doc/stable/reference/routines.polynomials.html
-        #     pscaled = Polynomial(cscaled.convert().coef)
-        #     # Inputs to pscaled must be shifted and scaled using mu and std
-        #     F0 = pscaled((x - mu)/std)
-        # #    print("F0?",F0[:20])
-        #     dffnorm = (y - F0)/F0 * 100
-        #############################################################################################
-            # filter out signal values that are below or above 2 standard deviations from the signal mean 
-            mean_signal = np.mean(y)
-            stdev_signal = np.std(y)
-            indexes = np.where((y<mean_signal+2*stdev_signal) & (y>mean_signal-2*stdev_signal))
-            selected_signal = y[indexes]
-            selected_control = x[indexes]
-            mu = np.mean(selected_control)
-            std = np.std(selected_control)
-            cscaled = np.polynomial.polynomial.Polynomial.fit((selected_control - mu)/std, selected_signal, 1)
-            pscaled = Polynomial(cscaled.convert().coef)
-            F0 = pscaled((x - mu)/std)
-            dffnorm = (y - F0)/F0 * 100
-        #############################################################################################################################
-            # find all values of the normalized DF/F that are negative so you can next shift up the curve 
-            # to make 0 the mean value for DF/F
-            negative = dffnorm[dffnorm<0]
-            dff=dffnorm-np.mean(negative)
-
-            if show_norm_as == "Z-Score":
-                median_all = np.median(dff)
-                mad = stats.median_abs_deviation(dff)
-                dff = (dff - median_all)/mad
-
-            y_dff_all.append(dff)
-            
-    elif settings_dict[0]["normalization"] == 'Modified Polynomial Fitting':
-        for x, y in zip(control_perievent_data, GCaMP_perievent_data):
-            x = np.array(x)
-            y = np.array(y)
-            # Before removing +/- 2xstdev
-            # bls_signal = np.polynomial.polynomial.Polynomial.fit(ts1, y, 1)
-            # F0_signal = polyval(ts1,bls_signal.convert().coef)
-            # dFF_signal = (y - F0_signal)/F0_signal *100
-            
-            # bls_control = np.polynomial.polynomial.Polynomial.fit(ts2,x,1)
-            # F0_control = polyval(ts2,bls_control.convert().coef)
-            # dFF_control = (x - F0_control)/F0_control *100
-            # dFFnorm = dFF_signal - dFF_control
-            ############################################################################################
-            # 23/01 filter out signal values that are below or above 2 standard deviations from the signal mean 
-            mean_signal = np.mean(y)
-            stdev_signal = np.std(y)
-            mean_control = np.mean(x)
-            stdev_control = np.std(x)
-            indexes_signal = np.where((y<mean_signal+2*stdev_signal) & (y>mean_signal-2*stdev_signal))
-            selected_signal = y[indexes_signal]
-            selected_ts_signal_arr = ts1[indexes_signal]
-            indexes_control = np.where((x<mean_control+2*stdev_control) & (x>mean_control-2*stdev_control))
-            selected_control = x[indexes_control]
-            selected_ts_control_arr = ts2[indexes_control]
-            # fit time axis to the 465nm stream  
-            bls_signal = np.polynomial.polynomial.Polynomial.fit(selected_ts_signal_arr,selected_signal,1)
-            bls_control = np.polynomial.polynomial.Polynomial.fit(selected_ts_control_arr,selected_control,1)
-            F0_signal = polyval(ts1,bls_signal.convert().coef)
-            F0_control = polyval(ts2,bls_control.convert().coef)
-            # dF/F for the 465 channel
-            dFF_signal = (y - F0_signal)/F0_signal *100
-            # dF/F for the 405 channel
-            dFF_control = (x - F0_control)/F0_control *100
-            dFFnorm = dFF_signal - dFF_control
-            ######################################################################################
-            # find all values of the normalized DF/F that are negative so you can next shift up the curve 
-            # to make 0 the mean value for DF/F
-            negative = dFFnorm[dFFnorm<0]
-            dff = dFFnorm-np.mean(negative)
-
-            if show_norm_as == "Z-Score":
-                median_all = np.median(dff)
-                mad = stats.median_abs_deviation(dff)
-                dff = (dff - median_all)/mad
-
-            y_dff_all.append(dff)
+    if len(normalized_perievent_data) > 0:
+        y_dff_all = [np.asarray(trial,dtype=np.float64) for trial in normalized_perievent_data]
+    elif len(GCaMP_perievent_data) > 0:
+        # all trials at once, the same way as in analyze_perievent_data
+        y_dff_all = normalize_trials(ts1,np.asarray(GCaMP_perievent_data,dtype=np.float64),
+                                     np.asarray(control_perievent_data,dtype=np.float64),settings_dict[0]["normalization"])
+        if show_norm_as == "Z-Score":
+            median_all,mad = get_median_mad(y_dff_all,axis=1)
+            y_dff_all = (y_dff_all - median_all[:,np.newaxis])/mad[:,np.newaxis]
+        y_dff_all = list(y_dff_all)
     # print(f"How many trials in preview plot perievent: {len(y_dff_all)}")
     # plot
     # clear previous figure
@@ -5590,48 +5931,24 @@ def get_batch_perievent_auc(canvas,my_all_dfs,group_names,perievent_options_dict
     ts = np.asarray(ts_df[0]['Time (sec)'].tolist())
     
     # Quantify changes as an area under the curve
-    pre_ind = np.where((np.array(ts)<perievent_options_dict["auc_pre_to"]) & (np.array(ts)>perievent_options_dict["auc_pre_from"]))
-   
-    AUC_pre = auc(ts[pre_ind], mean_zscore[pre_ind])
-    post_ind = np.where((np.array(ts)>perievent_options_dict["auc_post_from"]) & (np.array(ts)<perievent_options_dict["auc_post_to"]))
-    AUC_post= auc(ts[post_ind], mean_zscore[post_ind])
+    pre_ind = (ts<perievent_options_dict["auc_pre_to"]) & (ts>perievent_options_dict["auc_pre_from"])
+    AUC_pre = get_auc(ts[pre_ind], mean_zscore[pre_ind])
+    post_ind = (ts>perievent_options_dict["auc_post_from"]) & (ts<perievent_options_dict["auc_post_to"])
+    AUC_post= get_auc(ts[post_ind], mean_zscore[post_ind])
     AUC = [AUC_pre, AUC_post]   
 
-
-    aucs_pre_by_trial =[]
-    aucs_post_by_trial = []
-    zscore_all = []
-    # get each trials zscores
-    for col in by_trials_df.columns:
-        zscore_all.append(np.asarray(by_trials_df[col].tolist()))
-    for i in range(len(zscore_all)):
-        pre = auc(ts[pre_ind], zscore_all[i][pre_ind])
-        aucs_pre_by_trial.append(pre)
-        post = auc(ts[post_ind], zscore_all[i][post_ind])
-        aucs_post_by_trial.append(post)
+    # get each trials zscores (trials x samples)
+    zscore_all = by_trials_df.to_numpy(dtype=np.float64).T
+    aucs_pre_by_trial = list(get_auc(ts[pre_ind], zscore_all[:,pre_ind]))
+    aucs_post_by_trial = list(get_auc(ts[post_ind], zscore_all[:,post_ind]))
 
     AUC_pre_err = np.std(np.asarray(aucs_pre_by_trial)/np.sqrt(len(aucs_pre_by_trial)))
     AUC_post_err = np.std(np.asarray(aucs_post_by_trial)/np.sqrt(len(aucs_post_by_trial)))
     # print("errors",AUC_pre_err,AUC_post_err)
         
-
     # bin auc data in one second bins
-    # create indexes
-    # print(df_all_trials.head(20))
     col_names = df_all_trials.columns.tolist()
-    aucs = [[] for i in range(len(col_names))]
-    start = -perievent_options_dict["sec_before"]
-    end = start + 1
-    while end < perievent_options_dict["sec_after"]:
-        ind = np.where((np.array(ts)<end) & (np.array(ts)>start))
-        for i in range(len(col_names)):
-            trial_zscore = np.asarray(df_all_trials[col_names[i]].tolist())
-            # if i == 0:
-            #     print(trial_zscore[ind])
-            my_auc = auc(ts[ind], trial_zscore[ind])
-            aucs[i].append(my_auc)
-        start = end
-        end = start+1
+    aucs = [list(trial_aucs) for trial_aucs in get_auc_by_second(ts,df_all_trials.to_numpy(dtype=np.float64).T,perievent_options_dict)]
         
     # plot
     # clear previous figure
@@ -5698,249 +6015,69 @@ def get_batch_perievent_auc(canvas,my_all_dfs,group_names,perievent_options_dict
     dump_plot_file_path = os.path.join(dump_path,plot_file_name)
     canvas.fig.savefig(dump_plot_file_path, format='svg', dpi=DPI4SVG)
     
-def show_polynomial_fitting(canvas, settings_dict,downsampled,signal_name,control_name,subject_name,save_plot,dump_path):
+def get_polynomial_fitting(settings_dict,downsampled,baseline_dict=None,normalized_dict=None):
+    '''Returns time axis, (smoothed) signal and control of downsampled data
+    and the fit used for their normalization (see get_normalization_fit).
+    The fit is read from normalized_dict if it was normalized with the same settings,
+    otherwise lines are fitted to baseline_dict data (or to the whole trace if it is None)
+    '''
     normalization = settings_dict["normalization"]
     smooth = settings_dict["filter"]
     smooth_window = settings_dict["filter_window"]
-    
     # change lists to numpy array for calculations
     ts_arr = np.asarray(downsampled["ts"])
     signal_arr =np.asarray(downsampled["signal"])
     control_arr = np.asarray(downsampled["control"])
-    # reset time to start from zero
-    total_seconds = ts_arr[-1]-ts_arr[0]
-    # start time from zero
-    ts_reset = [i*total_seconds/len(ts_arr) for i in range(len(ts_arr))]
-
     if smooth == True:
         print("Start smoothing",smooth_window)
-        a = 1
-        b = np.divide(np.ones((smooth_window,)), smooth_window)
-        control_arr = filtfilt(b, a, control_arr)
-        signal_arr = filtfilt(b, a, signal_arr)
+        control_arr = smooth_data(control_arr,smooth_window)
+        signal_arr = smooth_data(signal_arr,smooth_window)
         print("Done smoothing")
-
-    # in order to suggest if user should normalize using modified method
-    # check if signals in both channels do not decrease equally
-    # filter out signal values that are below or above 2 standard deviations from the signal mean 
-    # fit time axis to the 465nm stream 
-    mean_signal = np.mean(signal_arr)
-    stdev_signal = np.std(signal_arr)
-    mean_control = np.mean(control_arr)
-    stdev_control = np.std(control_arr)
-    indexes_signal = np.where((signal_arr<mean_signal+2*stdev_signal) & (signal_arr>mean_signal-2*stdev_signal))
-    selected_signal = signal_arr[indexes_signal]
-    selected_ts_signal_arr = ts_arr[indexes_signal]
-    indexes_control = np.where((control_arr<mean_control+2*stdev_control) & (control_arr>mean_control-2*stdev_control))
-    selected_control = control_arr[indexes_control]
-    selected_ts_control_arr = ts_arr[indexes_control]
-    # fit time axis to the 465nm stream  
-    bls_Ca = np.polynomial.polynomial.Polynomial.fit(selected_ts_signal_arr,selected_signal,1)
-    # fit time axis the 405nm stream
-    bls_ref = np.polynomial.polynomial.Polynomial.fit(selected_ts_control_arr,selected_control,1)
-    #######################
-    # Before removing +/-2xstdev
-    # bls_Ca = np.polynomial.polynomial.Polynomial.fit(ts_reset,signal_arr,1)
-    # # fit time axis the 405nm stream
-    # bls_ref = np.polynomial.polynomial.Polynomial.fit(ts_reset,control_arr,1)
-    ##################################################################################
-    # the below returns first: slope, second: intercept
-    print("bls_Ca",bls_Ca.convert().coef[::-1])
-    # the below returns first: slope, second: intercept
-    print("bls_ref",bls_ref.convert().coef[::-1])
-    # put those values in a dictionary
-    slope_intercept_dict = {"signal_slope_intercept":bls_Ca.convert().coef[::-1],
-                            "control_slope_intercept":bls_ref.convert().coef[::-1]
-    }
-
-    if normalization == 'Standard Polynomial Fitting':      
-        # Before removing +/-2xstdev             
-        # # https://stackoverflow.com/questions/45338872/matlab-polyval-function-with-three-outputs-equivalent-in-python-numpy
-        # mu = np.mean(control_arr)
-        # std = np.std(control_arr, ddof=0)
-        # # Call np.polyfit(), using the shifted and scaled version of control_arr
-        # cscaled = np.polynomial.polynomial.Polynomial.fit((control_arr - mu)/std, signal_arr, 1)
-        # # Create a poly1d object that can be called
-        # # https://numpy.org/doc/stable/reference/routines.polynomials.html
-        # pscaled = Polynomial(cscaled.convert().coef)
-        # # Inputs to pscaled must be shifted and scaled using mu and std
-        # F0 = pscaled((control_arr - mu)/std)    
-        #############################################################################################
+    fit = None
+    if normalized_dict != None and "fit" in normalized_dict:
+        fit = normalized_dict["fit"]
+        if fit.get("normalization") != normalization:
+            fit = None
+    if fit == None:
+        if baseline_dict != None and NORMALIZATION_BACKENDS[normalization]["extrapolate"] == False:
+            baseline_dict = None
+        # in order to suggest if user should normalize using modified method
+        # check if signals in both channels do not decrease equally
         # filter out signal values that are below or above 2 standard deviations from the signal mean 
-        mean_signal = np.mean(signal_arr)
-        stdev_signal = np.std(signal_arr)
-        indexes = np.where((signal_arr<mean_signal+2*stdev_signal) & (signal_arr>mean_signal-2*stdev_signal))
-        selected_signal = signal_arr[indexes]
-        selected_control = control_arr[indexes]
-        mu = np.mean(selected_control)
-        std = np.std(selected_control)
-        cscaled = np.polynomial.polynomial.Polynomial.fit((selected_control - mu)/std, selected_signal, 1)
-        pscaled = Polynomial(cscaled.convert().coef)
-        F0 = pscaled((control_arr - mu)/std)
-        #################################################################################
-        # plot
-        # clear previous figure
-        canvas.fig.clf()
-        ax = canvas.fig.add_subplot(111)
-        
-        ax.plot(ts_reset, signal_arr, linewidth=1, color=SIGNAL_COLOR_RGB, label='F'+signal_name)
-        ax.plot(ts_reset, F0, linewidth=1, color='k', label='F0')
-        
-        my_title = "Check polynomial fitting: " + normalization
-        ax.set_title(my_title,fontsize=FIGURE_TITLE_FONT_SIZE)
-#        canvas.fig.suptitle(my_title, fontsize=FIGURE_TITLE_FONT_SIZE)
-        ax.set_ylabel('mV',fontsize=AXIS_LABEL_FONTSIZE)
-        ax.set_xlabel('Time (sec)', fontsize=AXIS_LABEL_FONTSIZE)
-        # show only intiger yticks
-        ax.yaxis.set_major_locator(MaxNLocator(integer=True))
-        # hide top and right border
-        ax.spines['top'].set_visible(False)
-        ax.spines['right'].set_visible(False)
-        ax.legend(loc=MY_LEGEND_LOC, bbox_to_anchor=MY_LEGENG_POS)
-    
-        canvas.draw()
-    
-    if normalization == 'Modified Polynomial Fitting':           
-        F0Ca = polyval(ts_reset,bls_Ca.convert().coef)
-        F0Ref = polyval(ts_reset,bls_ref.convert().coef)
-        #######################################################
-        # plot
-        # clear previous figure
-        canvas.fig.clf()
-        ax = canvas.fig.add_subplot(211)
-        ax2 = canvas.fig.add_subplot(212)
-        
-        ax.plot(ts_reset, signal_arr, linewidth=1, color=SIGNAL_COLOR_RGB, label='F'+signal_name)
-        ax.plot(ts_reset, F0Ca, linewidth=1, color='k', label='F0')
-        
-        ax2.plot(ts_reset, control_arr, linewidth=1, color=CONTROL_COLOR_RGB, label='F'+control_name)
-        ax2.plot(ts_reset, F0Ref, linewidth=1, color='k', label='F0')
-        
-        my_title = "Check polynomial fitting: " + normalization
-#        ax.set_title(my_title,fontsize=14)
-        canvas.fig.suptitle(my_title, fontsize=FIGURE_TITLE_FONT_SIZE)
-        ax.set_ylabel('mV',fontsize=AXIS_LABEL_FONTSIZE)
-        ax.set_xlabel('Time (sec)', fontsize=AXIS_LABEL_FONTSIZE)
-        # show only intiger yticks
-        ax.yaxis.set_major_locator(MaxNLocator(integer=True))
-        # hide top and right border
-        ax.spines['top'].set_visible(False)
-        ax.spines['right'].set_visible(False)
-        ax.legend(loc=MY_LEGEND_LOC, bbox_to_anchor=MY_LEGENG_POS)
-        ax2.set_ylabel('mV',fontsize=AXIS_LABEL_FONTSIZE)
-        ax2.set_xlabel('Time (sec)', fontsize=AXIS_LABEL_FONTSIZE)
-        # show only intiger yticks
-        ax2.yaxis.set_major_locator(MaxNLocator(integer=True))
-        # hide top and right border
-        ax2.spines['top'].set_visible(False)
-        ax2.spines['right'].set_visible(False)
-        ax2.legend(loc=MY_LEGEND_LOC, bbox_to_anchor=MY_LEGENG_POS)
-
-    if save_plot == True:
-        my_path = dump_path
-        file_name = subject_name+"_poly_fitting.png"
-        save_path = os.path.join(my_path,file_name)
-        canvas.fig.savefig(save_path)
-        # also as svg
-        file_name = subject_name+"_poly_fitting.svg"
-        dump_plot_file_path = os.path.join(dump_path,file_name)
-        canvas.fig.savefig(dump_plot_file_path, format='svg', dpi=DPI4SVG)
-    else:
-        canvas.draw()
-    return slope_intercept_dict
+        if baseline_dict != None:
+            print(f"All trace: first: {ts_arr[0]}, last: {ts_arr[-1]}")
+            ts_baseline_arr = np.asarray(baseline_dict["ts"])
+            signal_baseline_arr =np.asarray(baseline_dict["signal"])
+            control_baseline_arr = np.asarray(baseline_dict["control"])
+            print(f"Baseline: first: {ts_baseline_arr[0]}, last: {ts_baseline_arr[-1]}")
+            if smooth == True:
+                control_baseline_arr = smooth_data(control_baseline_arr,smooth_window)
+                signal_baseline_arr = smooth_data(signal_baseline_arr,smooth_window)
+            fit = get_normalization_fit(ts_baseline_arr,signal_baseline_arr,control_baseline_arr,normalization)
+        else:
+            fit = get_normalization_fit(ts_arr,signal_arr,control_arr,normalization)
+    return ts_arr,signal_arr,control_arr,fit
 
-def show_polynomial_fitting_custom_baseline(canvas, settings_dict,downsampled,baseline_dict,signal_name,control_name,subject_name,save_plot,dump_path):
+# normalized_dict is normalized data of the same subject with the same settings
+# (fitting is not repeated if it has the fit)
+def show_polynomial_fitting(canvas, settings_dict,downsampled,signal_name,control_name,subject_name,save_plot,dump_path,normalized_dict=None,baseline_dict=None):
     normalization = settings_dict["normalization"]
-    smooth = settings_dict["filter"]
-    smooth_window = settings_dict["filter_window"]
-    
-    # change lists to numpy array for calculations
-    ts_arr = np.asarray(downsampled["ts"])
-    signal_arr =np.asarray(downsampled["signal"])
-    control_arr = np.asarray(downsampled["control"])
-    print(f"All trace: first: {ts_arr[0]}, last: {ts_arr[-1]}")
-    # change baseline lists to numpy array for calculations
-    ts_baseline_arr = np.asarray(baseline_dict["ts"])
-    signal_baseline_arr =np.asarray(baseline_dict["signal"])
-    control_baseline_arr = np.asarray(baseline_dict["control"])
-    print(f"Baseline: first: {ts_baseline_arr[0]}, last: {ts_baseline_arr[-1]}")
+    ts_arr,signal_arr,control_arr,fit = get_polynomial_fitting(settings_dict,downsampled,baseline_dict,normalized_dict)
     # reset time to start from zero
     total_seconds = ts_arr[-1]-ts_arr[0]
-    total_seconds_baseline = ts_baseline_arr[-1]-ts_baseline_arr[0]
     # start time from zero
     ts_reset = [i*total_seconds/len(ts_arr) for i in range(len(ts_arr))]
+    # put fitted lines in a dictionary (first: slope, second: intercept)
+    slope_intercept_dict = {"signal_slope_intercept":np.array(fit["signal"][::-1]),
+                            "control_slope_intercept":np.array(fit["control"][::-1])
+    }
+    print("bls_Ca",slope_intercept_dict["signal_slope_intercept"])
+    print("bls_ref",slope_intercept_dict["control_slope_intercept"])
 
-    if smooth == True:
-        print("Start smoothing",smooth_window)
-        a = 1
-        b = np.divide(np.ones((smooth_window,)), smooth_window)
-        control_arr = filtfilt(b, a, control_arr)
-        signal_arr = filtfilt(b, a, signal_arr)
-        control_baseline_arr = filtfilt(b, a, control_baseline_arr)
-        signal_baseline_arr = filtfilt(b, a, signal_baseline_arr)
-        print("Done smoothing")
-
-    # in order to suggest if user should normalize using modified method
-    # check if signals in both channels do not decrease equally
-    # filter out signal values that are below or above 2 standard deviations from the signal mean  
-    mean_baseline_signal = np.mean(signal_baseline_arr)
-    stdev_baseline_signal = np.std(signal_baseline_arr)
-    mean_baseline_control = np.mean(control_baseline_arr)
-    stdev_baseline_control = np.std(control_baseline_arr)
-    indexes_signal = np.where((signal_baseline_arr<mean_baseline_signal+2*stdev_baseline_signal) & (signal_baseline_arr>mean_baseline_signal-2*stdev_baseline_signal))
-    selected_signal = signal_baseline_arr[indexes_signal]
-    selected_ts_baseline_signal_arr = ts_baseline_arr[indexes_signal]
-    indexes_control = np.where((control_baseline_arr<mean_baseline_control+2*stdev_baseline_control) & (control_baseline_arr>mean_baseline_control-2*stdev_baseline_control))
-    selected_control = control_baseline_arr[indexes_control]
-    selected_ts_baseline_control_arr = ts_baseline_arr[indexes_control]
-    new_signal_mean = np.mean(selected_signal)
-    new_control_mean = np.mean(selected_control)
-    # fit time axis to the 465nm stream  
-    bls_Ca = np.polynomial.polynomial.Polynomial.fit(selected_ts_baseline_signal_arr,selected_signal,1)
-    bls_ref = np.polynomial.polynomial.Polynomial.fit(selected_ts_baseline_control_arr,selected_control,1)
-
-    # put those values in a dictionary
-    slope_intercept_dict = {"signal_slope_intercept":bls_Ca.convert().coef[::-1],
-                                "control_slope_intercept":bls_ref.convert().coef[::-1]
-        }
-    ##########################################################
-    # # debug
-    # df_before = pd.DataFrame({"Time (sec)": ts_baseline_arr,
-    #                             "Signal": signal_baseline_arr,
-    #                             "Control": control_baseline_arr})
-    # df_before.to_csv("custom_baseline_before.csv", index=False)
-    # df_signal_after = pd.DataFrame({"Sample": selected_ts_baseline_signal_arr,
-    #                             "Signal": selected_signal})
-    # df_control_after = pd.DataFrame({"Sample": selected_ts_baseline_control_arr,
-    #                             "Control": selected_control})
-    # df_signal_after.to_csv("custom_baseline_signal_filtered.csv", index=False)
-    # df_control_after.to_csv("custom_baseline_control_filtered.csv", index=False)
-    #################################################################################################
-    if normalization == 'Standard Polynomial Fitting':    
-        # filter out signal values that are below or above 2 standard deviations from the signal mean  
-        mean_baseline_signal = np.mean(signal_baseline_arr)
-        stdev_baseline_signal = np.std(signal_baseline_arr)
-        indexes = np.where((signal_baseline_arr<mean_baseline_signal+2*stdev_baseline_signal) & (signal_baseline_arr>mean_baseline_signal-2*stdev_baseline_signal))
-        selected_signal = signal_baseline_arr[indexes]
-        selected_control = control_baseline_arr[indexes]
-        mu = np.mean(selected_control)
-        std = np.std(selected_control)
-        cscaled = np.polynomial.polynomial.Polynomial.fit((selected_control - mu)/std, selected_signal, 1)
-        pscaled = Polynomial(cscaled.convert().coef)
-        F0 = pscaled((control_arr - mu)/std)
-        
-        ##########################################################################################################           
-        # # https://stackoverflow.com/questions/45338872/matlab-polyval-function-with-three-outputs-equivalent-in-python-numpy
-        # mu = np.mean(control_baseline_arr)
-        # std = np.std(control_baseline_arr, ddof=0)
-        # # Call np.polyfit(), using the shifted and scaled version of control_arr
-        # cscaled = np.polynomial.polynomial.Polynomial.fit((control_baseline_arr - mu)/std, signal_baseline_arr, 1)
-        # # Create a poly1d object that can be called
-        # # https://numpy.org/doc/stable/reference/routines.polynomials.html
-        # pscaled = Polynomial(cscaled.convert().coef)
-        # # Inputs to pscaled must be shifted and scaled using mu and std
-        # F0 = pscaled((control_arr - mu)/std)  
-        ###########################################################################################################  
+    F0,F0Ref = get_F0(fit,ts_arr,signal_arr,control_arr,normalization)
+    # one plot if F0 was fitted from control, otherwise signal and control with their F0
+    if F0Ref is None:
+        #################################################################################
         # plot
         # clear previous figure
         canvas.fig.clf()
@@ -5963,15 +6100,8 @@ def show_polynomial_fitting_custom_baseline(canvas, settings_dict,downsampled,ba
     
         canvas.draw()
     
-    if normalization == 'Modified Polynomial Fitting': 
-        F0Ca = polyval(ts_arr,bls_Ca.convert().coef)
-        F0Ref = polyval(ts_arr,bls_ref.convert().coef)  
-        # print(f"signal mean, stdv, len: {mean_baseline_signal}, {stdev_baseline_signal}, {len(selected_signal)}") 
-        # print(f"control mean, stdv, len: {mean_baseline_control}, {stdev_baseline_control}, {len(selected_control)}") 
-        # print(f"signal poly: {bls_Ca.convert().coef[::-1]}\ncontrol poly: {bls_ref.convert().coef[::-1]}")
-###############################################################################
-        # F0Ca = polyval(ts_reset,bls_Ca.convert().coef)
-        # F0Ref = polyval(ts_reset,bls_ref.convert().coef)
+    else:
+        #######################################################
         # plot
         # clear previous figure
         canvas.fig.clf()
@@ -5979,7 +6109,7 @@ def show_polynomial_fitting_custom_baseline(canvas, settings_dict,downsampled,ba
         ax2 = canvas.fig.add_subplot(212)
         
         ax.plot(ts_reset, signal_arr, linewidth=1, color=SIGNAL_COLOR_RGB, label='F'+signal_name)
-        ax.plot(ts_reset, F0Ca, linewidth=1, color='k', label='F0')
+        ax.plot(ts_reset, F0, linewidth=1, color='k', label='F0')
         
         ax2.plot(ts_reset, control_arr, linewidth=1, color=CONTROL_COLOR_RGB, label='F'+control_name)
         ax2.plot(ts_reset, F0Ref, linewidth=1, color='k', label='F0')
@@ -6016,7 +6146,7 @@ def show_polynomial_fitting_custom_baseline(canvas, settings_dict,downsampled,ba
     else:
         canvas.draw()
     return slope_intercept_dict
-    
-   
-    
-    
\ No newline at end of file
+
+def show_polynomial_fitting_custom_baseline(canvas, settings_dict,downsampled,baseline_dict,signal_name,control_name,subject_name,save_plot,dump_path,normalized_dict=None):
+    return show_polynomial_fitting(canvas,settings_dict,downsampled,signal_name,control_name,subject_name,save_plot,dump_path,
+                                   normalized_dict,baseline_dict)
@@ -0,0 +1,56 @@
+import os
+import sys
+import numpy as np
+import pytest
+import tdt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fpExplorer_src"))
+
+import fpExplorer_cache
+
+SIGNAL = "_465A"
+CONTROL = "_405A"
+
+
+# tdt structure like from fpExplorer_functions.get_raw_data
+# with bleaching signal and control streams and one event
+def make_block(seconds=120, fs=1017.2526245117188, seed=0):
+    rng = np.random.RandomState(seed)
+    n = int(seconds*fs)
+    t = np.arange(n)/fs
+    bleach = 200*np.exp(-t/300)
+    control = (100+bleach*0.5+rng.normal(0,1.0,n)).astype(np.float32)
+    signal = (150+bleach+0.8*(control-100)+rng.normal(0,1.5,n)).astype(np.float32)
+    onsets = np.sort(rng.uniform(10,seconds-20,10))
+    for onset in onsets:
+        signal[(t > onset) & (t < onset+3)] += 10
+    raw_data = tdt.StructType()
+    raw_data.streams = tdt.StructType()
+    raw_data.epocs = tdt.StructType()
+    raw_data.info = tdt.StructType()
+    raw_data.info.duration = seconds
+    for name,data in [(SIGNAL,signal),(CONTROL,control)]:
+        stream = tdt.StructType()
+        stream.name = name
+        stream.fs = fs
+        stream.data = data
+        stream.start_time = 0.0
+        raw_data.streams[name] = stream
+    event = tdt.StructType()
+    event.name = "PrtA"
+    event.onset = onsets
+    event.offset = onsets+3
+    event.data = np.full(len(onsets),254.)
+    raw_data.epocs["PrtA"] = event
+    return raw_data
+
+
+@pytest.fixture
+def conversion_cache(tmp_path, monkeypatch):
+    '''Converted recordings are saved to a temporary folder'''
+    folder = str(tmp_path/"cache")
+    monkeypatch.setenv("FPEXPLORER_CACHE_FOLDER", folder)
+    monkeypatch.setenv("FPEXPLORER_CACHE_MAX_BYTES", str(fpExplorer_cache.CONVERSION_CACHE_MAX_BYTES))
+    monkeypatch.setattr(fpExplorer_cache, "CONVERSION_CACHE_FOLDER", folder)
+    monkeypatch.setattr(fpExplorer_cache, "CONVERSION_CACHE_MAX_BYTES", fpExplorer_cache.CONVERSION_CACHE_MAX_BYTES)
+    return folder
@@ -0,0 +1,45 @@
+import os
+import pandas as pd
+import pytest
+
+import fpExplorer_batch
+import fpExplorer_functions
+from conftest import SIGNAL, CONTROL, make_block
+
+
+# batch analysis reads only TDT tanks, they are replaced with synthetic blocks
+# (subjects are analyzed in this process, so that the replaced reader is used)
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch, conversion_cache):
+    main_path = tmp_path/"data"
+    for subject in ["s1","s2"]:
+        os.makedirs(str(main_path/subject/"exp"))
+    def get_raw_data(path, stream_names=[], t1=0, t2=0):
+        if "broken" in path:
+            return None
+        return make_block(seed=int(os.path.basename(os.path.dirname(path))[1:]))
+    monkeypatch.setattr(fpExplorer_functions, "get_raw_data", get_raw_data)
+    return main_path
+
+
+def get_arguments(main_path, export_path):
+    return [str(main_path),"--experiment","exp","--signal",SIGNAL,"--control",CONTROL,
+            "--event","PrtA 254","--perievent","--group-data","--no-chunked","--workers","1",
+            "--export-path",str(export_path)]
+
+
+def test_batch_main(data_folder, tmp_path):
+    export_path = tmp_path/"export"
+    assert fpExplorer_batch.main(get_arguments(data_folder,export_path)) == 0
+    for subject in ["s1","s2"]:
+        normalized = pd.read_csv(str(export_path/subject/("exp_"+subject+"_normalized.csv")))
+        assert len(normalized) > 0
+    # group data
+    assert os.path.exists(str(export_path/"exp_perievent_zscore.csv"))
+
+
+def test_batch_main_fails_when_subject_cannot_be_read(data_folder, tmp_path):
+    os.makedirs(str(data_folder/"broken"/"exp"))
+    export_path = tmp_path/"export"
+    assert fpExplorer_batch.main(get_arguments(data_folder,export_path)) == 1
+    assert os.path.exists(str(export_path/"s1"/"exp_s1_normalized.csv"))
@@ -0,0 +1,118 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+import fpExplorer_cache
+import fpExplorer_functions
+from conftest import SIGNAL, CONTROL, make_block
+
+
+def get_block_bytes():
+    return fpExplorer_cache.get_block_size(make_block(seconds=10))
+
+
+@pytest.fixture
+def read_blocks(monkeypatch):
+    '''Subjects are read from synthetic blocks (not memory mapped), returns list of read paths'''
+    monkeypatch.setattr(fpExplorer_cache, "USE_CONVERSION_CACHE", False)
+    read_paths = []
+    def get_raw_data(path, stream_names=[], t1=0, t2=0):
+        read_paths.append(path)
+        return make_block(seconds=10)
+    monkeypatch.setattr(fpExplorer_functions, "get_raw_data", get_raw_data)
+    return read_paths
+
+
+def test_raw_data_cache_releases_least_recently_used(read_blocks):
+    cache = fpExplorer_cache.RawDataCache(SIGNAL, CONTROL, max_bytes=int(2.5*get_block_bytes()))
+    for subject in ["s1","s2","s3"]:
+        cache.load(subject, subject+"_path")
+    stats = cache.get_stats()
+    assert stats["evictions"] == 1
+    assert stats["subjects"] == 2
+    assert stats["bytes"] <= stats["max_bytes"]
+    assert "s1" not in cache.data and "s1" in cache
+    # released subject is read again from its path
+    assert cache["s1"] != None
+    assert read_blocks == ["s1_path","s2_path","s3_path","s1_path"]
+    assert "s2" not in cache.data
+    cache["s3"]
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_raw_data_cache_keeps_most_recent_subject(read_blocks):
+    cache = fpExplorer_cache.RawDataCache(SIGNAL, CONTROL, max_bytes=1)
+    cache.load("s1", "s1_path")
+    cache.load("s2", "s2_path")
+    assert list(cache.data.keys()) == ["s2"]
+    # data added directly cannot be read again, so it is never released
+    cache["s3"] = make_block(seconds=10)
+    cache.load("s4", "s4_path")
+    assert list(cache.data.keys()) == ["s3","s4"]
+    del cache["s3"]
+    assert cache.total_bytes == cache.data["s4"][1]
+
+
+def test_stage_cache_byte_limit_and_clear_subject():
+    trimmed = [(0,0),fpExplorer_functions.trim_raw_data(make_block(seconds=30),SIGNAL,CONTROL,0,0)]
+    settings_dict = [{"downsample":100,"downsample_method":"Linear Interpolation",
+                      "normalization":"Standard Polynomial Fitting","show_norm_as":"Z-Score",
+                      "filter":False,"filter_window":10}]
+    cache = fpExplorer_cache.StageCache()
+    normalized = cache.normalize("s1", trimmed, settings_dict)
+    # downsampled and normalized data are both reused
+    assert cache.normalize("s1", trimmed, settings_dict) is normalized
+    assert cache.get_stats()["hits"] == 2
+    assert cache.get_stats()["misses"] == 2
+    cache.normalize("s2", trimmed, settings_dict)
+    assert cache.get_stats()["results"] == 4
+    cache.clear_subject("s1")
+    assert set([key[0] for key in cache.data.keys()]) == set(["s2"])
+    assert cache.total_bytes == sum([size for result,size in cache.data.values()])
+    assert cache.get_cached_normalized("s1", trimmed, settings_dict) is None
+    # a budget of one result keeps only the newest
+    cache.max_bytes = 1
+    cache.normalize("s1", trimmed, settings_dict)
+    assert len(cache.data) == 1
+    assert cache.get_cached_normalized("s1", trimmed, settings_dict) != None
+    assert cache.get_stats()["evictions"] > 0
+
+
+# fixed number of decimals, file size changes only with number of digits before them
+def write_recording(path, signal_offset=0.0):
+    ts = np.arange(1000)/100
+    pd.DataFrame({"Time":ts,"Signal":np.sin(ts)+signal_offset,"Control":np.cos(ts)}).to_csv(path,index=False,float_format="%.6f")
+
+
+def test_conversion_cache_reads_saved_recording(conversion_cache, tmp_path):
+    path = str(tmp_path/"recording.csv")
+    write_recording(path)
+    df = fpExplorer_cache.read_recording_csv(path)
+    assert len(fpExplorer_cache.get_conversion_folders()) == 1
+    converted = fpExplorer_cache.read_recording_csv(path)
+    assert fpExplorer_cache.is_mapped(converted.iloc[:,1].to_numpy())
+    assert np.array_equal(df.to_numpy(), converted.to_numpy())
+
+
+def test_conversion_cache_invalidated_when_size_changes(conversion_cache, tmp_path):
+    path = str(tmp_path/"recording.csv")
+    write_recording(path, 1.0)
+    fpExplorer_cache.read_recording_csv(path)
+    mtime = os.path.getmtime(path)
+    write_recording(path, 10.0)
+    os.utime(path, (mtime, mtime))
+    assert np.allclose(fpExplorer_cache.read_recording_csv(path)["Signal"], np.sin(np.arange(1000)/100)+10.0)
+
+
+def test_conversion_cache_invalidated_when_mtime_changes(conversion_cache, tmp_path):
+    path = str(tmp_path/"recording.csv")
+    write_recording(path, 1.0)
+    fpExplorer_cache.read_recording_csv(path)
+    size = os.path.getsize(path)
+    mtime = os.path.getmtime(path)
+    write_recording(path, 2.0)
+    assert os.path.getsize(path) == size
+    os.utime(path, (mtime+10, mtime+10))
+    assert np.allclose(fpExplorer_cache.read_recording_csv(path)["Signal"], np.sin(np.arange(1000)/100)+2.0)
+    assert len(fpExplorer_cache.get_conversion_folders()) == 1
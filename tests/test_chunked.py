@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+import fpExplorer_chunked
+import fpExplorer_functions
+from conftest import SIGNAL, CONTROL, make_block
+
+
+def get_chunks(raw_data, size):
+    n = min(len(raw_data.streams[SIGNAL].data),len(raw_data.streams[CONTROL].data))
+    for first in range(0,n,size):
+        yield first,raw_data.streams[SIGNAL].data[first:first+size],raw_data.streams[CONTROL].data[first:first+size]
+
+
+def get_stream_info(raw_data):
+    fs = float(raw_data.streams[SIGNAL].fs)
+    n = min(len(raw_data.streams[SIGNAL].data),len(raw_data.streams[CONTROL].data))
+    return {"fs":fs,"start_time":0.0,"duration":n/fs,"n_samples":n}
+
+
+@pytest.mark.parametrize("normalization", fpExplorer_chunked.CHUNKED_NORMALIZATION_METHODS)
+@pytest.mark.parametrize("show_norm_as", ["dF/F","Z-Score"])
+@pytest.mark.parametrize("smooth", [False,True])
+def test_normalize_chunked_matches_normalize_trace(normalization, show_norm_as, smooth):
+    trimmed = fpExplorer_functions.trim_raw_data(make_block(),SIGNAL,CONTROL,10,0)
+    downsampled = fpExplorer_functions.downsample(trimmed,10)
+    settings_dict = [{"normalization":normalization,"show_norm_as":show_norm_as,"filter":smooth,"filter_window":10}]
+    expected = fpExplorer_functions.normalize_trace(downsampled,None,normalization,show_norm_as,smooth,10)
+    # blocks much smaller than the trace
+    normalized = fpExplorer_chunked.normalize_chunked(downsampled,settings_dict,block_samples=77)
+    assert np.array_equal(normalized["ts"],expected["ts"])
+    assert np.allclose(normalized["normalized_signal"],expected["normalized_signal"],
+                       rtol=0,atol=1e-9*np.std(expected["normalized_signal"]))
+
+
+@pytest.mark.parametrize("method", fpExplorer_chunked.CHUNKED_DOWNSAMPLE_METHODS)
+def test_downsample_chunks_matches_downsample(method):
+    raw_data = make_block()
+    expected = fpExplorer_functions.downsample(fpExplorer_functions.trim_raw_data(raw_data,SIGNAL,CONTROL,12,33),10,method)
+    downsampled = fpExplorer_chunked.downsample_chunks(get_chunks(raw_data,7777),get_stream_info(raw_data),12,33,10,method)
+    for key in expected:
+        assert np.allclose(downsampled[key],expected[key],rtol=1e-12,atol=0)
+
+
+def test_downsample_chunks_refuses_polyphase():
+    raw_data = make_block(seconds=10)
+    with pytest.raises(ValueError):
+        fpExplorer_chunked.downsample_chunks(get_chunks(raw_data,1000),get_stream_info(raw_data),0,0,10,"Polyphase")